@@ -138,6 +138,62 @@ class Settings(BaseSettings):
     CACHE_TTL_SECONDS: int = 300  # 5 минут
     CACHE_FAQ_TTL_SECONDS: int = 3600  # 1 час
     
+    # База знаний разговоров (RAG)
+    KB_EMBEDDING_MODEL: str = "all-MiniLM-L6-v2"
+    KB_LOAD_BATCH_SIZE: int = 5000  # Строк за одну выборку при старте
+    KB_REEMBED_BATCH_SIZE: int = 256  # Сообщений за один фоновый проход энкодера
+    KB_ENCODER_MAX_BATCH_SIZE: int = 32  # Максимум текстов в одном батче энкодера
+    KB_ENCODER_MAX_WAIT_MS: float = 5.0  # Сколько ждать попутчиков для батча
+    KB_INGEST_QUEUE_SIZE: int = 1000  # Очередь записи; при переполнении запись ждет
+    KB_INGEST_BATCH_SIZE: int = 64  # Сообщений в одной транзакции записи
+    KB_INGEST_MAX_RETRIES: int = 3  # Повторы пачки при ошибке; затем сообщения ждут в журнале до перезапуска
+    KB_INGEST_RETRY_DELAY_SECONDS: float = 0.5  # Пауза перед первым повтором, далее удваивается
+    KB_INGEST_FSYNC: bool = True  # Один fsync журнала на пачку в фоне; без него сбой ОС теряет последние записи
+    KB_QUERY_CACHE_SIZE: int = 1024  # Векторов запросов в LRU-кэше (0 — без кэша)
+    KB_QUERY_CACHE_TTL_SECONDS: int = 3600
+    KB_TOOL_CACHE_SIZE: int = 512  # Результатов RAG-инструментов в кэше (0 — без кэша)
+    KB_TOOL_CACHE_TTL_SECONDS: int = 300  # Сводки зависят от текущей даты
+    KB_TOOL_INDEX_WAIT_SECONDS: float = 2.0  # Ожидание индексации новых сообщений перед вызовом инструментов
+    KB_RRF_K: int = 60  # Сглаживание reciprocal rank fusion
+    KB_RRF_RECENCY_WEIGHT: float = 0.5  # Надбавка свежим сообщениям при слиянии
+    KB_RRF_RECENCY_HALF_LIFE_DAYS: float = 14.0
+    KB_RRF_IMPORTANCE_WEIGHT: float = 1.0  # Степень importance_score в итоговом ранге
+    KB_TOPIC_BOOST: float = 0.5  # Надбавка к рангу сообщений с темой запроса (find_related_discussions)
+    KB_SQLITE_READERS: int = 4  # Потоков-читателей SQLite (запись всегда в одном потоке)
+    KB_SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024  # 256MB
+    KB_SQLITE_CACHED_STATEMENTS: int = 128  # Кэш подготовленных запросов на соединение
+    KB_SNAPSHOT_ENABLED: bool = True  # Снимки индекса на диске для быстрого старта
+    KB_SNAPSHOT_INTERVAL_SECONDS: int = 600  # Как часто сохранять снимок при изменениях
+    KB_MEMORY_BUDGET_MB: int = 0  # Память под векторы активных пользователей (0 — держать всех)
+    KB_NEAR_DUPLICATE_BITS: int = 3  # Порог SimHash для почти дублей (0 — только точные повторы)
+    KB_PASSAGE_MAX_CHARS: int = 700  # Длинные сообщения индексируются фрагментами (~256 токенов MiniLM)
+    KB_PASSAGE_OVERLAP_CHARS: int = 150  # Перекрытие соседних фрагментов
+    KB_SESSION_IDLE_MINUTES: int = 30  # Через сколько минут тишины сессия попадает в индекс сессий
+    KB_SESSION_ROUTING_MIN_VECTORS: int = 5000  # С какого объема поиск идет сначала по сессиям
+    KB_SESSION_CANDIDATES: int = 20  # Сколько ближайших сессий просматривать
+
+    # Векторный индекс: auto, flat, hnsw, ivfpq
+    KB_INDEX_TYPE: str = "auto"
+    KB_HNSW_MIN_VECTORS: int = 20000  # В режиме auto: с какого размера раздела HNSW
+    KB_IVFPQ_MIN_VECTORS: int = 500000  # В режиме auto: с какого размера раздела IVF-PQ
+    KB_HNSW_M: int = 32
+    KB_HNSW_EF_CONSTRUCTION: int = 80
+    KB_HNSW_EF_SEARCH: int = 64  # Больше — выше полнота, медленнее поиск
+    KB_HNSW_COMPACT_RATIO: float = 0.2  # Доля удаленных векторов, после которой HNSW и IVF-PQ перестраиваются
+    KB_IVF_NLIST: int = 0  # 0 — подбирать как 4 * sqrt(N)
+    KB_IVF_NPROBE: int = 16  # Минимум ячеек IVF на запрос; больше — выше полнота, медленнее поиск
+    KB_IVF_NPROBE_FRACTION: float = 0.02  # Доля ячеек IVF на запрос: nprobe растет вместе с nlist
+    KB_IVFPQ_REFINE: str = "sq8"  # Пересчет кандидатов IVF-PQ по точным кодам: none, sq8, fp16, flat
+    KB_IVFPQ_REFINE_K_FACTOR: int = 32  # Во сколько раз больше кандидатов IVF-PQ пересчитывается
+    KB_PQ_M: int = 48  # Число подквантователей, делитель размерности 384
+    KB_PQ_NBITS: int = 8
+    KB_TIME_BUCKET: str = "month"  # Разделы индекса по времени: month, week, none
+
+    # Квантование векторов
+    KB_EMBEDDING_STORAGE: str = "float32"  # Формат векторов в SQLite: float32, float16
+    KB_FLAT_CODEC: str = "float32"  # Векторы Flat-разделов в памяти: float32, fp16, sq8
+    KB_SQ8_RANGE: float = 0.35  # Диапазон компонент для sq8 (компоненты нормированных векторов)
+
     # Лимиты
     MAX_CHAT_HISTORY: int = 10  # Количество сообщений в истории чата
     MAX_CONCURRENT_LLM_REQUESTS: int = 5
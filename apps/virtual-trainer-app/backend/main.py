@@ -14,6 +14,7 @@ from backend.core.config import settings
 from backend.core.database import init_db
 from backend.api.v1.api import api_router
 from backend.core.exceptions import CustomException
+from backend.services.knowledge_base_service import knowledge_base
 
 # Настройка логирования
 logging.getLogger("uvicorn.access").disabled = True
@@ -99,6 +100,7 @@ async def startup_event():
 async def shutdown_event():
     """Действия при остановке приложения"""
     logger.info("Остановка Virtual Trainer Backend")
+    await knowledge_base.close()
 
 
 @app.get("/")
@@ -4,13 +4,22 @@ Stores conversation history with embeddings for semantic search
 """
 
 import json
+import hashlib
+import os
+import re
+import shutil
+import time
+import uuid
 import asyncio
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Optional, Tuple, Union
 from datetime import datetime, timedelta
 from loguru import logger
 import numpy as np
 from pathlib import Path
 import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from backend.core.config import settings
 from backend.core.exceptions import LLMServiceError
 
@@ -41,22 +50,1352 @@ def _get_openai():
     return _openai
 
 
+# Model that produced every embedding written before the model name was tracked
+LEGACY_EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+
+INDEX_TYPES = ('flat', 'hnsw', 'ivfpq')
+
+# On-disk formats of the embedding BLOB column, told apart by BLOB length
+EMBEDDING_STORAGE_DTYPES = {'float32': np.dtype('float32'), 'float16': np.dtype('float16')}
+
+# In-memory vector codecs of Flat partitions
+FLAT_CODECS = ('float32', 'fp16', 'sq8')
+
+# Index partitions are keyed by (user_id, time bucket)
+PartitionKey = Tuple[str, str]
+
+_TOKEN_PATTERN = re.compile(r'\w+')
+_WORD_CHAR = re.compile(r'\w')
+TERM_PREFIX_LENGTH = 3  # Inverted index groups terms by this many leading characters
+
+
+def normalize_text(text: str) -> str:
+    """Lowercased words, ignoring punctuation and spacing; text itself if it has no words"""
+    return ' '.join(_TOKEN_PATTERN.findall(text.lower())) or text
+
+
+def content_hash(text: str) -> int:
+    """Signed 64-bit hash of the normalized text (fits an SQLite INTEGER)"""
+    digest = hashlib.blake2b(normalize_text(text).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def simhash(text: str) -> int:
+    """
+    Signed 64-bit SimHash of the text's words and word pairs
+
+    Each bit is the majority vote of the feature hashes' bits, so texts
+    sharing most of their wording differ in only a few bits.
+    """
+    words = _TOKEN_PATTERN.findall(text.lower())
+    features = words + [f"{first} {second}" for first, second in zip(words, words[1:])] or [text]
+    digests = np.frombuffer(
+        b''.join(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest() for feature in features),
+        dtype=np.uint8
+    ).reshape(-1, 8)
+    votes = np.unpackbits(digests, axis=1).sum(axis=0) * 2 > len(features)
+    return int.from_bytes(np.packbits(votes).tobytes(), 'big', signed=True)
+
+
+def hamming_distance(first: int, second: int) -> int:
+    """Number of differing bits of two 64-bit fingerprints"""
+    return bin((first ^ second) & 0xFFFFFFFFFFFFFFFF).count('1')
+
+
+def simhash_bands(value: int, max_distance: int) -> List[Tuple[int, int]]:
+    """
+    (band, bits) keys of a fingerprint split into max_distance + 1 bands
+
+    Fingerprints within max_distance bits agree on at least one band.
+    """
+    value &= 0xFFFFFFFFFFFFFFFF
+    bands = max_distance + 1
+    edges = [64 * band // bands for band in range(bands + 1)]
+    return [
+        (band, (value >> start) & ((1 << (end - start)) - 1))
+        for band, (start, end) in enumerate(zip(edges, edges[1:]))
+    ]
+
+
+_SENTENCE_END = re.compile(r'(?<=[.!?…])\s+')
+
+
+def split_passages(text: str, max_chars: int, overlap_chars: int) -> List[str]:
+    """
+    Split a long text into passages of at most max_chars characters
+
+    Passages break at line ends, then at sentence ends, then at spaces; each
+    passage repeats the trailing lines or sentences of the previous one, up
+    to overlap_chars characters. Texts within max_chars are one passage.
+    """
+    if len(text) <= max_chars:
+        return [text]
+
+    # (separator before the unit, unit)
+    units: List[Tuple[str, str]] = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        separator = '\n'
+        for sentence in _SENTENCE_END.split(line) if len(line) > max_chars else [line]:
+            while len(sentence) > max_chars:
+                cut = sentence.rfind(' ', 0, max_chars)
+                if cut <= 0:
+                    cut = max_chars
+                units.append((separator, sentence[:cut]))
+                sentence = sentence[cut:].lstrip()
+                separator = ' '
+            if sentence:
+                units.append((separator, sentence))
+            separator = ' '
+
+    def joined(passage_units: List[Tuple[str, str]]) -> str:
+        return ''.join(separator + unit for separator, unit in passage_units)[1:]
+
+    passages = []
+    current: List[Tuple[str, str]] = []
+    for unit in units:
+        if current and len(joined(current + [unit])) > max_chars:
+            passages.append(joined(current))
+            overlap = []
+            for previous in reversed(current):
+                if len(joined([previous] + overlap)) > overlap_chars:
+                    break
+                overlap.insert(0, previous)
+            current = overlap
+            while current and len(joined(current + [unit])) > max_chars:
+                current.pop(0)
+        current.append(unit)
+    if current:
+        passages.append(joined(current))
+    return passages
+
+# Keyword search score multipliers for messages containing these term prefixes
+KEYWORD_BOOSTS = {
+    'регулярн': 2.0,
+    'вод': 1.5,
+    'пить': 1.5,
+    'здоровь': 1.3,
+    'совет': 1.3,
+    'важно': 1.2
+}
+
+# Russian stemmer endings (Snowball), longest first
+_RU_VOWELS = set('аеиоуыэюя')
+_RU_PERFECTIVE_GERUND_1 = ('вшись', 'вши', 'в')
+_RU_PERFECTIVE_GERUND_2 = ('ившись', 'ывшись', 'ивши', 'ывши', 'ив', 'ыв')
+_RU_REFLEXIVE = ('ся', 'сь')
+_RU_ADJECTIVE = (
+    'ими', 'ыми', 'его', 'ого', 'ему', 'ому', 'ее', 'ие', 'ые', 'ое', 'ей', 'ий', 'ый', 'ой',
+    'ем', 'им', 'ым', 'ом', 'их', 'ых', 'ую', 'юю', 'ая', 'яя', 'ою', 'ею'
+)
+_RU_PARTICIPLE_1 = ('ем', 'нн', 'вш', 'ющ', 'щ')
+_RU_PARTICIPLE_2 = ('ивш', 'ывш', 'ующ')
+_RU_VERB_1 = (
+    'ете', 'йте', 'ешь', 'нно', 'ла', 'на', 'ли', 'ем', 'ло', 'но', 'ет', 'ют', 'ны', 'ть', 'й', 'л', 'н'
+)
+_RU_VERB_2 = (
+    'ейте', 'уйте', 'ила', 'ыла', 'ена', 'ите', 'или', 'ыли', 'ило', 'ыло', 'ено', 'ует', 'уют',
+    'ены', 'ить', 'ыть', 'ишь', 'ей', 'уй', 'ил', 'ыл', 'им', 'ым', 'ен', 'ят', 'ит', 'ыт', 'ую', 'ю'
+)
+_RU_NOUN = (
+    'иями', 'ями', 'ами', 'ией', 'иям', 'ием', 'иях', 'ев', 'ов', 'ие', 'ье', 'еи', 'ии', 'ей', 'ой',
+    'ий', 'ям', 'ем', 'ам', 'ом', 'ах', 'ях', 'ию', 'ью', 'ия', 'ья', 'а', 'е', 'и', 'й', 'о', 'у',
+    'ы', 'ь', 'ю', 'я'
+)
+
+
+def _strip_ending(word: str, endings: Tuple[str, ...], preceded_by: str = '') -> Optional[str]:
+    """Remove the first matching ending, optionally requiring а/я before it"""
+    for ending in endings:
+        if word.endswith(ending):
+            stem = word[:-len(ending)]
+            if not preceded_by or (stem and stem[-1] in preceded_by):
+                return stem
+    return None
+
+
+def stem_russian(word: str) -> str:
+    """
+    Light Snowball-style Russian stemmer
+
+    Strips inflectional endings from the part of the word after its first
+    vowel; words without Cyrillic vowels are returned unchanged.
+    """
+    word = word.lower().replace('ё', 'е')
+    for position, char in enumerate(word):
+        if char in _RU_VOWELS:
+            break
+    else:
+        return word
+
+    prefix, rv = word[:position + 1], word[position + 1:]
+
+    stem = _strip_ending(rv, _RU_PERFECTIVE_GERUND_1, 'ая') or _strip_ending(rv, _RU_PERFECTIVE_GERUND_2)
+    if stem is None:
+        rv = _strip_ending(rv, _RU_REFLEXIVE) or rv
+        stem = _strip_ending(rv, _RU_ADJECTIVE)
+        if stem is not None:
+            stem = _strip_ending(stem, _RU_PARTICIPLE_1, 'ая') or _strip_ending(stem, _RU_PARTICIPLE_2) or stem
+        else:
+            stem = (
+                _strip_ending(rv, _RU_VERB_1, 'ая')
+                or _strip_ending(rv, _RU_VERB_2)
+                or _strip_ending(rv, _RU_NOUN)
+            )
+    rv = rv if stem is None else stem
+
+    if rv.endswith('и'):
+        rv = rv[:-1]
+    rv = _strip_ending(rv, ('ейше', 'ейш')) or rv
+    if rv.endswith('нн'):
+        rv = rv[:-1]
+    elif rv.endswith('ь'):
+        rv = rv[:-1]
+
+    return prefix + rv
+
+
+def _ivf_nlist(n_vectors: int) -> int:
+    """Number of IVF cells for a corpus of the given size"""
+    if settings.KB_IVF_NLIST > 0:
+        return settings.KB_IVF_NLIST
+    return max(1, int(4 * np.sqrt(n_vectors)))
+
+
+def _ivf_nprobe(nlist: int) -> int:
+    """IVF cells probed per query: a fixed share of the cells, at least KB_IVF_NPROBE"""
+    return max(1, min(nlist, max(settings.KB_IVF_NPROBE, int(nlist * settings.KB_IVF_NPROBE_FRACTION))))
+
+
+def _ivfpq_min_training_vectors(n_vectors: int) -> int:
+    """Vectors needed to train IVF centroids and PQ codebooks reliably"""
+    return 39 * max(_ivf_nlist(n_vectors), 2 ** settings.KB_PQ_NBITS)
+
+
+def select_index_type(n_vectors: int) -> str:
+    """
+    Pick the index type for a partition of the given size
+
+    In auto mode small partitions stay exact (Flat), mid-sized ones use HNSW
+    and the largest use IVF-PQ. IVF-PQ is only chosen once there is enough data
+    to train it; until then the partition stays Flat.
+    """
+    index_type = settings.KB_INDEX_TYPE.lower()
+
+    if index_type == 'auto':
+        if n_vectors >= settings.KB_IVFPQ_MIN_VECTORS:
+            index_type = 'ivfpq'
+        elif n_vectors >= settings.KB_HNSW_MIN_VECTORS:
+            index_type = 'hnsw'
+        else:
+            index_type = 'flat'
+
+    if index_type not in INDEX_TYPES:
+        logger.warning(f"Unknown KB_INDEX_TYPE '{settings.KB_INDEX_TYPE}', using flat index")
+        return 'flat'
+
+    if index_type == 'ivfpq' and n_vectors < _ivfpq_min_training_vectors(n_vectors):
+        return 'flat'
+
+    return index_type
+
+
+def time_bucket(ts: Optional[float]) -> str:
+    """
+    Time partition of a message timestamp (epoch seconds)
+
+    Buckets of one granularity sort chronologically as strings; undated
+    messages go to the '' bucket, which windowed searches never route to.
+    """
+    if ts is None or np.isnan(ts):
+        return ''
+
+    granularity = settings.KB_TIME_BUCKET.lower()
+    if granularity == 'none':
+        return 'all'
+    moment = datetime.fromtimestamp(ts)
+    if granularity == 'week':
+        return moment.strftime('%G-W%V')
+    return moment.strftime('%Y-%m')
+
+
+def embedding_storage_dtype() -> np.dtype:
+    """dtype embeddings are written to SQLite with (KB_EMBEDDING_STORAGE)"""
+    dtype = EMBEDDING_STORAGE_DTYPES.get(settings.KB_EMBEDDING_STORAGE.lower())
+    if dtype is None:
+        logger.warning(f"Unknown KB_EMBEDDING_STORAGE '{settings.KB_EMBEDDING_STORAGE}', using float32")
+        return EMBEDDING_STORAGE_DTYPES['float32']
+    return dtype
+
+
+def encode_embedding(embedding: np.ndarray) -> bytes:
+    """BLOB of one raw embedding in the configured storage format"""
+    return np.asarray(embedding, dtype=embedding_storage_dtype()).tobytes()
+
+
+def decode_embeddings(blobs: List[bytes], dim: int) -> np.ndarray:
+    """float32 matrix of embedding BLOBs; each may be in any storage format"""
+    embeddings = np.empty((len(blobs), dim), dtype='float32')
+    lengths = np.fromiter(map(len, blobs), dtype='int64', count=len(blobs))
+
+    for dtype in EMBEDDING_STORAGE_DTYPES.values():
+        rows = np.flatnonzero(lengths == dim * dtype.itemsize)
+        if len(rows):
+            embeddings[rows] = np.frombuffer(
+                b''.join(blobs[row] for row in rows), dtype=dtype
+            ).reshape(-1, dim)
+
+    return embeddings
+
+
+def _create_flat_index(dim: int):
+    """Exact-scan index holding vectors in the configured KB_FLAT_CODEC"""
+    faiss = _get_faiss()
+    codec = settings.KB_FLAT_CODEC.lower()
+
+    if codec == 'fp16':
+        return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+
+    if codec == 'sq8':
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit_uniform, faiss.METRIC_INNER_PRODUCT)
+        # Components of unit vectors fall in one known range, so training
+        # needs no data and new partitions are usable immediately
+        limit = settings.KB_SQ8_RANGE
+        index.train(np.array([[-limit] * dim, [limit] * dim], dtype='float32'))
+        return index
+
+    if codec not in FLAT_CODECS:
+        logger.warning(f"Unknown KB_FLAT_CODEC '{settings.KB_FLAT_CODEC}', using float32")
+    return faiss.IndexFlatIP(dim)
+
+
+def _create_refine_index(dim: int):
+    """Codes IVF-PQ candidates are re-scored with, or None for KB_IVFPQ_REFINE = none"""
+    faiss = _get_faiss()
+    codec = settings.KB_IVFPQ_REFINE.lower()
+    if codec == 'none':
+        return None
+    if codec == 'flat':
+        return faiss.IndexFlatIP(dim)
+    if codec == 'fp16':
+        return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+    if codec != 'sq8':
+        logger.warning(f"Unknown KB_IVFPQ_REFINE '{settings.KB_IVFPQ_REFINE}', using sq8")
+    # Per-dimension ranges, trained together with the IVF-PQ index
+    return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+
+
+def create_vector_index(index_type: str, dim: int, n_vectors: int = 0):
+    """
+    Create an empty ID-mapped inner-product FAISS index
+
+    IVF-PQ indexes must be trained before vectors are added; n_vectors sizes
+    the IVF cell count. PQ codes alone rank poorly, so IVF-PQ candidates are
+    re-scored against finer codes (KB_IVFPQ_REFINE). Search-time knobs
+    (efSearch, nprobe, refine k_factor) come from settings.
+    """
+    faiss = _get_faiss()
+
+    if index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(dim, settings.KB_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = settings.KB_HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = settings.KB_HNSW_EF_SEARCH
+    elif index_type == 'ivfpq':
+        quantizer = faiss.IndexFlatIP(dim)
+        nlist = _ivf_nlist(n_vectors)
+        index = faiss.IndexIVFPQ(
+            quantizer, dim, nlist, settings.KB_PQ_M, settings.KB_PQ_NBITS, faiss.METRIC_INNER_PRODUCT
+        )
+        index.nprobe = _ivf_nprobe(nlist)
+        refine = _create_refine_index(dim)
+        if refine is not None:
+            index = faiss.IndexRefine(index, refine)
+            index.k_factor = settings.KB_IVFPQ_REFINE_K_FACTOR
+    else:
+        index = _create_flat_index(dim)
+
+    return faiss.IndexIDMap2(index)
+
+
+# Topic categories detected in message content, in topic-bit order
+FITNESS_TOPIC_KEYWORDS = {
+    'workout': ['workout', 'exercise', 'training', 'тренировка', 'упражнение'],
+    'nutrition': ['nutrition', 'diet', 'food', 'eating', 'питание', 'диета', 'еда'],
+    'muscle_groups': ['chest', 'back', 'legs', 'arms', 'shoulders', 'abs', 'грудь', 'спина', 'ноги', 'руки', 'плечи', 'пресс'],
+    'equipment': ['gym', 'weights', 'dumbbells', 'barbell', 'тренажер', 'штанга', 'гантели'],
+    'goals': ['weight loss', 'muscle gain', 'strength', 'похудение', 'набор массы', 'сила']
+}
+
+
+def _trie_pattern(words: List[str]) -> str:
+    """
+    Regex alternation of the words shaped as a prefix trie
+
+    Shared prefixes are matched once instead of once per word, and at each
+    position the longest word wins.
+    """
+    root: Dict[str, Any] = {}
+    for word in words:
+        node = root
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def emit(node: Dict[str, Any]) -> str:
+        branches = [re.escape(char) + emit(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return f'(?:{body})?' if '' in node else body
+
+    return emit(root)
+
+
+class KeywordMatcher:
+    """
+    Multi-pattern matcher compiled once from the topic and boost keyword tables
+
+    Every keyword goes into one trie-shaped regex scanned with a lookahead,
+    so one pass over the text finds all keyword occurrences, overlapping ones
+    included. Topic keywords match anywhere in the text (substring), boost
+    words only at the start of a word (term prefix).
+    """
+
+    def __init__(self, topics: Dict[str, List[str]], boosts: Dict[str, float]):
+        self._topics = list(topics)
+        self._boosts = boosts
+
+        labels = [(keyword, ('topic', topic)) for topic, keywords in topics.items() for keyword in keywords]
+        labels += [(word, ('boost', word)) for word in boosts]
+        keywords = {keyword for keyword, _ in labels}
+
+        # The regex reports the longest keyword at a position; keywords that
+        # are its prefixes match there as well
+        self._labels: Dict[str, List[Tuple[str, str]]] = {
+            keyword: [label for other, label in labels if keyword.startswith(other)]
+            for keyword in keywords
+        }
+        self._pattern = re.compile(f'(?=({_trie_pattern(sorted(keywords))}))')
+
+    def scan(self, text: str) -> Tuple[List[str], float]:
+        """Topics found in lowercased text, in table order, and its combined boost factor"""
+        topics = set()
+        boosted = set()
+        for match in self._pattern.finditer(text):
+            start = match.start()
+            at_word_start = start == 0 or not _WORD_CHAR.match(text, start - 1)
+            for kind, value in self._labels[match.group(1)]:
+                if kind == 'topic':
+                    topics.add(value)
+                elif at_word_start:
+                    boosted.add(value)
+
+        factor = 1.0
+        for word, boost in self._boosts.items():
+            if word in boosted:
+                factor *= boost
+        return [topic for topic in self._topics if topic in topics], factor
+
+
+KEYWORD_MATCHER = KeywordMatcher(FITNESS_TOPIC_KEYWORDS, KEYWORD_BOOSTS)
+
+# Topics with a fixed bit in the stored topic_mask column, in bit order.
+# Rows with any topic outside the vocabulary also get OTHER_TOPICS_BIT
+TOPIC_VOCABULARY = list(FITNESS_TOPIC_KEYWORDS) + ['general']
+OTHER_TOPICS_BIT = 62
+
+
+def topic_bitmask(topics: Optional[List[str]], vocabulary_only: bool = False) -> int:
+    """Bitmask of topics over TOPIC_VOCABULARY (fits an SQLite INTEGER)"""
+    mask = 0
+    for topic in topics or []:
+        if topic in TOPIC_VOCABULARY:
+            mask |= 1 << TOPIC_VOCABULARY.index(topic)
+        elif not vocabulary_only:
+            mask |= 1 << OTHER_TOPICS_BIT
+    return mask
+
+
+def topics_for_bitmask(mask: int) -> List[str]:
+    """Vocabulary topics of a bitmask"""
+    return [topic for bit, topic in enumerate(TOPIC_VOCABULARY) if mask >> bit & 1]
+
+
+# Stems of each topic keyword's words, so inflected forms name the topic too
+_TOPIC_KEYWORD_STEMS = {
+    topic: [{stem_russian(word) for word in keyword.split()} for keyword in keywords]
+    for topic, keywords in FITNESS_TOPIC_KEYWORDS.items()
+}
+
+
+def query_topics(text: str) -> List[str]:
+    """Vocabulary topics a free-text topic refers to, by name or by keyword in any inflection"""
+    text = text.lower().strip()
+    if text in TOPIC_VOCABULARY:
+        return [text]
+    topics, _ = KEYWORD_MATCHER.scan(text)
+    stems = {stem_russian(word) for word in _TOKEN_PATTERN.findall(text)}
+    return [
+        topic for topic, keyword_stems in _TOPIC_KEYWORD_STEMS.items()
+        if topic in topics or any(keyword <= stems for keyword in keyword_stems)
+    ]
+
+
+class SortedIdArray:
+    """
+    Growable sorted int64 array of conversation ids
+
+    Ids mostly arrive in ascending order, so adds append into spare capacity
+    (doubling when full); out-of-order ids are merged in.
+    """
+
+    __slots__ = ('_values', '_size')
+
+    # Python objects behind one array: the holder, the ndarray header and a dict entry
+    OVERHEAD_BYTES = 256
+
+    def __init__(self):
+        self._values = np.empty(0, dtype='int64')
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def ids(self) -> np.ndarray:
+        """The ids in order (a view, valid until the next change)"""
+        return self._values[:self._size]
+
+    @property
+    def nbytes(self) -> int:
+        return self._values.nbytes + self.OVERHEAD_BYTES
+
+    def add(self, ids: np.ndarray):
+        """Add sorted ids not stored yet"""
+        values, start = self._values, self._size
+        if start and ids[0] <= values[start - 1]:
+            self._values = np.union1d(values[:start], ids)
+            self._size = len(self._values)
+            return
+        size = start + len(ids)
+        if size > len(values):
+            grown = self._values = np.empty(max(size, 2 * len(values)), dtype='int64')
+            grown[:start] = values[:start]
+            values = grown
+        values[start:size] = ids
+        self._size = size
+
+    def discard(self, ids: np.ndarray):
+        """Remove ids, releasing the spare capacity once most of it is unused"""
+        kept = self.ids[~np.isin(self.ids, ids)]
+        self._size = len(kept)
+        if self._size < len(self._values) // 4:
+            self._values = kept.copy()
+        else:
+            self._values[:self._size] = kept
+
+
+class ConversationMetadataStore:
+    """
+    Columnar in-memory metadata of indexed conversations
+
+    One row per message, kept sorted by conversation id. Users, sessions and
+    topics are interned into integer codes and a topic bitmask, timestamps are
+    epoch seconds, so user and time-window filters run as vectorized masks.
+    Per-user sorted id arrays (by user, by session and by topic) are kept up to
+    date on append and remove, so per-user lookups don't scan the other
+    tenants' rows.
+    Removed rows are tombstoned in the live column and compacted in bulk once
+    they make up a quarter of the rows.
+    Message text is not held here; it is read from SQLite by id when needed.
+    """
+
+    MAX_TOPICS = 64
+    _COLUMNS = (
+        'ids', 'user_codes', 'session_codes', 'timestamps', 'importance', 'topic_masks', 'content_hashes', 'simhashes'
+    )
+    # Snapshots are compacted, so the live flags aren't persisted
+    _ROW_ARRAYS = _COLUMNS + ('live',)
+    COMPACT_MIN_ROWS = 1024
+
+    def __init__(self, capacity: int = 1024):
+        self._size = 0
+        self._dead = 0
+        self._users: List[str] = []
+        self._user_codes: Dict[str, int] = {}
+        self._sessions: List[str] = []
+        self._session_codes: Dict[str, int] = {}
+        self._topics: List[str] = []
+        self._topic_bits: Dict[str, int] = {}
+        # Vocabulary topics get the same bits as the stored topic_mask column
+        for topic in TOPIC_VOCABULARY:
+            self._intern_topic(topic)
+
+        self.ids = np.empty(capacity, dtype='int64')
+        self.user_codes = np.empty(capacity, dtype='int32')
+        self.session_codes = np.empty(capacity, dtype='int32')
+        self.timestamps = np.empty(capacity, dtype='float64')
+        self.importance = np.empty(capacity, dtype='float32')
+        self.topic_masks = np.empty(capacity, dtype='uint64')
+        self.content_hashes = np.empty(capacity, dtype='int64')
+        self.simhashes = np.empty(capacity, dtype='int64')
+        self.live = np.empty(capacity, dtype=bool)
+
+        # user code -> ids, user code -> session codes, (user, session code) -> ids,
+        # (user, topic bit) -> ids
+        self._user_rows: Dict[int, SortedIdArray] = {}
+        self._user_sessions: Dict[int, set] = {}
+        self._session_rows: Dict[Tuple[int, int], SortedIdArray] = {}
+        self._topic_rows: Dict[Tuple[int, int], SortedIdArray] = {}
+
+    def __len__(self) -> int:
+        return self._size - self._dead
+
+    def live_ids(self) -> np.ndarray:
+        """Ids of the stored rows, in order"""
+        ids = self.ids[:self._size]
+        return ids[self.live[:self._size]] if self._dead else ids
+
+    @property
+    def row_bytes(self) -> int:
+        """Memory held per stored row: allocated columns and per-user id arrays over the live rows"""
+        if not len(self):
+            return sum(getattr(self, column).itemsize for column in self._ROW_ARRAYS)
+        total = sum(getattr(self, column).nbytes for column in self._ROW_ARRAYS) + sum(
+            rows.nbytes for table in (self._user_rows, self._session_rows, self._topic_rows) for rows in table.values()
+        )
+        return -(-total // len(self))
+
+    def user_bytes(self, user_id: str) -> int:
+        """Memory held by one user's rows: their column cells and per-user id arrays"""
+        code = self.user_code(user_id)
+        rows = self._user_rows.get(code)
+        if rows is None:
+            return 0
+        cells = len(rows) * sum(getattr(self, column).itemsize for column in self._ROW_ARRAYS)
+        return cells + rows.nbytes + sum(
+            self._session_rows[(code, session)].nbytes for session in self._user_sessions[code]
+        ) + sum(self._topic_rows[(code, bit)].nbytes for bit in range(self.MAX_TOPICS) if (code, bit) in self._topic_rows)
+
+    def _intern_topic(self, topic: str) -> Optional[int]:
+        bit = self._topic_bits.get(topic)
+        if bit is None and len(self._topics) < self.MAX_TOPICS:
+            bit = self._topic_bits[topic] = len(self._topics)
+            self._topics.append(topic)
+        return bit
+
+    def topic_mask(self, topics: List[str]) -> int:
+        """Bitmask of the given topics; topics beyond MAX_TOPICS are dropped"""
+        mask = 0
+        for topic in topics or []:
+            bit = self._intern_topic(topic)
+            if bit is not None:
+                mask |= 1 << bit
+        return mask
+
+    def topics_for_mask(self, mask: int) -> List[str]:
+        return [topic for bit, topic in enumerate(self._topics) if mask >> bit & 1]
+
+    def user_code(self, user_id: str) -> Optional[int]:
+        return self._user_codes.get(user_id)
+
+    def _code(self, value: str, values: List[str], codes: Dict[str, int]) -> int:
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(values)
+            values.append(value)
+        return code
+
+    @staticmethod
+    def _mask_bits(mask: int) -> List[int]:
+        bits = []
+        while mask:
+            bit = (mask & -mask).bit_length() - 1
+            bits.append(bit)
+            mask &= mask - 1
+        return bits
+
+    @staticmethod
+    def _runs(ids: np.ndarray, *keys: np.ndarray) -> List[Tuple[Tuple[int, ...], np.ndarray]]:
+        """(key values, ids) of each run of equal keys in rows sorted by those keys"""
+        if not len(ids):
+            return []
+        change = np.zeros(len(ids) - 1, dtype=bool)
+        for key in keys:
+            change |= key[1:] != key[:-1]
+        starts = np.flatnonzero(change) + 1
+        bounds = [0] + starts.tolist() + [len(ids)]
+        heads = zip(*(key[bounds[:-1]].tolist() for key in keys))
+        return [(head, ids[start:end]) for head, start, end in zip(heads, bounds, bounds[1:])]
+
+    def _grouped_ids(self, ids: np.ndarray, user_codes: np.ndarray, session_codes: np.ndarray,
+                     topic_masks: np.ndarray):
+        """
+        Sorted ids of the rows per user, per (user, session) and per (user, topic bit)
+
+        Rows are grouped by sorting, so the cost follows the number of rows
+        and groups rather than users times rows.
+        """
+        order = np.lexsort((ids, user_codes))
+        by_user = ids[order], user_codes[order], topic_masks[order]
+        users = self._runs(by_user[0], by_user[1])
+
+        order = np.lexsort((ids, session_codes, user_codes))
+        sessions = self._runs(ids[order], user_codes[order], session_codes[order])
+
+        topics = []
+        for bit in self._mask_bits(int(np.bitwise_or.reduce(topic_masks))):
+            tagged = (by_user[2] >> np.uint64(bit)) & np.uint64(1) == 1
+            topics.extend(((user, bit), topic_ids) for (user,), topic_ids in self._runs(
+                by_user[0][tagged], by_user[1][tagged]
+            ))
+        return [(user, user_ids) for (user,), user_ids in users], sessions, topics
+
+    def _index_rows(self, ids: np.ndarray, user_codes: np.ndarray, session_codes: np.ndarray,
+                    topic_masks: np.ndarray):
+        """Add rows to the per-user id arrays"""
+        users, sessions, topics = self._grouped_ids(ids, user_codes, session_codes, topic_masks)
+        for table, groups in ((self._user_rows, users), (self._session_rows, sessions), (self._topic_rows, topics)):
+            for key, added_ids in groups:
+                rows = table.get(key)
+                if rows is None:
+                    rows = table[key] = SortedIdArray()
+                rows.add(added_ids)
+        for (user, session), _ in sessions:
+            self._user_sessions.setdefault(user, set()).add(session)
+
+    def _unindex_rows(self, ids: np.ndarray, user_codes: np.ndarray, session_codes: np.ndarray,
+                      topic_masks: np.ndarray):
+        """Drop rows from the per-user id arrays, forgetting emptied users, sessions and topics"""
+        users, sessions, topics = self._grouped_ids(ids, user_codes, session_codes, topic_masks)
+        for table, groups in ((self._user_rows, users), (self._session_rows, sessions), (self._topic_rows, topics)):
+            for key, removed_ids in groups:
+                rows = table[key]
+                rows.discard(removed_ids)
+                if not len(rows):
+                    del table[key]
+        for (user, session), _ in sessions:
+            if (user, session) not in self._session_rows:
+                self._user_sessions[user].discard(session)
+                if not self._user_sessions[user]:
+                    del self._user_sessions[user]
+
+    def append(self, rows: List[Dict[str, Any]]):
+        """Add rows (id, user_id, session_id, ts, topics, importance_score, content_hash, simhash)"""
+        if not rows:
+            return
+
+        new = {
+            'ids': np.array([row['id'] for row in rows], dtype='int64'),
+            'user_codes': np.array(
+                [self._code(row['user_id'], self._users, self._user_codes) for row in rows], dtype='int32'
+            ),
+            'session_codes': np.array(
+                [self._code(row['session_id'], self._sessions, self._session_codes) for row in rows], dtype='int32'
+            ),
+            'timestamps': np.array([row['ts'] for row in rows], dtype='float64'),
+            'importance': np.array([row['importance_score'] for row in rows], dtype='float32'),
+            'topic_masks': np.array([self.topic_mask(row['topics']) for row in rows], dtype='uint64'),
+            'content_hashes': np.array([row['content_hash'] for row in rows], dtype='int64'),
+            'simhashes': np.array([row['simhash'] for row in rows], dtype='int64'),
+            'live': np.ones(len(rows), dtype=bool),
+        }
+
+        # A re-added id must not sit next to its own tombstone
+        if self._dead and self._size:
+            at = np.minimum(np.searchsorted(self.ids[:self._size], new['ids']), self._size - 1)
+            if np.any((self.ids[at] == new['ids']) & ~self.live[at]):
+                self.compact()
+
+        size = self._size + len(rows)
+        if size > len(self.ids):
+            capacity = max(size, 2 * len(self.ids))
+            for column in self._ROW_ARRAYS:
+                grown = np.empty(capacity, dtype=getattr(self, column).dtype)
+                grown[:self._size] = getattr(self, column)[:self._size]
+                setattr(self, column, grown)
+
+        for column in self._ROW_ARRAYS:
+            getattr(self, column)[self._size:size] = new[column]
+        self._index_rows(new['ids'], new['user_codes'], new['session_codes'], new['topic_masks'])
+
+        # Re-embedded rows can arrive with older ids; restore id order
+        out_of_order = self._size > 0 and new['ids'].min() < self.ids[self._size - 1]
+        self._size = size
+        if out_of_order or np.any(np.diff(new['ids']) < 0):
+            order = np.argsort(self.ids[:size], kind='stable')
+            for column in self._ROW_ARRAYS:
+                getattr(self, column)[:size] = getattr(self, column)[:size][order]
+
+    def positions(self, conversation_ids: np.ndarray) -> np.ndarray:
+        """Row positions of the given ids, -1 where an id is not stored"""
+        conversation_ids = np.asarray(conversation_ids, dtype='int64')
+        positions = np.searchsorted(self.ids[:self._size], conversation_ids)
+        positions = np.minimum(positions, max(self._size - 1, 0))
+        found = (self._size > 0) & (self.ids[positions] == conversation_ids) & self.live[positions]
+        return np.where(found, positions, -1)
+
+    def remove(self, conversation_ids: np.ndarray) -> int:
+        """Tombstone rows by id, compacting once enough are dead; returns the number of rows removed"""
+        positions = self.positions(conversation_ids)
+        positions = np.unique(positions[positions >= 0])
+        if len(positions) == 0:
+            return 0
+
+        self._unindex_rows(
+            self.ids[positions], self.user_codes[positions], self.session_codes[positions], self.topic_masks[positions]
+        )
+        self.live[positions] = False
+        self._dead += len(positions)
+        if self._dead > max(self.COMPACT_MIN_ROWS, self._size // 4):
+            self.compact()
+        return len(positions)
+
+    def compact(self):
+        """Drop tombstoned rows, keeping id order"""
+        if not self._dead:
+            return
+        keep = self.live[:self._size].copy()
+        size = self._size - self._dead
+        for column in self._ROW_ARRAYS:
+            values = getattr(self, column)
+            values[:size] = values[:self._size][keep]
+        self._size = size
+        self._dead = 0
+
+    def snapshot(self) -> Tuple[Dict[str, np.ndarray], Dict[str, List[str]]]:
+        """Copies of the columns and the interned value lists"""
+        self.compact()
+        columns = {column: getattr(self, column)[:self._size].copy() for column in self._COLUMNS}
+        return columns, {'users': list(self._users), 'sessions': list(self._sessions), 'topics': list(self._topics)}
+
+    @classmethod
+    def from_snapshot(cls, columns: Dict[str, np.ndarray], values: Dict[str, List[str]]) -> 'ConversationMetadataStore':
+        """Rebuild a store from the output of snapshot()"""
+        store = cls(capacity=max(len(columns['ids']), 1024))
+        for user_id in values['users']:
+            store._code(user_id, store._users, store._user_codes)
+        for session_id in values['sessions']:
+            store._code(session_id, store._sessions, store._session_codes)
+        for topic in values['topics']:
+            store._intern_topic(topic)
+
+        store._size = len(columns['ids'])
+        for column in cls._COLUMNS:
+            getattr(store, column)[:store._size] = columns[column]
+        store.live[:store._size] = True
+        store._index_rows(columns['ids'], columns['user_codes'], columns['session_codes'], columns['topic_masks'])
+        return store
+
+    def user_ids(self, user_id: str) -> np.ndarray:
+        """Conversation ids of one user's rows"""
+        rows = self._user_rows.get(self.user_code(user_id))
+        return rows.ids.copy() if rows is not None else np.empty(0, dtype='int64')
+
+    def topic_ids(self, user_id: str, mask: int) -> np.ndarray:
+        """Conversation ids of one user's rows tagged with any topic of the bitmask"""
+        code = self.user_code(user_id)
+        tagged = [self._topic_rows[(code, bit)].ids for bit in self._mask_bits(mask) if (code, bit) in self._topic_rows]
+        if len(tagged) == 1:
+            return tagged[0].copy()
+        # A row may carry several of the topics
+        return np.unique(np.concatenate(tagged)) if tagged else np.empty(0, dtype='int64')
+
+    def session_ids(self, user_id: str, sessions: List[str], known_sessions: List[str]) -> np.ndarray:
+        """Conversation ids of one user's rows in the given sessions or in sessions outside known_sessions"""
+        code = self.user_code(user_id)
+        user_sessions = self._user_sessions.get(code, set())
+        codes = lambda names: {self._session_codes[name] for name in names if name in self._session_codes}
+        wanted = (user_sessions & codes(sessions)) | (user_sessions - codes(known_sessions))
+        # Sessions don't share rows
+        ids = [self._session_rows[(code, session)].ids for session in wanted]
+        return np.sort(np.concatenate(ids)) if ids else np.empty(0, dtype='int64')
+
+    def content_ids(self, user_id: str) -> Dict[int, int]:
+        """Content hash -> conversation id of one user's rows"""
+        ids = self.user_ids(user_id)
+        rows = self.positions(ids)
+        return dict(zip(self.content_hashes[rows].tolist(), ids.tolist()))
+
+    def simhashes_of(self, user_id: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Conversation ids and SimHash fingerprints of one user's rows"""
+        ids = self.user_ids(user_id)
+        return ids, self.simhashes[self.positions(ids)]
+
+    def describe(self, position: int) -> Dict[str, Any]:
+        """Metadata of one row in the shape used by search results"""
+        return {
+            'id': int(self.ids[position]),
+            'user_id': self._users[self.user_codes[position]],
+            'session_id': self._sessions[self.session_codes[position]],
+            'topics': self.topics_for_mask(int(self.topic_masks[position])),
+            'importance_score': float(self.importance[position])
+        }
+
+
+class BatchedEncoder:
+    """
+    Micro-batching embedding worker
+
+    Callers await encode(); texts queued within max_wait_ms of each other are
+    encoded together (up to max_batch_size) on a dedicated thread, so the
+    transformer forward pass never runs on the event loop.
+    """
+
+    def __init__(self, encode_fn, max_batch_size: int, max_wait_ms: float):
+        self._encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="kb-encoder")
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.batches_encoded = 0
+        self.texts_encoded = 0
+
+    def _ensure_worker(self):
+        loop = asyncio.get_running_loop()
+        # The worker is bound to the loop it was started on (asyncio.run creates new ones)
+        if self._loop is not loop or self._worker is None or self._worker.done():
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+
+    async def encode(self, texts: List[str]) -> np.ndarray:
+        """Raw embeddings for texts, encoded together with other pending requests"""
+        self._ensure_worker()
+        future = self._loop.create_future()
+        self._queue.put_nowait((texts, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        queue = self._queue
+
+        while True:
+            batch = [await queue.get()]
+            pending = len(batch[0][0])
+            deadline = loop.time() + self.max_wait
+
+            while pending < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                pending += len(item[0])
+
+            texts = [text for item_texts, _ in batch for text in item_texts]
+            try:
+                embeddings = await loop.run_in_executor(self._executor, self._encode_fn, texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches_encoded += 1
+            self.texts_encoded += len(texts)
+
+            offset = 0
+            for item_texts, future in batch:
+                if not future.done():
+                    future.set_result(embeddings[offset:offset + len(item_texts)])
+                offset += len(item_texts)
+
+    async def close(self):
+        """Stop the worker and release the encoder thread"""
+        if self._worker is not None and not self._worker.done():
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        self._worker = None
+        self._executor.shutdown(wait=False)
+
+
+class QueryEmbeddingCache:
+    """
+    LRU cache of normalized query vectors with a time-to-live
+
+    Tool calls repeat the same short queries within a session; a hit skips
+    the transformer pass entirely.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: 'OrderedDict[str, Tuple[float, np.ndarray]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl_seconds:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        if entry is not None:
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key: str, vector: np.ndarray):
+        if self.max_size <= 0:
+            return
+        vector.flags.writeable = False  # shared by every hit
+        self._entries[key] = (time.monotonic(), vector)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+
+class UserResidency:
+    """
+    LRU accounting of the users whose vectors and metadata are in memory
+
+    Under a byte budget the least recently active users are evicted once the
+    estimated footprint exceeds it, and paged back in on their next access.
+    A budget of 0 keeps every user resident and turns accounting off.
+    """
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self._users: 'OrderedDict[str, int]' = OrderedDict()
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget_bytes > 0
+
+    def __contains__(self, user_id: str) -> bool:
+        return not self.enabled or user_id in self._users
+
+    def touch(self, user_id: str) -> bool:
+        """Record an access; returns whether the user is resident"""
+        if not self.enabled:
+            return True
+        if user_id in self._users:
+            self._users.move_to_end(user_id)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def admit(self, user_id: str, size_bytes: int):
+        """Set a user's resident footprint and mark them most recently used"""
+        if not self.enabled:
+            return
+        self.resident_bytes += size_bytes - self._users.get(user_id, 0)
+        self._users[user_id] = size_bytes
+        self._users.move_to_end(user_id)
+
+    def discard(self, user_id: str, evicted: bool = False):
+        self.resident_bytes -= self._users.pop(user_id, 0)
+        if evicted:
+            self.evictions += 1
+
+    def over_budget(self) -> List[str]:
+        """Least recently used users to evict to get back under the budget"""
+        victims = []
+        excess = self.resident_bytes - self.budget_bytes
+        # The most recently used user stays even if it alone exceeds the budget
+        for user_id, size_bytes in list(self._users.items())[:-1]:
+            if not self.enabled or excess <= 0:
+                break
+            victims.append(user_id)
+            excess -= size_bytes
+        return victims
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'resident_users': len(self._users),
+            'resident_bytes': self.resident_bytes,
+            'budget_bytes': self.budget_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions
+        }
+
+
+class SessionSummaryIndex:
+    """
+    Per-user centroids of idle sessions, the coarse level of long-range search
+
+    A session's centroid is the mean of its messages' normalized vectors; the
+    message count and last conversation id it covers let it be extended when
+    the session gets new messages. Queries pick the sessions with the most
+    similar centroids and then search only their messages.
+    """
+
+    def __init__(self):
+        # user -> session -> (centroid, message count, last conversation id)
+        self._summaries: Dict[str, Dict[str, Tuple[np.ndarray, int, int]]] = {}
+        # user -> (sessions, normalized centroid matrix), rebuilt after changes
+        self._matrices: Dict[str, Tuple[List[str], np.ndarray]] = {}
+
+    def __len__(self) -> int:
+        return sum(len(sessions) for sessions in self._summaries.values())
+
+    def get(self, user_id: str, session_id: str) -> Optional[Tuple[np.ndarray, int, int]]:
+        return self._summaries.get(user_id, {}).get(session_id)
+
+    def put(self, user_id: str, session_id: str, centroid: np.ndarray, message_count: int, last_id: int):
+        self._summaries.setdefault(user_id, {})[session_id] = (centroid, message_count, last_id)
+        self._matrices.pop(user_id, None)
+
+    def discard(self, user_id: str, session_id: str):
+        sessions = self._summaries.get(user_id, {})
+        if sessions.pop(session_id, None) is not None:
+            self._matrices.pop(user_id, None)
+        if not sessions:
+            self._summaries.pop(user_id, None)
+
+    def sessions(self, user_id: str) -> List[str]:
+        """The user's summarized sessions"""
+        return list(self._summaries.get(user_id, {}))
+
+    def candidates(self, user_id: str, query_embeddings: np.ndarray, n: int) -> List[List[str]]:
+        """Per query, the n sessions of the user with the most similar centroids"""
+        if user_id not in self._matrices:
+            sessions = self.sessions(user_id)
+            centroids = np.stack([self._summaries[user_id][session][0] for session in sessions]).astype('float32')
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+            self._matrices[user_id] = (sessions, centroids)
+
+        sessions, centroids = self._matrices[user_id]
+        scores = query_embeddings @ centroids.T
+        n = min(n, len(sessions))
+        top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+        return [[sessions[column] for column in row] for row in top]
+
+
+class ConversationDatabase:
+    """
+    Connection manager for the conversation SQLite database
+
+    Connections are opened once in WAL mode, so reads do not wait for a
+    write to commit. All writes go through a single connection on a
+    dedicated thread; reads use a per-thread connection on a small reader
+    pool. Each connection keeps its own prepared statement cache.
+    """
+
+    def __init__(self, db_path: Path, readers: int = 4):
+        self.db_path = db_path
+        self.readers = readers
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writer: Optional[sqlite3.Connection] = None
+        self._connections: List[sqlite3.Connection] = []
+        self._write_executor: Optional[ThreadPoolExecutor] = None
+        self._read_executor: Optional[ThreadPoolExecutor] = None
+
+    def _connect(self, read_only: bool) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=30,
+            check_same_thread=False,  # closed from the event loop thread
+            cached_statements=settings.KB_SQLITE_CACHED_STATEMENTS
+        )
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA mmap_size={int(settings.KB_SQLITE_MMAP_SIZE)}")
+        if read_only:
+            conn.execute("PRAGMA query_only=ON")
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def _writer_connection(self) -> sqlite3.Connection:
+        with self._lock:
+            writer = self._writer
+        if writer is None:
+            writer = self._connect(read_only=False)
+            # Persistent in the database file; readers opened later inherit it
+            writer.execute("PRAGMA journal_mode=WAL")
+            with self._lock:
+                if self._writer is None:
+                    self._writer = writer
+                writer = self._writer
+        return writer
+
+    def reader(self) -> sqlite3.Connection:
+        """Read-only connection owned by the calling thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            self._writer_connection()  # switches the file to WAL before the first read
+            conn = self._local.conn = self._connect(read_only=True)
+        return conn
+
+    def _run_read(self, fn, args):
+        return fn(self.reader(), *args)
+
+    def _run_write(self, fn, args):
+        conn = self._writer_connection()
+        with conn:  # one transaction, rolled back on error
+            return fn(conn, *args)
+
+    async def read(self, fn, *args):
+        """Run fn(connection, *args) on the reader pool"""
+        if self._read_executor is None:
+            self._read_executor = ThreadPoolExecutor(
+                max_workers=self.readers, thread_name_prefix="kb-sqlite-reader"
+            )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_executor, self._run_read, fn, args)
+
+    async def write(self, fn, *args):
+        """Run fn(connection, *args) in a transaction on the writer thread"""
+        if self._write_executor is None:
+            self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="kb-sqlite-writer")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._write_executor, self._run_write, fn, args)
+
+    async def fetchall(self, sql: str, params=()) -> List[Tuple]:
+        """Rows of a single read query"""
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    def close(self):
+        """Finish pending operations and close every connection"""
+        for executor in (self._write_executor, self._read_executor):
+            if executor is not None:
+                executor.shutdown(wait=True)
+        self._write_executor = None
+        self._read_executor = None
+
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._writer = None
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+
 class ConversationKnowledgeBase:
     """
     RAG-based knowledge base for conversation history
     Uses embeddings and FAISS for semantic search
     """
-    
-    def __init__(self):
-        self.db_path = Path("conversation_kb.db")
+
+    def __init__(self, db_path: Optional[str] = None):
+        self.db_path = Path(db_path or "conversation_kb.db")
+        # Write-behind journal of messages not yet committed to the database
+        self.ingest_log_path = Path(f"{self.db_path}-ingest.jsonl")
+        self._db = ConversationDatabase(self.db_path, readers=settings.KB_SQLITE_READERS)
+        # Generations of persisted indexes; CURRENT names the latest complete one
+        self.snapshot_dir = Path(f"{self.db_path}-snapshot")
+        self._snapshot_task: Optional[asyncio.Task] = None
+        self._changes_since_snapshot = 0
         self.embeddings_model = None
-        self.faiss_index = None
-        self.conversation_texts = []
-        self.conversation_metadata = []
+        self.embedding_model_name = settings.KB_EMBEDDING_MODEL
+        # One ID-mapped index per user and time bucket (user -> bucket -> index),
+        # so windowed searches skip older history; FAISS ids are conversation row ids
+        self.user_indexes: Dict[str, Dict[str, Any]] = {}
+        self.metadata_store = ConversationMetadataStore()
+        self._index_types: Dict[PartitionKey, str] = {}
+        self._index_rebuilds: Dict[PartitionKey, asyncio.Task] = {}
+        self._rebuild_buffers: Dict[PartitionKey, List[Tuple[np.ndarray, np.ndarray]]] = {}
+        self._rebuild_removals: Dict[PartitionKey, List[np.ndarray]] = {}
+        # Deleted vectors still held by HNSW and IVF-PQ partitions, which cannot remove ids
+        self._tombstones: Dict[PartitionKey, int] = {}
+        # Flat partitions still viewing their memory-mapped snapshot file; they
+        # are copied into memory on their first write
+        self._mapped_partitions: set = set()
+        # Per user: content hash -> the one conversation id holding its vector.
+        # Built lazily from the metadata store on the user's first write
+        self._content_ids: Dict[str, Dict[int, int]] = {}
+        # Per user: SimHash band -> {conversation id: fingerprint} of indexed
+        # rows, to find near-duplicates; built lazily like _content_ids
+        self._simhash_bands: Dict[str, Dict[Tuple[int, int], Dict[int, int]]] = {}
+        # Ids of metadata rows whose vector went to a newer (near-)duplicate;
+        # snapshotted, since removing such a row must not touch any vector
+        self._superseded: set = set()
+        self._index_locks: Dict[PartitionKey, threading.Lock] = {}
+        # Inverted index partitioned by user: term -> conversation ids, plus
+        # term prefix -> terms so prefix (stem) lookups skip the vocabulary scan
+        self._postings: Dict[str, Dict[str, List[int]]] = {}
+        self._term_prefixes: Dict[str, Dict[str, set]] = {}
+        # With FTS5 available lexical search runs inside SQLite and the
+        # in-memory inverted index above is not built
+        self._fts_enabled = False
         self.embedding_dim = 384  # all-MiniLM-L6-v2 dimension
         self._initialized = False
         self._initialization_lock = asyncio.Lock()
+        self._reembed_task: Optional[asyncio.Task] = None
+        self._storage_migration_task: Optional[asyncio.Task] = None
+        self._encoder = BatchedEncoder(
+            self._encode_texts,
+            max_batch_size=settings.KB_ENCODER_MAX_BATCH_SIZE,
+            max_wait_ms=settings.KB_ENCODER_MAX_WAIT_MS
+        )
+        self.query_cache = QueryEmbeddingCache(
+            max_size=settings.KB_QUERY_CACHE_SIZE,
+            ttl_seconds=settings.KB_QUERY_CACHE_TTL_SECONDS
+        )
+        # Which users are held in memory; the others live only in SQLite
+        self.residency = UserResidency(settings.KB_MEMORY_BUDGET_MB * 2 ** 20)
+        self._page_ins: Dict[str, asyncio.Task] = {}
+        # Evicted users are only loaded again by an explicit page-in
+        self._evicted_users: set = set()
+        self._ingest_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._ingest_queue: Optional[asyncio.Queue] = None
+        self._ingest_worker: Optional[asyncio.Task] = None
+        # Batch the worker is ingesting; kept if the worker stops mid-batch
+        self._ingest_inflight: List[Dict[str, Any]] = []
+        self._ingest_pending = 0
+        # Messages that failed every retry; kept in the journal for the next startup
+        self._ingest_failed: List[Dict[str, Any]] = []
+        # Queued messages per user and searches waiting for them to be indexed
+        self._user_ingest_pending: Dict[str, int] = {}
+        self._indexed_waiters: Dict[str, List[asyncio.Future]] = {}
+        # Centroids of idle sessions; sessions with messages not yet summarized
+        # (user, session -> last activity, epoch seconds) are always searched
+        self.session_summaries = SessionSummaryIndex()
+        self._open_sessions: Dict[Tuple[str, str], float] = {}
+        self._sessions_caught_up = False
+        self._session_task: Optional[asyncio.Task] = None
+        # Bumped whenever a user's stored conversations may have changed
+        # (per user on writes, for everyone on cleanup); keys result caches
+        self._user_versions: Dict[str, int] = {}
+        self._data_epoch = 0
     
+    @property
+    def total_vectors(self) -> int:
+        """Number of live vectors across all partitions"""
+        return sum(index.ntotal for _, index in self._partitions()) - sum(self._tombstones.values())
+
+    @property
+    def total_conversations(self) -> int:
+        """Number of conversations held in the in-memory metadata store"""
+        return len(self.metadata_store)
+
+    def data_version(self, user_id: str) -> Tuple[int, int]:
+        """Version of the user's indexed conversations; changes with every write that can alter results"""
+        return self._data_epoch, self._user_versions.get(user_id, 0)
+
+    def _bump_data_version(self, user_id: str):
+        self._user_versions[user_id] = self._user_versions.get(user_id, 0) + 1
+
     async def _ensure_initialized(self):
         """Ensure the knowledge base is initialized"""
         if not self._initialized:
@@ -71,7 +1410,7 @@ class ConversationKnowledgeBase:
             
             # Load embedding model (lazy import)
             SentenceTransformer = _get_sentence_transformers().SentenceTransformer
-            self.embeddings_model = SentenceTransformer('all-MiniLM-L6-v2')
+            self.embeddings_model = SentenceTransformer(self.embedding_model_name)
             
             # Initialize database
             await self._init_database()
@@ -80,6 +1419,13 @@ class ConversationKnowledgeBase:
             await self._load_conversations_to_faiss()
             
             self._initialized = True
+            
+            if settings.KB_SNAPSHOT_ENABLED:
+                self._snapshot_task = asyncio.create_task(self._run_snapshots())
+            self._session_task = asyncio.create_task(self._run_session_summaries())
+            
+            # Finish ingesting messages accepted before the last shutdown
+            await self._replay_ingest_log()
             logger.info("Knowledge base initialized successfully")
             
         except Exception as e:
@@ -89,7 +1435,10 @@ class ConversationKnowledgeBase:
     
     async def _init_database(self):
         """Initialize SQLite database for conversation storage"""
-        conn = sqlite3.connect(self.db_path)
+        self._fts_enabled = await self._db.write(self._create_schema)
+    
+    def _create_schema(self, conn: sqlite3.Connection) -> bool:
+        """Create or migrate the conversations schema; returns whether FTS5 is enabled"""
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -103,80 +1452,1363 @@ class ConversationKnowledgeBase:
                 embedding BLOB,
                 topics TEXT,
                 importance_score REAL DEFAULT 1.0,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                embedding_model TEXT,
+                ingest_id TEXT,
+                content_hash INTEGER,
+                topic_mask INTEGER,
+                parent_id INTEGER,
+                passage_count INTEGER,
+                simhash INTEGER
             )
         """)
+
+        # Older databases predate the embedding_model column; all of their
+        # vectors were produced by the legacy model
+        cursor.execute("PRAGMA table_info(conversations)")
+        columns = {row[1] for row in cursor.fetchall()}
+        if 'embedding_model' not in columns:
+            cursor.execute("ALTER TABLE conversations ADD COLUMN embedding_model TEXT")
+            cursor.execute("""
+                UPDATE conversations SET embedding_model = ?
+                WHERE embedding IS NOT NULL
+            """, (LEGACY_EMBEDDING_MODEL,))
+        if 'ingest_id' not in columns:
+            cursor.execute("ALTER TABLE conversations ADD COLUMN ingest_id TEXT")
+        if 'content_hash' not in columns:
+            cursor.execute("ALTER TABLE conversations ADD COLUMN content_hash INTEGER")
+            conn.create_function('kb_content_hash', 1, content_hash, deterministic=True)
+            cursor.execute("UPDATE conversations SET content_hash = kb_content_hash(message_content)")
+        if 'topic_mask' not in columns:
+            cursor.execute("ALTER TABLE conversations ADD COLUMN topic_mask INTEGER")
+            conn.create_function(
+                'kb_topic_mask', 1, lambda topics: topic_bitmask(self._parse_topics(topics)), deterministic=True
+            )
+            cursor.execute("UPDATE conversations SET topic_mask = kb_topic_mask(topics)")
+        # Long messages are stored whole (parent, passage_count set, no vector)
+        # and as passage rows (parent_id set) that carry the vectors
+        if 'parent_id' not in columns:
+            cursor.execute("ALTER TABLE conversations ADD COLUMN parent_id INTEGER")
+        if 'passage_count' not in columns:
+            cursor.execute("ALTER TABLE conversations ADD COLUMN passage_count INTEGER")
+        if 'simhash' not in columns:
+            cursor.execute("ALTER TABLE conversations ADD COLUMN simhash INTEGER")
+            conn.create_function('kb_simhash', 1, simhash, deterministic=True)
+            cursor.execute("UPDATE conversations SET simhash = kb_simhash(message_content)")
+
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_content_hash ON conversations(content_hash);
+        """)
+
+        cursor.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_ingest_id ON conversations(ingest_id);
+        """)
+
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_user_id ON conversations(user_id);
+        """)
+        
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_session_id ON conversations(session_id);
+        """)
+        
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_timestamp ON conversations(timestamp);
+        """)
         
         cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_user_id ON conversations(user_id);
+            CREATE INDEX IF NOT EXISTS idx_parent_id ON conversations(parent_id) WHERE parent_id IS NOT NULL;
         """)
         
         cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_session_id ON conversations(session_id);
+            CREATE TABLE IF NOT EXISTS session_summaries (
+                user_id TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                centroid BLOB NOT NULL,
+                message_count INTEGER NOT NULL,
+                last_id INTEGER NOT NULL,
+                last_timestamp TEXT NOT NULL,
+                PRIMARY KEY (user_id, session_id)
+            ) WITHOUT ROWID
         """)
         
+        self._init_rollups(cursor)
+        return self._init_fts(cursor)
+    
+    def _init_rollups(self, cursor):
+        """
+        Create the per-user daily rollups and the triggers keeping them in sync
+
+        Each non-system message counts once under topic '' (all messages) and
+        once under each of its topics, on the day of its timestamp. Passage
+        rows don't count; their parent message does.
+        """
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'conversation_rollups'")
+        exists = cursor.fetchone() is not None
+        
         cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_timestamp ON conversations(timestamp);
+            CREATE TABLE IF NOT EXISTS conversation_rollups (
+                user_id TEXT NOT NULL,
+                day TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                message_count INTEGER NOT NULL,
+                PRIMARY KEY (user_id, day, topic)
+            ) WITHOUT ROWID
+        """)
+        
+        # Recreated so definition changes reach existing databases
+        cursor.execute("DROP TRIGGER IF EXISTS conversation_rollups_insert")
+        cursor.execute("DROP TRIGGER IF EXISTS conversation_rollups_delete")
+        
+        cursor.execute(f"""
+            CREATE TRIGGER conversation_rollups_insert AFTER INSERT ON conversations
+            WHEN new.message_role != 'system' AND new.parent_id IS NULL BEGIN
+                INSERT INTO conversation_rollups(user_id, day, topic, message_count)
+                SELECT new.user_id, substr(new.timestamp, 1, 10), topic, 1
+                FROM ({self._ROLLUP_TOPICS.format(row='new')}) WHERE true
+                ON CONFLICT(user_id, day, topic) DO UPDATE SET message_count = message_count + 1;
+            END
+        """)
+        
+        cursor.execute(f"""
+            CREATE TRIGGER conversation_rollups_delete AFTER DELETE ON conversations
+            WHEN old.message_role != 'system' AND old.parent_id IS NULL BEGIN
+                UPDATE conversation_rollups SET message_count = message_count - 1
+                WHERE user_id = old.user_id AND day = substr(old.timestamp, 1, 10)
+                AND topic IN ({self._ROLLUP_TOPICS.format(row='old')});
+                DELETE FROM conversation_rollups
+                WHERE user_id = old.user_id AND day = substr(old.timestamp, 1, 10) AND message_count <= 0;
+            END
         """)
         
-        conn.commit()
-        conn.close()
+        # Roll up rows written before the table existed
+        if not exists:
+            cursor.execute(f"""
+                INSERT INTO conversation_rollups(user_id, day, topic, message_count)
+                SELECT user_id, substr(timestamp, 1, 10), '', COUNT(*)
+                FROM conversations WHERE message_role != 'system' AND parent_id IS NULL
+                GROUP BY 1, 2
+                UNION ALL
+                SELECT c.user_id, substr(c.timestamp, 1, 10), t.value, COUNT(DISTINCT c.id)
+                FROM conversations c, json_each({self._ROLLUP_TOPIC_ARRAY.format(row='c')}) t
+                WHERE c.message_role != 'system' AND c.parent_id IS NULL
+                GROUP BY 1, 2, 3
+            """)
     
-    async def _load_conversations_to_faiss(self):
-        """Load existing conversations into FAISS index"""
-        faiss = _get_faiss()
+    # A row's topics as a JSON array, empty when missing or malformed
+    _ROLLUP_TOPIC_ARRAY = (
+        "CASE WHEN json_valid({row}.topics) AND json_type({row}.topics) = 'array' THEN {row}.topics ELSE '[]' END"
+    )
+    # Rollup keys of one message row: '' plus its distinct topics
+    _ROLLUP_TOPICS = "SELECT '' AS topic UNION SELECT value FROM json_each(" + _ROLLUP_TOPIC_ARRAY + ")"
+    
+    def _init_fts(self, cursor) -> bool:
+        """Create the FTS5 index over conversations and the triggers keeping it in sync"""
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'conversations_fts'")
+        exists = cursor.fetchone() is not None
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(
+                    message_content, user_id,
+                    content='conversations', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2', prefix='3 4'
+                )
+            """)
+        except sqlite3.OperationalError as e:
+            logger.warning(f"SQLite FTS5 unavailable, using in-memory keyword index: {e}")
+            return False
         
         cursor.execute("""
-            SELECT id, message_content, user_id, session_id, timestamp, topics, importance_score
-            FROM conversations 
-            WHERE message_role != 'system'
-            ORDER BY timestamp ASC
+            CREATE TRIGGER IF NOT EXISTS conversations_fts_insert AFTER INSERT ON conversations BEGIN
+                INSERT INTO conversations_fts(rowid, message_content, user_id)
+                VALUES (new.id, new.message_content, new.user_id);
+            END
         """)
         
-        rows = cursor.fetchall()
-        conn.close()
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS conversations_fts_delete AFTER DELETE ON conversations BEGIN
+                INSERT INTO conversations_fts(conversations_fts, rowid, message_content, user_id)
+                VALUES ('delete', old.id, old.message_content, old.user_id);
+            END
+        """)
         
-        if not rows:
-            # Initialize empty FAISS index
-            self.faiss_index = faiss.IndexFlatIP(self.embedding_dim)
-            return
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS conversations_fts_update
+            AFTER UPDATE OF message_content, user_id ON conversations BEGIN
+                INSERT INTO conversations_fts(conversations_fts, rowid, message_content, user_id)
+                VALUES ('delete', old.id, old.message_content, old.user_id);
+                INSERT INTO conversations_fts(rowid, message_content, user_id)
+                VALUES (new.id, new.message_content, new.user_id);
+            END
+        """)
+        
+        # Index rows written before the FTS table existed
+        if not exists:
+            cursor.execute("INSERT INTO conversations_fts(conversations_fts) VALUES ('rebuild')")
         
-        # Extract texts and metadata
+        return True
+    
+    async def _load_conversations_to_faiss(self, use_snapshot: bool = True):
+        """
+        Load existing conversations into FAISS index
+
+        The latest on-disk snapshot is memory-mapped when available, and only
+        rows added after it (the tail of the conversations table) are read.
+        Otherwise vectors are rebuilt from the stored embedding BLOBs in
+        streamed batches. Rows without a usable vector (missing, wrong size or
+        produced by another model) are re-encoded in the background once the
+        index is serving.
+        """
+        # A rebuild supersedes any re-embedding still running from the previous load
+        if self._reembed_task is not None and not self._reembed_task.done():
+            self._reembed_task.cancel()
+        if self._storage_migration_task is not None and not self._storage_migration_task.done():
+            self._storage_migration_task.cancel()
+
+        for task in self._index_rebuilds.values():
+            task.cancel()
+
+        self.user_indexes = {}
+        self.metadata_store = ConversationMetadataStore()
+        self._index_types = {}
+        self._index_rebuilds = {}
+        self._rebuild_buffers = {}
+        self._rebuild_removals = {}
+        self._tombstones = {}
+        self._mapped_partitions = set()
+        self.session_summaries = SessionSummaryIndex()
+        for user_id, session_id, centroid, message_count, last_id in await self._db.fetchall("""
+            SELECT user_id, session_id, centroid, message_count, last_id FROM session_summaries
+        """):
+            self.session_summaries.put(
+                user_id, session_id, decode_embeddings([centroid], self.embedding_dim)[0], message_count, last_id
+            )
+        self._content_ids = {}
+        self._simhash_bands = {}
+        self._superseded = set()
+        self._postings = {}
+        self._term_prefixes = {}
+        self.residency = UserResidency(settings.KB_MEMORY_BUDGET_MB * 2 ** 20)
+        self._page_ins = {}
+        self._evicted_users = set()
+        stale_ids = []
+
+        last_id = 0
+        use_snapshot = use_snapshot and settings.KB_SNAPSHOT_ENABLED and self._fts_enabled
+        # The in-memory postings used without FTS5 are not snapshotted.
+        # The tail is replayed into the snapshot's indexes, so a failure there
+        # falls back to a full rebuild from SQLite as well
+        try:
+            if use_snapshot:
+                last_id = await self._load_snapshot(stale_ids)
+
+            while True:
+                # Keyset pagination keeps each read short so writes are never held up
+                rows = await self._db.fetchall("""
+                    SELECT id, message_content, user_id, session_id, timestamp, topics,
+                           importance_score, embedding, embedding_model, simhash
+                    FROM conversations
+                    WHERE message_role != 'system' AND passage_count IS NULL AND id > ?
+                    ORDER BY id ASC
+                    LIMIT ?
+                """, (last_id, settings.KB_LOAD_BATCH_SIZE))
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                self._load_rows(rows, stale_ids)
+        except Exception as e:
+            if not use_snapshot:
+                raise
+            logger.warning(f"Ignoring unusable knowledge base snapshot: {e}")
+            return await self._load_conversations_to_faiss(use_snapshot=False)
+
+        self._enforce_memory_budget()
+
+        # Large partitions are converted to an approximate index in the background
+        partitions = [partition for partition, _ in self._partitions()]
+        for partition in partitions:
+            self._maybe_upgrade_index(partition)
+
+        logger.info(
+            f"Loaded {self.total_conversations} conversations into "
+            f"{len(partitions)} FAISS partitions of {len(self.user_indexes)} users"
+        )
+
+        if stale_ids:
+            logger.info(f"Scheduling background re-embedding of {len(stale_ids)} conversations")
+            self._reembed_task = asyncio.create_task(self._reembed_conversations(stale_ids))
+
+        # Vectors stored in another format than KB_EMBEDDING_STORAGE are rewritten in place
+        self._storage_migration_task = asyncio.create_task(self._migrate_embedding_storage())
+
+    async def _migrate_embedding_storage(self):
+        """Convert stored embedding BLOBs to the configured storage format"""
+        target_bytes = self.embedding_dim * embedding_storage_dtype().itemsize
+        known_bytes = {self.embedding_dim * dtype.itemsize for dtype in EMBEDDING_STORAGE_DTYPES.values()}
+        migrated = 0
+        last_id = 0
+
+        try:
+            while True:
+                rows = await self._db.fetchall("""
+                    SELECT id, embedding FROM conversations
+                    WHERE id > ? AND embedding IS NOT NULL AND length(embedding) != ?
+                    ORDER BY id ASC
+                    LIMIT ?
+                """, (last_id, target_bytes, settings.KB_REEMBED_BATCH_SIZE))
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+
+                # Malformed BLOBs are left to the re-embedding path
+                rows = [row for row in rows if len(row[1]) in known_bytes]
+                if not rows:
+                    continue
+
+                embeddings = decode_embeddings([row[1] for row in rows], self.embedding_dim)
+                await self._db.write(lambda conn, params: conn.executemany(
+                    "UPDATE conversations SET embedding = ? WHERE id = ?", params
+                ), [(encode_embedding(embedding), row[0]) for row, embedding in zip(rows, embeddings)])
+                migrated += len(rows)
+
+            if migrated:
+                logger.info(f"Converted {migrated} stored embeddings to {settings.KB_EMBEDDING_STORAGE}")
+
+        except Exception as e:
+            logger.error(f"Error converting stored embeddings: {e}")
+
+    def _load_rows(self, rows: List[Tuple], stale_ids: List[int]):
+        """Index conversation rows with usable stored vectors; collect the others in stale_ids"""
+        vector_bytes = {self.embedding_dim * dtype.itemsize for dtype in EMBEDDING_STORAGE_DTYPES.values()}
+
+        blobs = []
         texts = []
         metadata = []
-        
         for row in rows:
-            conv_id, content, user_id, session_id, timestamp, topics, importance = row
+            conv_id, content, user_id, session_id, timestamp, topics, importance, blob, model, fingerprint = row
+
+            if blob is None or len(blob) not in vector_bytes or model != self.embedding_model_name:
+                stale_ids.append(conv_id)
+                continue
+
+            blobs.append(blob)
             texts.append(content)
             metadata.append({
                 'id': conv_id,
                 'user_id': user_id,
                 'session_id': session_id,
                 'timestamp': timestamp,
-                'topics': topics,
-                'importance_score': importance
+                'topics': self._parse_topics(topics),
+                'importance_score': importance,
+                'simhash': fingerprint
             })
+
+        if blobs:
+            embeddings = decode_embeddings(blobs, self.embedding_dim)
+            self._add_to_indexes(texts, metadata, embeddings, schedule_upgrades=False)
+
+    async def _load_snapshot(self, stale_ids: List[int]) -> int:
+        """
+        Load the latest snapshot, memory-mapping flat partitions, and reconcile it with SQLite
+
+        Rows deleted since the snapshot are removed, rows at or below its last
+        id that it does not hold (e.g. re-embedded since) are loaded. Returns
+        the last conversation id covered; 0 if there is no usable snapshot.
+        """
+        current = self.snapshot_dir / 'CURRENT'
+        if not current.exists():
+            return 0
+
+        generation_dir = self.snapshot_dir / current.read_text().strip()
+        manifest = json.loads((generation_dir / 'manifest.json').read_text())
+        if manifest['embedding_model'] != self.embedding_model_name or manifest['embedding_dim'] != self.embedding_dim:
+            logger.info("Knowledge base snapshot was built with another embedding model, ignoring it")
+            return 0
+        if manifest.get('flat_codec') != settings.KB_FLAT_CODEC:
+            logger.info("Knowledge base snapshot uses another vector codec, ignoring it")
+            return 0
+        if manifest.get('time_bucket') != settings.KB_TIME_BUCKET:
+            logger.info("Knowledge base snapshot uses other time buckets, ignoring it")
+            return 0
+
+        faiss = _get_faiss()
+        loop = asyncio.get_running_loop()
+
+        for partition in manifest['partitions']:
+            # Flat codes are mapped zero-copy: processes on the same host share
+            # them through the page cache, and old buckets stay on disk until a
+            # search reaches them. Mapped codes are read-only, so HNSW graphs and
+            # IVF lists, which FAISS would otherwise map read-only, are read into memory
+            mapped = partition['index_type'] == 'flat'
+            index = await loop.run_in_executor(
+                None, faiss.read_index, str(generation_dir / partition['file']),
+                faiss.IO_FLAG_MMAP_IFC if mapped else 0
+            )
+            key = (partition['user_id'], partition['bucket'])
+            self.user_indexes.setdefault(partition['user_id'], {})[partition['bucket']] = index
+            self._index_types[key] = partition['index_type']
+            if mapped:
+                self._mapped_partitions.add(key)
+            if partition['tombstones']:
+                self._tombstones[key] = partition['tombstones']
+
+        with np.load(generation_dir / 'metadata.npz') as columns:
+            self.metadata_store = ConversationMetadataStore.from_snapshot(
+                {column: columns[column] for column in ConversationMetadataStore._COLUMNS},
+                manifest['values']
+            )
+            superseded = columns['superseded'] if 'superseded' in columns.files else np.empty(0, dtype='int64')
+
+        for user_id in self.user_indexes:
+            self.residency.admit(user_id, self._user_bytes(user_id))
+
+        last_id = manifest['last_id']
+        rows = await self._db.fetchall("""
+            SELECT id, user_id FROM conversations
+            WHERE message_role != 'system' AND passage_count IS NULL AND id <= ?
+        """, (last_id,))
+        stored_ids = np.array([row[0] for row in rows], dtype='int64')
+        snapshot_ids = self.metadata_store.live_ids()
+
+        # Deduplicated rows have no vector by design, so removing them only
+        # drops their metadata; deleted ones are forgotten afterwards
+        self._superseded = set(superseded.tolist())
+        deleted = snapshot_ids[~np.isin(snapshot_ids, stored_ids)]
+        if len(deleted):
+            removed: Dict[str, List[int]] = {}
+            for position in self.metadata_store.positions(deleted):
+                metadata = self.metadata_store.describe(position)
+                removed.setdefault(metadata['user_id'], []).append(metadata['id'])
+            self._remove_from_indexes(removed)
+
+        self._superseded.intersection_update(stored_ids.tolist())
+        missing = ~np.isin(stored_ids, snapshot_ids)
+        if self.residency.enabled:
+            # Users evicted before the snapshot stay cold until their next access
+            cold = np.array([row[1] not in self.residency for row in rows], dtype=bool)
+            self._evicted_users.update(row[1] for row, is_cold in zip(rows, cold) if is_cold)
+            missing &= ~cold
+        missing = stored_ids[missing].tolist()
+        for start in range(0, len(missing), 500):
+            batch_ids = missing[start:start + 500]
+            placeholders = ",".join("?" * len(batch_ids))
+            self._load_rows(await self._db.fetchall(f"""
+                SELECT id, message_content, user_id, session_id, timestamp, topics,
+                       importance_score, embedding, embedding_model, simhash
+                FROM conversations WHERE id IN ({placeholders})
+                ORDER BY id ASC
+            """, batch_ids), stale_ids)
+
+        logger.info(
+            f"Loaded knowledge base snapshot {generation_dir.name} "
+            f"({len(snapshot_ids)} conversations, {len(deleted)} deleted since)"
+        )
+        self._changes_since_snapshot = len(deleted) + len(missing)
+        return last_id
+
+    async def save_snapshot(self):
+        """
+        Persist the per-user indexes and the metadata store to a new snapshot generation
+
+        State is captured on the event loop, so it is consistent with the
+        indexes at one point in time; the files are written off the loop.
+        """
+        faiss = _get_faiss()
+
+        columns, values = self.metadata_store.snapshot()
+        columns['superseded'] = np.fromiter(self._superseded, dtype='int64', count=len(self._superseded))
+        partitions = [
+            (partition, self._index_types[partition], self._tombstones.get(partition, 0), faiss.serialize_index(index))
+            for partition, index in self._partitions()
+        ]
+        manifest = {
+            'embedding_model': self.embedding_model_name,
+            'embedding_dim': self.embedding_dim,
+            'flat_codec': settings.KB_FLAT_CODEC,
+            'time_bucket': settings.KB_TIME_BUCKET,
+            'last_id': int(columns['ids'].max()) if len(columns['ids']) else 0,
+            'values': values,
+            'partitions': [
+                {
+                    'user_id': user_id, 'bucket': bucket, 'file': f"{number}.faiss",
+                    'index_type': index_type, 'tombstones': tombstones
+                }
+                for number, ((user_id, bucket), index_type, tombstones, _) in enumerate(partitions)
+            ]
+        }
+        self._changes_since_snapshot = 0
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._write_snapshot, manifest, columns, partitions)
+
+    def _write_snapshot(self, manifest: Dict[str, Any], columns: Dict[str, np.ndarray], partitions: List[Tuple]):
+        """Write a snapshot generation, then point CURRENT at it and drop older ones"""
+        generation = f"{time.time_ns()}-{os.getpid()}"
+        generation_dir = self.snapshot_dir / generation
+        generation_dir.mkdir(parents=True)
+
+        for partition, (_, _, _, data) in zip(manifest['partitions'], partitions):
+            data.tofile(generation_dir / partition['file'])
+        np.savez(generation_dir / 'metadata.npz', **columns)
+        (generation_dir / 'manifest.json').write_text(json.dumps(manifest, ensure_ascii=False))
+
+        current_tmp = self.snapshot_dir / f"CURRENT.{generation}.tmp"
+        current_tmp.write_text(generation)
+        os.replace(current_tmp, self.snapshot_dir / 'CURRENT')
+
+        # Mapped files of dropped generations stay valid until unmapped
+        for path in self.snapshot_dir.iterdir():
+            if path.is_dir() and path.name != generation:
+                shutil.rmtree(path, ignore_errors=True)
+
+        logger.info(f"Wrote knowledge base snapshot {generation}")
+
+    async def _run_snapshots(self):
+        """Snapshot periodically while the index keeps changing"""
+        while True:
+            await asyncio.sleep(settings.KB_SNAPSHOT_INTERVAL_SECONDS)
+            if self._changes_since_snapshot:
+                try:
+                    await self.save_snapshot()
+                except Exception as e:
+                    logger.error(f"Error writing knowledge base snapshot: {e}")
+
+    async def _run_session_summaries(self):
+        """Summarize sessions left over from earlier runs, then each session once it goes idle"""
+        try:
+            await self._catch_up_session_summaries()
+        except Exception as e:
+            logger.error(f"Error summarizing stored sessions: {e}")
         
-        # Generate embeddings for existing conversations
-        if texts:
-            embeddings = self.embeddings_model.encode(texts, convert_to_tensor=False)
-            embeddings = np.array(embeddings).astype('float32')
-            
-            # Normalize for cosine similarity
-            faiss.normalize_L2(embeddings)
-            
-            # Create FAISS index
-            self.faiss_index = faiss.IndexFlatIP(self.embedding_dim)
-            self.faiss_index.add(embeddings)
-            
-            self.conversation_texts = texts
-            self.conversation_metadata = metadata
-            
-            logger.info(f"Loaded {len(texts)} conversations into FAISS index")
-    
+        while True:
+            await asyncio.sleep(settings.KB_SESSION_IDLE_MINUTES * 60)
+            try:
+                await self._summarize_idle_sessions()
+            except Exception as e:
+                logger.error(f"Error summarizing idle sessions: {e}")
+
+    async def _catch_up_session_summaries(self):
+        """Queue every session with messages past its summary, then summarize the idle ones"""
+        rows = await self._db.fetchall("""
+            SELECT c.user_id, c.session_id, MAX(c.timestamp)
+            FROM conversations c
+            LEFT JOIN session_summaries s ON s.user_id = c.user_id AND s.session_id = c.session_id
+            WHERE c.message_role != 'system' AND c.passage_count IS NULL AND c.id > COALESCE(s.last_id, 0)
+            GROUP BY c.user_id, c.session_id
+        """)
+        for user_id, session_id, last_timestamp in rows:
+            last_activity = self._parse_timestamp(last_timestamp) or time.time()
+            key = (user_id, session_id)
+            self._open_sessions[key] = max(self._open_sessions.get(key, 0.0), last_activity)
+        
+        await self._summarize_idle_sessions()
+        self._sessions_caught_up = True
+
+    async def _summarize_idle_sessions(self):
+        """Fold the new messages of sessions idle for KB_SESSION_IDLE_MINUTES into their centroids"""
+        idle_before = time.time() - settings.KB_SESSION_IDLE_MINUTES * 60
+        idle = [(key, last) for key, last in self._open_sessions.items() if last <= idle_before]
+        
+        for (user_id, session_id), last_activity in idle:
+            await self._summarize_session(user_id, session_id)
+            # Sessions that got a message meanwhile stay open
+            if self._open_sessions.get((user_id, session_id)) == last_activity:
+                del self._open_sessions[(user_id, session_id)]
+        
+        if idle:
+            logger.debug(f"Summarized {len(idle)} idle sessions")
+
+    async def _summarize_session(self, user_id: str, session_id: str):
+        """Extend a session's centroid with its messages stored after the last summary"""
+        centroid, message_count, last_id = self.session_summaries.get(user_id, session_id) or (
+            np.zeros(self.embedding_dim, dtype='float32'), 0, 0
+        )
+        rows = await self._db.fetchall("""
+            SELECT id, embedding, timestamp FROM conversations
+            WHERE user_id = ? AND session_id = ? AND id > ? AND embedding_model = ?
+            AND embedding IS NOT NULL AND message_role != 'system'
+            ORDER BY id ASC
+        """, (user_id, session_id, last_id, self.embedding_model_name))
+        if not rows:
+            return
+        
+        embeddings = decode_embeddings([row[1] for row in rows], self.embedding_dim)
+        embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        centroid = (centroid * message_count + embeddings.sum(axis=0)) / (message_count + len(rows))
+        message_count += len(rows)
+        last_id = rows[-1][0]
+        
+        await self._db.write(lambda conn: conn.execute("""
+            INSERT OR REPLACE INTO session_summaries
+            (user_id, session_id, centroid, message_count, last_id, last_timestamp)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (user_id, session_id, encode_embedding(centroid), message_count, last_id, max(row[2] for row in rows))))
+        self.session_summaries.put(user_id, session_id, centroid, message_count, last_id)
+
+    async def _reembed_conversations(self, conversation_ids: List[int]):
+        """Encode rows that have no usable stored vector and add them to the index"""
+        batch_size = settings.KB_REEMBED_BATCH_SIZE
+
+        try:
+            for start in range(0, len(conversation_ids), batch_size):
+                batch_ids = conversation_ids[start:start + batch_size]
+                placeholders = ",".join("?" * len(batch_ids))
+
+                rows = await self._db.fetchall(f"""
+                    SELECT id, message_content, user_id, session_id, timestamp, topics, importance_score
+                    FROM conversations
+                    WHERE id IN ({placeholders})
+                    ORDER BY id ASC
+                """, batch_ids)
+
+                if not rows:
+                    continue
+
+                texts = [row[1] for row in rows]
+                embeddings = await self._encoder.encode(texts)
+
+                await self._db.write(lambda conn, params: conn.executemany("""
+                    UPDATE conversations SET embedding = ?, embedding_model = ?
+                    WHERE id = ?
+                """, params), [
+                    (encode_embedding(embedding), self.embedding_model_name, row[0])
+                    for row, embedding in zip(rows, embeddings)
+                ])
+
+                self._add_to_indexes(texts, [
+                    {
+                        'id': conv_id,
+                        'user_id': user_id,
+                        'session_id': session_id,
+                        'timestamp': timestamp,
+                        'topics': self._parse_topics(topics),
+                        'importance_score': importance
+                    }
+                    for conv_id, _, user_id, session_id, timestamp, topics, importance in rows
+                ], embeddings)
+
+            logger.info(f"Re-embedded {len(conversation_ids)} conversations in background")
+
+        except Exception as e:
+            logger.error(f"Error re-embedding conversations: {e}")
+
+    def _add_to_indexes(
+        self,
+        texts: List[str],
+        metadata: List[Dict[str, Any]],
+        embeddings: np.ndarray,
+        schedule_upgrades: bool = True
+    ):
+        """
+        Add raw embeddings and their metadata to the owning partitions
+
+        A user's messages with the same normalized text, or with SimHash
+        fingerprints within KB_NEAR_DUPLICATE_BITS bits, share one vector: it
+        moves to the newest such message, so repeated advice, short phrases
+        and boilerplate replies do not grow the index. The older messages keep
+        their metadata rows, so keyword and metadata lookups still find them.
+
+        Under a memory budget rows of evicted users stay in SQLite only until
+        the user is paged back in; the budget is then enforced by evicting the
+        least recently active users.
+        """
+        faiss = _get_faiss()
+
+        if self.residency.enabled:
+            rows = [row for row, meta in enumerate(metadata) if meta['user_id'] not in self._evicted_users]
+            if len(rows) < len(metadata):
+                texts = [texts[row] for row in rows]
+                metadata = [metadata[row] for row in rows]
+                embeddings = np.asarray(embeddings)[rows]
+
+        if not metadata:
+            return
+
+        rows, replaced = self._dedupe_rows(texts, metadata)
+        kept = {metadata[row]['id'] for row in rows}
+        self._superseded.difference_update(kept)
+        self._superseded.update(meta['id'] for meta in metadata if meta['id'] not in kept)
+        if replaced:
+            self._superseded.update(conv_id for ids in replaced.values() for conv_id in ids)
+            self._remove_from_indexes(replaced, keep_rows=True)
+
+        # Normalize for cosine similarity; only the rows holding a vector are added
+        embeddings = np.array(np.asarray(embeddings)[rows], dtype='float32', copy=True)
+        faiss.normalize_L2(embeddings)
+        ids = np.array([metadata[row]['id'] for row in rows], dtype='int64')
+
+        for meta in metadata:
+            meta['ts'] = self._parse_timestamp(meta['timestamp'])
+        rows_by_partition: Dict[PartitionKey, List[int]] = {}
+        for vector_row, row in enumerate(rows):
+            meta = metadata[row]
+            rows_by_partition.setdefault((meta['user_id'], time_bucket(meta['ts'])), []).append(vector_row)
+
+        for partition, rows in rows_by_partition.items():
+            index = self._writable_index(partition)
+            if index is None:
+                index_type = select_index_type(0)
+                index = create_vector_index(index_type, self.embedding_dim)
+                user_id, bucket = partition
+                self.user_indexes.setdefault(user_id, {})[bucket] = index
+                self._index_types[partition] = index_type
+            with self._index_lock(partition):
+                index.add_with_ids(embeddings[rows], ids[rows])
+
+            # Vectors that arrive while a replacement index is being built are
+            # replayed into it before the swap
+            if partition in self._rebuild_buffers:
+                self._rebuild_buffers[partition].append((ids[rows], embeddings[rows]))
+
+        for text, meta in zip(texts, metadata):
+            if not self._fts_enabled:
+                self._index_terms(meta['user_id'], meta['id'], text)
+        self.metadata_store.append(metadata)
+        self._changes_since_snapshot += len(metadata)
+
+        if schedule_upgrades:
+            for partition in rows_by_partition:
+                self._maybe_upgrade_index(partition)
+
+        if self.residency.enabled:
+            for user_id in dict.fromkeys(meta['user_id'] for meta in metadata):
+                self.residency.admit(user_id, self._user_bytes(user_id))
+            self._enforce_memory_budget()
+
+    def _dedupe_rows(
+        self,
+        texts: List[str],
+        metadata: List[Dict[str, Any]]
+    ) -> Tuple[List[int], Dict[str, List[int]]]:
+        """
+        Rows to index (newest per user and content hash or near-duplicate
+        cluster) and, per user, the previously indexed ids they supersede
+        """
+        newest: Dict[Tuple[str, int], int] = {}
+        for row, (text, meta) in enumerate(zip(texts, metadata)):
+            if meta.get('content_hash') is None:
+                meta['content_hash'] = content_hash(text)
+            if meta.get('simhash') is None:
+                meta['simhash'] = simhash(text)
+            key = (meta['user_id'], meta['content_hash'])
+            if key not in newest or meta['id'] > metadata[newest[key]]['id']:
+                newest[key] = row
+
+        # Oldest first, so a batch's own near-duplicates collapse into its newest row
+        chosen: Dict[int, int] = {}
+        replaced: Dict[str, List[int]] = {}
+        for row in sorted(newest.values(), key=lambda row: metadata[row]['id']):
+            meta = metadata[row]
+            user_id = meta['user_id']
+            content_ids = self._content_ids.get(user_id)
+            if content_ids is None:
+                content_ids = self._content_ids[user_id] = {
+                    digest: conv_id for digest, conv_id in self.metadata_store.content_ids(user_id).items()
+                    if conv_id not in self._superseded
+                }
+
+            previous = content_ids.get(meta['content_hash'])
+            if previous is None:
+                previous = self._near_duplicate_id(user_id, meta['simhash'])
+            if previous is not None:
+                if previous > meta['id']:
+                    continue  # e.g. a re-embedded old row; the newer copy keeps the vector
+                if previous in chosen:
+                    superseded = metadata[chosen.pop(previous)]
+                    del content_ids[superseded['content_hash']]
+                    self._unindex_simhash(user_id, previous, superseded['simhash'])
+                else:
+                    replaced.setdefault(user_id, []).append(previous)
+            content_ids[meta['content_hash']] = meta['id']
+            self._index_simhash(user_id, meta['id'], meta['simhash'])
+            chosen[meta['id']] = row
+
+        return sorted(chosen.values()), replaced
+
+    def _user_simhash_bands(self, user_id: str) -> Dict[Tuple[int, int], Dict[int, int]]:
+        """The user's band -> {conversation id: fingerprint} table, built on first use"""
+        bands = self._simhash_bands.get(user_id)
+        if bands is None:
+            bands = self._simhash_bands[user_id] = {}
+            ids, fingerprints = self.metadata_store.simhashes_of(user_id)
+            for conv_id, fingerprint in zip(ids.tolist(), fingerprints.tolist()):
+                if conv_id in self._superseded:
+                    continue  # holds no vector, its newer duplicate does
+                for band in simhash_bands(fingerprint, settings.KB_NEAR_DUPLICATE_BITS):
+                    bands.setdefault(band, {})[conv_id] = fingerprint
+        return bands
+
+    def _near_duplicate_id(self, user_id: str, fingerprint: int) -> Optional[int]:
+        """Newest indexed message of the user within KB_NEAR_DUPLICATE_BITS of the fingerprint"""
+        if settings.KB_NEAR_DUPLICATE_BITS <= 0:
+            return None
+        bands = self._user_simhash_bands(user_id)
+        matches = [
+            conv_id
+            for band in simhash_bands(fingerprint, settings.KB_NEAR_DUPLICATE_BITS)
+            for conv_id, other in bands.get(band, {}).items()
+            if hamming_distance(fingerprint, other) <= settings.KB_NEAR_DUPLICATE_BITS
+        ]
+        return max(matches) if matches else None
+
+    def _index_simhash(self, user_id: str, conv_id: int, fingerprint: int):
+        if settings.KB_NEAR_DUPLICATE_BITS <= 0:
+            return
+        bands = self._user_simhash_bands(user_id)
+        for band in simhash_bands(fingerprint, settings.KB_NEAR_DUPLICATE_BITS):
+            bands.setdefault(band, {})[conv_id] = fingerprint
+
+    def _unindex_simhash(self, user_id: str, conv_id: int, fingerprint: int):
+        bands = self._simhash_bands.get(user_id)
+        if bands is None:
+            return
+        for band in simhash_bands(fingerprint, settings.KB_NEAR_DUPLICATE_BITS):
+            ids = bands.get(band)
+            if ids is not None:
+                ids.pop(conv_id, None)
+                if not ids:
+                    del bands[band]
+
+    def _remove_from_indexes(self, removed: Dict[str, List[int]], keep_rows: bool = False):
+        """
+        Drop deleted conversations from the partitions and the metadata store
+
+        With keep_rows only the vectors go (their rows were superseded by a
+        newer duplicate) and the metadata rows stay.
+        """
+        all_ids = np.fromiter((conv_id for ids in removed.values() for conv_id in ids), dtype='int64')
+
+        # Find each vector's partition and forget content hashes whose vector goes away
+        removed_by_partition: Dict[PartitionKey, List[int]] = {}
+        positions = self.metadata_store.positions(all_ids)
+        for position in positions[positions >= 0]:
+            metadata = self.metadata_store.describe(position)
+            content_ids = self._content_ids.get(metadata['user_id'])
+            digest = int(self.metadata_store.content_hashes[position])
+            if content_ids is not None and content_ids.get(digest) == metadata['id']:
+                del content_ids[digest]
+            self._unindex_simhash(metadata['user_id'], metadata['id'], int(self.metadata_store.simhashes[position]))
+            if not keep_rows and metadata['id'] in self._superseded:
+                continue  # a superseded row has no vector of its own
+
+            partition = (metadata['user_id'], time_bucket(float(self.metadata_store.timestamps[position])))
+            removed_by_partition.setdefault(partition, []).append(metadata['id'])
+
+        for partition, conversation_ids in removed_by_partition.items():
+            index = self._writable_index(partition)
+            if index is None:
+                continue
+
+            ids = np.array(conversation_ids, dtype='int64')
+            self._remove_vectors(partition, index, ids)
+
+            # Replayed into the replacement index if it was read before the delete
+            if partition in self._rebuild_removals:
+                self._rebuild_removals[partition].append(ids)
+
+        if keep_rows:
+            self._changes_since_snapshot += len(all_ids)
+        else:
+            if not self._fts_enabled:
+                for user_id, conversation_ids in removed.items():
+                    self._unindex_terms(user_id, set(conversation_ids))
+            self._changes_since_snapshot += self.metadata_store.remove(all_ids)
+
+        # Emptied partitions (e.g. buckets past retention) are dropped whole;
+        # shrunken ones may downgrade their index type, HNSW ones compact
+        for partition in removed_by_partition:
+            index = self._partition_index(partition)
+            if index is None:
+                continue
+            if index.ntotal <= self._tombstones.get(partition, 0):
+                self._drop_partition(partition)
+            else:
+                self._maybe_upgrade_index(partition)
+
+    def _partitions(self):
+        """(partition key, index) of every loaded partition"""
+        for user_id, buckets in self.user_indexes.items():
+            for bucket, index in buckets.items():
+                yield (user_id, bucket), index
+
+    def _partition_index(self, partition: PartitionKey):
+        """Index of one partition, None if it is not loaded"""
+        user_id, bucket = partition
+        return self.user_indexes.get(user_id, {}).get(bucket)
+
+    def _writable_index(self, partition: PartitionKey):
+        """Index of one partition ready for adds and removals, copying a mapped snapshot view into memory"""
+        index = self._partition_index(partition)
+        if index is not None and partition in self._mapped_partitions:
+            faiss = _get_faiss()
+            index = faiss.deserialize_index(faiss.serialize_index(index))
+            user_id, bucket = partition
+            self.user_indexes[user_id][bucket] = index
+            self._mapped_partitions.discard(partition)
+        return index
+
+    def _drop_partition(self, partition: PartitionKey):
+        """Forget an emptied partition along with its pending rebuild"""
+        rebuild = self._index_rebuilds.pop(partition, None)
+        if rebuild is not None:
+            rebuild.cancel()
+        for state in (self._index_types, self._tombstones, self._rebuild_buffers, self._rebuild_removals):
+            state.pop(partition, None)
+        self._mapped_partitions.discard(partition)
+
+        user_id, bucket = partition
+        del self.user_indexes[user_id][bucket]
+        if not self.user_indexes[user_id]:
+            del self.user_indexes[user_id]
+
+    def _route_buckets(self, user_id: str, time_window_days: int) -> List[str]:
+        """The user's time buckets overlapping the last time_window_days (all of them for 0)"""
+        buckets = self.user_indexes.get(user_id, {})
+        if time_window_days <= 0:
+            return list(buckets)
+
+        first = time_bucket((datetime.now() - timedelta(days=time_window_days)).timestamp())
+        return [bucket for bucket in buckets if bucket >= first]
+
+    def _partition_bytes(self, partition: PartitionKey, index) -> int:
+        """Estimated memory of one partition: vector codes, id maps and HNSW links"""
+        if self._index_types.get(partition) == 'hnsw':
+            per_vector = self.embedding_dim * 4 + 2 * settings.KB_HNSW_M * 4
+        else:
+            per_vector = index.sa_code_size()
+        return index.ntotal * (per_vector + 16)
+
+    def _user_bytes(self, user_id: str) -> int:
+        """Estimated memory of a user's partitions and metadata rows"""
+        total = self.metadata_store.user_bytes(user_id)
+        for bucket, index in self.user_indexes.get(user_id, {}).items():
+            total += self._partition_bytes((user_id, bucket), index)
+        return total
+
+    async def _ensure_resident(self, user_id: str):
+        """Make sure a user's vectors and metadata are in memory, paging them in if evicted"""
+        if self.residency.touch(user_id):
+            return
+
+        # Concurrent requests of a cold user share one page-in
+        task = self._page_ins.get(user_id)
+        if task is None:
+            task = self._page_ins[user_id] = asyncio.create_task(self._page_in(user_id))
+            task.add_done_callback(lambda _: self._page_ins.pop(user_id, None))
+        await asyncio.shield(task)
+
+    async def _page_in(self, user_id: str):
+        """Load one user's stored vectors from SQLite"""
+        start = time.perf_counter()
+
+        # Read on the writer thread: ordered with ingest commits, so a message is
+        # either in this read or indexed after the user becomes resident
+        rows = await self._db.write(lambda conn: conn.execute("""
+            SELECT id, message_content, user_id, session_id, timestamp, topics,
+                   importance_score, embedding, embedding_model, simhash
+            FROM conversations
+            WHERE user_id = ? AND message_role != 'system' AND passage_count IS NULL
+            ORDER BY id ASC
+        """, (user_id,)).fetchall())
+
+        # Rows without a usable vector are left to the background re-embedding
+        self._evicted_users.discard(user_id)
+        self._load_rows(rows, [])
+        self.residency.admit(user_id, self._user_bytes(user_id))
+        for bucket in list(self.user_indexes.get(user_id, {})):
+            self._maybe_upgrade_index((user_id, bucket))
+        self._enforce_memory_budget()
+
+        logger.debug(
+            f"Paged in {len(rows)} conversations of user {user_id} "
+            f"in {(time.perf_counter() - start) * 1000:.1f} ms"
+        )
+
+    def _enforce_memory_budget(self):
+        """Evict least recently active users until the residency budget holds"""
+        for user_id in self.residency.over_budget():
+            self._evict_user(user_id)
+
+    def _evict_user(self, user_id: str):
+        """Release a cold user's partitions and metadata; SQLite keeps everything"""
+        for bucket in list(self.user_indexes.get(user_id, {})):
+            self._drop_partition((user_id, bucket))
+        self.metadata_store.remove(self.metadata_store.user_ids(user_id))
+        self._content_ids.pop(user_id, None)
+        self._simhash_bands.pop(user_id, None)
+        self._postings.pop(user_id, None)
+        self._term_prefixes.pop(user_id, None)
+        self.residency.discard(user_id, evicted=True)
+        self._evicted_users.add(user_id)
+        logger.debug(f"Evicted user {user_id} from memory")
+
+    def _index_lock(self, partition: PartitionKey) -> threading.Lock:
+        """Guards a partition: searches run on executor threads, updates on the loop"""
+        lock = self._index_locks.get(partition)
+        if lock is None:
+            # setdefault is atomic, so racing threads end up with the same lock
+            lock = self._index_locks.setdefault(partition, threading.Lock())
+        return lock
+
+    def _search_index(self, partition: PartitionKey, index, query_embedding: np.ndarray, k: int, params=None):
+        with self._index_lock(partition):
+            return index.search(query_embedding, k, params=params)
+
+    def _filtered_search_params(self, partition: PartitionKey, index, ids: np.ndarray, k: int):
+        """FAISS search parameters restricting a partition search to the given ids"""
+        faiss = _get_faiss()
+        selector = faiss.IDSelectorBatch(ids)
+
+        # Graph and inverted-list searches must visit more of the partition the
+        # more selective the filter is, to reach enough matching vectors
+        widen = index.ntotal / max(len(ids), 1)
+        index_type = self._index_types.get(partition)
+        if index_type == 'hnsw':
+            ef_search = min(index.ntotal, int(settings.KB_HNSW_EF_SEARCH * widen))
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=max(ef_search, settings.KB_HNSW_EF_SEARCH, k))
+        elif index_type == 'ivfpq':
+            nlist = faiss.extract_index_ivf(index).nlist
+            nprobe = max(1, min(nlist, int(_ivf_nprobe(nlist) * widen)))
+            refine = faiss.downcast_index(index.index)
+            if isinstance(refine, faiss.IndexRefine):
+                # IndexRefine hands only base_index_params to the IVF-PQ, past the
+                # id map, so the selector is translated to internal ids here
+                translated = faiss.IDSelectorTranslated(index.id_map, selector)
+                ivf_params = faiss.SearchParametersIVF(sel=translated, nprobe=nprobe)
+                params = faiss.IndexRefineSearchParameters(
+                    k_factor=refine.k_factor, base_index_params=ivf_params
+                )
+                params.base_params = ivf_params  # keep the nested parameters alive
+                params.translated = translated
+            else:
+                params = faiss.SearchParametersIVF(sel=selector, nprobe=nprobe)
+        else:
+            params = faiss.SearchParameters(sel=selector)
+
+        params.selector = selector  # the parameters don't keep the selector alive
+        return params
+
+    def _remove_vectors(self, partition: PartitionKey, index, ids: np.ndarray):
+        """Remove ids from one partition, or tombstone them where the index cannot"""
+        if self._index_types.get(partition) in ('hnsw', 'ivfpq'):
+            # HNSW graphs and refined IVF-PQ can't delete; searches already skip
+            # ids missing from the metadata store, and compaction drops them
+            self._tombstones[partition] = self._tombstones.get(partition, 0) + len(ids)
+        else:
+            with self._index_lock(partition):
+                index.remove_ids(ids)
+
+    def _unindex_terms(self, user_id: str, conversation_ids: set):
+        """Remove conversations from the user's inverted index"""
+        postings = self._postings.get(user_id, {})
+        for term in list(postings):
+            remaining = [conv_id for conv_id in postings[term] if conv_id not in conversation_ids]
+            if remaining:
+                postings[term] = remaining
+            else:
+                del postings[term]
+                self._term_prefixes[user_id][term[:TERM_PREFIX_LENGTH]].discard(term)
+
+    def _index_terms(self, user_id: str, conversation_id: int, text: str):
+        """Add a message's terms to the user's inverted index"""
+        postings = self._postings.setdefault(user_id, {})
+        prefixes = self._term_prefixes.setdefault(user_id, {})
+
+        for term in set(_TOKEN_PATTERN.findall(text.lower())):
+            conversation_ids = postings.get(term)
+            if conversation_ids is None:
+                conversation_ids = postings[term] = []
+                prefixes.setdefault(term[:TERM_PREFIX_LENGTH], set()).add(term)
+            conversation_ids.append(conversation_id)
+
+    def _match_term_prefix(self, user_id: str, prefix: str) -> set:
+        """Ids of the user's messages containing a term that starts with prefix"""
+        postings = self._postings.get(user_id)
+        if not postings or len(prefix) < TERM_PREFIX_LENGTH:
+            return set()
+
+        matched = set()
+        for term in self._term_prefixes[user_id].get(prefix[:TERM_PREFIX_LENGTH], ()):
+            if term.startswith(prefix):
+                matched.update(postings[term])
+        return matched
+
+    async def _fts_candidates(
+        self,
+        user_id: str,
+        terms: List[str],
+        limit: int,
+        since: Optional[datetime] = None,
+        topic_mask: int = 0
+    ) -> List[Tuple]:
+        """
+        BM25-ranked messages of a user matching any of the stemmed terms
+
+        The user_id column is part of the FTS match so the posting-list
+        intersection happens inside SQLite; the exact comparison on the
+        base table guards against phrase matches of similar ids.
+        """
+        stems = sorted({stem_russian(term) for term in terms})
+        if not stems:
+            return []
+
+        user_phrase = user_id.replace('"', '""')
+        match = f'user_id : "{user_phrase}" AND message_content : (' + ' OR '.join(
+            f'"{stem}"*' for stem in stems
+        ) + ')'
+
+        sql = """
+            SELECT c.id, c.message_content, c.timestamp, c.session_id, c.topics, c.importance_score
+            FROM conversations_fts
+            JOIN conversations c ON c.id = conversations_fts.rowid
+            WHERE conversations_fts MATCH ? AND c.user_id = ? AND c.message_role != 'system'
+            AND c.passage_count IS NULL
+        """
+        params: List[Any] = [match, user_id]
+        if since is not None:
+            sql += " AND c.timestamp >= ?"
+            params.append(since.isoformat())
+        if topic_mask:
+            sql += " AND (c.topic_mask & ?) != 0"
+            params.append(topic_mask)
+        sql += " ORDER BY bm25(conversations_fts) LIMIT ?"
+        params.append(limit)
+
+        return await self._db.fetchall(sql, params)
+
+    @staticmethod
+    def _has_term_prefix(tokens: set, prefix: str) -> bool:
+        """Whether any token of a message starts with prefix"""
+        return any(token.startswith(prefix) for token in tokens)
+
+    async def _fetch_messages(self, conversation_ids: List[int]) -> Dict[int, Tuple[str, str]]:
+        """Content and timestamp of the given conversations, read from SQLite"""
+        messages = {}
+        for start in range(0, len(conversation_ids), 500):
+            batch_ids = [int(conv_id) for conv_id in conversation_ids[start:start + 500]]
+            placeholders = ",".join("?" * len(batch_ids))
+            rows = await self._db.fetchall(f"""
+                SELECT id, message_content, timestamp FROM conversations
+                WHERE id IN ({placeholders})
+            """, batch_ids)
+            for conv_id, content, timestamp in rows:
+                messages[conv_id] = (content, timestamp)
+        return messages
+
+    async def _build_results(
+        self,
+        positions: np.ndarray,
+        similarities: List[float],
+        match_type: str
+    ) -> List[Dict[str, Any]]:
+        """Search results for metadata rows, with text fetched from SQLite"""
+        messages = await self._fetch_messages([int(conv_id) for conv_id in self.metadata_store.ids[positions]])
+        return self._format_results(positions, similarities, match_type, messages)
+
+    def _format_results(
+        self,
+        positions: np.ndarray,
+        similarities: List[float],
+        match_type: str,
+        messages: Dict[int, Tuple[str, str]]
+    ) -> List[Dict[str, Any]]:
+        """Search results for metadata rows whose text is in messages"""
+        results = []
+        for position, similarity in zip(positions, similarities):
+            conv_id = int(self.metadata_store.ids[position])
+            if conv_id not in messages:
+                continue
+            content, timestamp = messages[conv_id]
+            metadata = self.metadata_store.describe(position)
+            results.append({
+                'id': conv_id,
+                'content': content,
+                'similarity': float(similarity),
+                'timestamp': timestamp,
+                'session_id': metadata['session_id'],
+                'topics': metadata['topics'],
+                'importance_score': metadata['importance_score'],
+                'match_type': match_type
+            })
+        return results
+
+    async def expand_passages(self, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Replace passage results with their whole parent messages
+
+        Passages of the same message collapse into the first (best ranked)
+        one; the expanded result keeps the passage's id and scores and gains
+        'parent_id'. Other results are returned unchanged.
+        """
+        ids = [result['id'] for result in results if 'id' in result]
+        if not ids:
+            return results
+        
+        parents = {}
+        for start in range(0, len(ids), 500):
+            batch_ids = ids[start:start + 500]
+            placeholders = ",".join("?" * len(batch_ids))
+            rows = await self._db.fetchall(f"""
+                SELECT passage.id, parent.id, parent.message_content
+                FROM conversations passage
+                JOIN conversations parent ON parent.id = passage.parent_id
+                WHERE passage.id IN ({placeholders})
+            """, batch_ids)
+            for passage_id, parent_id, content in rows:
+                parents[passage_id] = (parent_id, content)
+        
+        expanded = []
+        seen_parents = set()
+        for result in results:
+            if result.get('id') not in parents:
+                expanded.append(result)
+                continue
+            parent_id, content = parents[result['id']]
+            if parent_id in seen_parents:
+                continue
+            seen_parents.add(parent_id)
+            expanded.append({**result, 'content': content, 'parent_id': parent_id})
+        return expanded
+
+    def get_all_conversations(self, user_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """All stored non-system messages, oldest first (for inspection scripts)"""
+        sql = """
+            SELECT id, user_id, session_id, message_role, message_content, timestamp, topics, importance_score
+            FROM conversations WHERE message_role != 'system' AND parent_id IS NULL
+        """
+        params: List[Any] = []
+        if user_id:
+            sql += " AND user_id = ?"
+            params.append(user_id)
+        rows = self._db.reader().execute(sql + " ORDER BY timestamp ASC", params).fetchall()
+
+        return [
+            {
+                'id': conv_id,
+                'user_id': row_user_id,
+                'session_id': session_id,
+                'role': role,
+                'content': content,
+                'timestamp': timestamp,
+                'topics': self._parse_topics(topics),
+                'importance_score': importance
+            }
+            for conv_id, row_user_id, session_id, role, content, timestamp, topics, importance in rows
+        ]
+
+    @staticmethod
+    def _parse_timestamp(timestamp: str) -> Optional[float]:
+        """Epoch seconds of an ISO timestamp, parsed once per message"""
+        try:
+            return datetime.fromisoformat(timestamp).timestamp()
+        except (TypeError, ValueError):
+            return None
+
+    def _maybe_upgrade_index(self, partition: PartitionKey):
+        """Schedule a background rebuild if the partition changed size class or needs compaction"""
+        if partition in self._index_rebuilds:
+            return
+
+        old_index = self._partition_index(partition)
+        total = old_index.ntotal
+        tombstones = self._tombstones.get(partition, 0)
+        index_type = select_index_type(total - tombstones)
+        if index_type == self._index_types.get(partition) and tombstones <= total * settings.KB_HNSW_COMPACT_RATIO:
+            return
+
+        # Snapshot the ids now: anything added from here on is buffered and replayed.
+        # Tombstoned ids are no longer in the metadata store, or (superseded by
+        # a duplicate) no longer own a vector, and are left out
+        indexed_ids = _get_faiss().vector_to_array(old_index.id_map).copy()
+        superseded = np.fromiter(self._superseded, dtype='int64', count=len(self._superseded))
+        indexed_ids = indexed_ids[
+            (self.metadata_store.positions(indexed_ids) >= 0) & ~np.isin(indexed_ids, superseded)
+        ]
+        self._rebuild_buffers[partition] = []
+        self._rebuild_removals[partition] = []
+        self._index_rebuilds[partition] = asyncio.create_task(
+            self._rebuild_partition(partition, index_type, old_index, indexed_ids)
+        )
+
+    async def _rebuild_partition(self, partition: PartitionKey, index_type: str, old_index, indexed_ids: np.ndarray):
+        """Build (and train) a new index for one partition off the event loop, then swap it in"""
+        loop = asyncio.get_running_loop()
+        user_id, bucket = partition
+
+        try:
+            new_index = await loop.run_in_executor(
+                None, self._build_partition_index, user_id, index_type, indexed_ids
+            )
+
+            # The partition was replaced (e.g. by a full reload) while building
+            if self._partition_index(partition) is not old_index:
+                return
+
+            for ids, vectors in self._rebuild_buffers.get(partition, []):
+                new_index.add_with_ids(vectors, ids)
+
+            self.user_indexes[user_id][bucket] = new_index
+            self._index_types[partition] = index_type
+            self._mapped_partitions.discard(partition)
+            # Rows deleted before the build read SQLite are already absent
+            self._tombstones.pop(partition, None)
+            for ids in self._rebuild_removals.get(partition, []):
+                self._remove_vectors(partition, new_index, ids)
+            logger.info(
+                f"Rebuilt index for user {user_id}, bucket {bucket or 'undated'} "
+                f"as {index_type} ({new_index.ntotal} vectors)"
+            )
+
+        except Exception as e:
+            logger.error(f"Error rebuilding index for user {user_id}, bucket {bucket or 'undated'}: {e}")
+
+        finally:
+            if self._index_rebuilds.get(partition) is asyncio.current_task():
+                del self._index_rebuilds[partition]
+                self._rebuild_buffers.pop(partition, None)
+                self._rebuild_removals.pop(partition, None)
+
+    def _build_partition_index(self, user_id: str, index_type: str, indexed_ids: np.ndarray):
+        """Build a partition's index from the stored embeddings of the given rows"""
+        faiss = _get_faiss()
+
+        # Runs on an executor thread, which gets its own read connection.
+        # Only the id range of the partition's rows is read
+        first_id, last_id = (int(indexed_ids.min()), int(indexed_ids.max())) if len(indexed_ids) else (0, -1)
+        rows = self._db.reader().execute("""
+            SELECT id, embedding FROM conversations
+            WHERE user_id = ? AND embedding_model = ? AND id BETWEEN ? AND ?
+            ORDER BY id ASC
+        """, (user_id, self.embedding_model_name, first_id, last_id)).fetchall()
+
+        ids = np.array([row[0] for row in rows], dtype='int64')
+        keep = np.isin(ids, indexed_ids)
+        ids = ids[keep]
+        embeddings = decode_embeddings([row[1] for row, kept in zip(rows, keep) if kept], self.embedding_dim)
+        faiss.normalize_L2(embeddings)
+
+        index = create_vector_index(index_type, self.embedding_dim, len(ids))
+        if not index.is_trained:
+            index.train(embeddings)
+        index.add_with_ids(embeddings, ids)
+        return index
+
+    def _encode_texts(self, texts: List[str]) -> np.ndarray:
+        """Encode texts into raw (unnormalized) float32 embeddings"""
+        embeddings = self.embeddings_model.encode(texts, convert_to_tensor=False)
+        return np.asarray(embeddings, dtype='float32').reshape(len(texts), self.embedding_dim)
+
+    @staticmethod
+    def _parse_topics(topics_json: Optional[str]) -> List[str]:
+        """Decode the JSON topics column"""
+        if not topics_json:
+            return []
+        try:
+            return json.loads(topics_json)
+        except (TypeError, ValueError):
+            return []
+
     async def store_conversation_message(
         self,
         user_id: str,
@@ -187,7 +2819,14 @@ class ConversationKnowledgeBase:
         topics: List[str] = None,
         importance_score: float = 1.0
     ):
-        """Store a conversation message in the knowledge base"""
+        """
+        Store a conversation message in the knowledge base
+
+        The message is journaled to the ingest log and queued; syncing the log
+        to disk, embedding, the database write and indexing happen in the
+        background ingest worker. Awaits only when the ingest queue is full
+        (backpressure).
+        """
         
         try:
             await self._ensure_initialized()
@@ -207,77 +2846,365 @@ class ConversationKnowledgeBase:
             return
         
         try:
-            faiss = _get_faiss()
+            message = {
+                'ingest_id': uuid.uuid4().hex,
+                'user_id': user_id,
+                'session_id': session_id,
+                'role': role,
+                'content': content,
+                'timestamp': timestamp.isoformat(),
+                'topics': topics,
+                'importance_score': importance_score
+            }
             
-            # Generate embedding
-            embedding = self.embeddings_model.encode([content], convert_to_tensor=False)[0]
-            embedding = embedding.astype('float32')
+            # Journal first so a crash before the batch commits loses nothing;
+            # the worker syncs the log to disk once per batch
+            with open(self.ingest_log_path, 'a', encoding='utf-8') as log:
+                log.write(json.dumps(message, ensure_ascii=False) + '\n')
+            self._ingest_pending += 1
+            self._user_ingest_pending[user_id] = self._user_ingest_pending.get(user_id, 0) + 1
             
-            # Normalize for cosine similarity
-            embedding_normalized = embedding.copy()
-            faiss.normalize_L2(embedding_normalized.reshape(1, -1))
+            self._ensure_ingest_worker()
+            await self._ingest_queue.put(message)
             
-            # Extract topics automatically if not provided
-            if topics is None:
-                topics = await self._extract_topics(content)
+            logger.debug(f"Queued conversation message for user {user_id}")
             
-            # Store in database
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+        except Exception as e:
+            logger.error(f"Error storing conversation message: {e}")
+    
+    def _ensure_ingest_worker(self):
+        """
+        Start the ingest consumer on the running event loop
+
+        Messages left by a worker whose loop went away (queued, or in the batch
+        it was ingesting) move to the new queue ahead of new ones; their
+        pending counts carry over, so the journal is still truncated once
+        they are done.
+        """
+        loop = asyncio.get_running_loop()
+        if self._ingest_loop is not loop or self._ingest_worker is None or self._ingest_worker.done():
+            stranded = self._ingest_inflight
+            if self._ingest_queue is not None:
+                while not self._ingest_queue.empty():
+                    stranded.append(self._ingest_queue.get_nowait())
+            self._ingest_inflight = []
             
-            cursor.execute("""
-                INSERT INTO conversations 
-                (user_id, session_id, message_role, message_content, timestamp, embedding, topics, importance_score)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                user_id, session_id, role, content, timestamp.isoformat(),
-                embedding.tobytes(), json.dumps(topics), importance_score
-            ))
+            self._ingest_loop = loop
+            # Stranded messages may briefly exceed the usual bound
+            self._ingest_queue = asyncio.Queue(maxsize=max(settings.KB_INGEST_QUEUE_SIZE, len(stranded)))
+            for message in stranded:
+                self._ingest_queue.put_nowait(message)
+            self._ingest_worker = loop.create_task(self._run_ingest_worker(recover=bool(stranded)))
+    
+    async def _run_ingest_worker(self, recover: bool = False):
+        """
+        Consume queued messages in batches: one encode, one transaction, one index add
+
+        With recover the first batch holds messages of an interrupted worker,
+        which may have committed them without indexing.
+        """
+        queue = self._ingest_queue
+        
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < settings.KB_INGEST_BATCH_SIZE and not queue.empty():
+                batch.append(queue.get_nowait())
+            # Cancellation (or the loop closing) mid-batch leaves the batch in
+            # flight and journaled for the next worker
+            self._ingest_inflight = batch
             
-            conversation_id = cursor.lastrowid
-            conn.commit()
-            conn.close()
+            if settings.KB_INGEST_FSYNC:
+                await self._sync_ingest_log()
             
-            # Add to FAISS index
-            if self.faiss_index is None:
-                self.faiss_index = faiss.IndexFlatIP(self.embedding_dim)
+            for attempt in range(settings.KB_INGEST_MAX_RETRIES + 1):
+                try:
+                    if attempt:
+                        await asyncio.sleep(settings.KB_INGEST_RETRY_DELAY_SECONDS * 2 ** (attempt - 1))
+                    if attempt or recover:
+                        # A failed or interrupted attempt may have committed before indexing
+                        await self._index_committed(batch)
+                    await self._ingest_batch(batch)
+                    break
+                except Exception as e:
+                    logger.error(
+                        f"Error ingesting {len(batch)} conversation messages (attempt {attempt + 1}): {e}"
+                    )
+            else:
+                # Entries stay in the ingest log and are replayed on next startup
+                self._ingest_failed.extend(batch)
             
-            self.faiss_index.add(embedding_normalized.reshape(1, -1))
+            recover = False
+            self._ingest_inflight = []
+            self._ingest_pending -= len(batch)
             
-            # Update in-memory storage
-            self.conversation_texts.append(content)
-            self.conversation_metadata.append({
-                'id': conversation_id,
-                'user_id': user_id,
-                'session_id': session_id,
-                'timestamp': timestamp.isoformat(),
-                'topics': topics,
-                'importance_score': importance_score
-            })
+            # Everything journaled is now committed or failed; keep only the failures
+            if self._ingest_pending == 0:
+                try:
+                    self._rewrite_ingest_log(self._ingest_failed)
+                except OSError as e:
+                    logger.error(f"Error rewriting ingest log: {e}")
             
-            logger.debug(f"Stored conversation message for user {user_id}")
+            for message in batch:
+                self._release_pending(message['user_id'])
+                queue.task_done()
+    
+    async def _sync_ingest_log(self):
+        """Group commit: one fsync off the event loop covers every message journaled so far"""
+        def sync():
+            with open(self.ingest_log_path, 'a', encoding='utf-8') as log:
+                os.fsync(log.fileno())
+        
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, sync)
+        except OSError as e:
+            # The batch is durable once committed to SQLite anyway
+            logger.error(f"Error syncing ingest log: {e}")
+    
+    def _rewrite_ingest_log(self, messages: List[Dict[str, Any]]):
+        """Replace the ingest log with the given messages, or empty it"""
+        if not messages:
+            open(self.ingest_log_path, 'w').close()
+            return
+        
+        tmp_path = self.ingest_log_path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as log:
+            for message in messages:
+                entry = {field: message[field] for field in self._JOURNAL_FIELDS}
+                log.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            log.flush()
+            os.fsync(log.fileno())
+        os.replace(tmp_path, self.ingest_log_path)
+    
+    async def _index_committed(self, batch: List[Dict[str, Any]]):
+        """Index rows of the batch that are stored in SQLite but not in memory"""
+        ingest_ids = [message['ingest_id'] for message in batch] + [
+            passage['ingest_id'] for message in batch for passage in message.get('passages', [])
+        ]
+        placeholders = ",".join("?" * len(ingest_ids))
+        rows = await self._db.fetchall(f"""
+            SELECT id, message_content, user_id, session_id, timestamp, topics,
+                   importance_score, embedding, embedding_model, simhash
+            FROM conversations
+            WHERE ingest_id IN ({placeholders}) AND passage_count IS NULL
+            ORDER BY id ASC
+        """, ingest_ids)
+        positions = self.metadata_store.positions([row[0] for row in rows])
+        rows = [row for row, position in zip(rows, positions) if position < 0]
+        if rows:
+            stale_ids = []
+            self._load_rows(rows, stale_ids)
+            for user_id in {row[2] for row in rows}:
+                self._bump_data_version(user_id)
+    
+    # Message fields written to the ingest log
+    _JOURNAL_FIELDS = (
+        'ingest_id', 'user_id', 'session_id', 'role', 'content', 'timestamp', 'topics', 'importance_score'
+    )
+
+    def _release_pending(self, user_id: str):
+        """Count one of the user's queued messages as done; wakes searches waiting for them"""
+        remaining = self._user_ingest_pending.get(user_id, 0) - 1
+        if remaining > 0:
+            self._user_ingest_pending[user_id] = remaining
+            return
+        self._user_ingest_pending.pop(user_id, None)
+        for waiter in self._indexed_waiters.pop(user_id, []):
+            if not waiter.done():
+                waiter.set_result(None)
+    
+    async def wait_indexed(self, user_id: str, timeout: float):
+        """Wait up to timeout seconds until the user's queued messages are indexed"""
+        loop = asyncio.get_running_loop()
+        if not self._user_ingest_pending.get(user_id) or self._ingest_loop is not loop:
+            return
+        waiter = loop.create_future()
+        self._indexed_waiters.setdefault(user_id, []).append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            logger.debug(f"Messages of user {user_id} still queued after {timeout}s")
+    
+    async def _ingest_batch(self, batch: List[Dict[str, Any]]):
+        """Embed, persist and index a batch of queued messages"""
+        for message in batch:
+            # Extract topics automatically if not provided
+            if message['topics'] is None:
+                message['topics'] = await self._extract_topics(message['content'])
+        
+        # Long messages are embedded and indexed as overlapping passages
+        units = []
+        for message in batch:
+            passages = split_passages(
+                message['content'], settings.KB_PASSAGE_MAX_CHARS, settings.KB_PASSAGE_OVERLAP_CHARS
+            )
+            message['simhash'] = simhash(message['content'])
+            if len(passages) > 1:
+                message['content_hash'] = content_hash(message['content'])
+                message['passages'] = [
+                    {
+                        **message, 'content': passage, 'ingest_id': f"{message['ingest_id']}:{number}",
+                        'simhash': simhash(passage)
+                    }
+                    for number, passage in enumerate(passages)
+                ]
+                units.extend(message['passages'])
+            else:
+                units.append(message)
+        embeddings = await self._embed_messages(units)
+        
+        # Store in database as a single transaction
+        inserted = await self._db.write(self._insert_messages, batch, embeddings)
+        
+        if not inserted:
+            return
+        
+        now = time.time()
+        for message in batch:
+            self._open_sessions[(message['user_id'], message['session_id'])] = now
+        
+        # Add to the users' FAISS indexes and in-memory storage
+        self._add_to_indexes(
+            [message['content'] for _, message, _ in inserted],
+            [
+                {
+                    'id': conversation_id,
+                    'user_id': message['user_id'],
+                    'session_id': message['session_id'],
+                    'timestamp': message['timestamp'],
+                    'topics': message['topics'],
+                    'importance_score': message['importance_score'],
+                    'content_hash': message['content_hash'],
+                    'simhash': message['simhash']
+                }
+                for conversation_id, message, _ in inserted
+            ],
+            np.stack([embedding for _, _, embedding in inserted])
+        )
+        
+        # A queued message changes search results only once it is indexed
+        for user_id in {message['user_id'] for _, message, _ in inserted}:
+            self._bump_data_version(user_id)
+        
+        logger.debug(f"Stored {len(inserted)} conversation messages")
+    
+    async def _embed_messages(self, batch: List[Dict[str, Any]]) -> np.ndarray:
+        """
+        Raw embeddings of queued messages, encoding each distinct text once
+
+        Texts already stored (by content hash, under the current model) reuse
+        their stored vector without an encoder pass.
+        """
+        for message in batch:
+            message['content_hash'] = content_hash(message['content'])
+
+        hashes = list(dict.fromkeys(message['content_hash'] for message in batch))
+        placeholders = ",".join("?" * len(hashes))
+        rows = await self._db.fetchall(f"""
+            SELECT content_hash, embedding FROM conversations
+            WHERE content_hash IN ({placeholders}) AND embedding_model = ? AND embedding IS NOT NULL
+            GROUP BY content_hash
+        """, hashes + [self.embedding_model_name])
+        known = dict(zip(
+            [row[0] for row in rows],
+            decode_embeddings([row[1] for row in rows], self.embedding_dim)
+        ))
+
+        new_texts: Dict[int, str] = {}
+        for message in batch:
+            if message['content_hash'] not in known:
+                new_texts.setdefault(message['content_hash'], message['content'])
+        if new_texts:
+            encoded = await self._encoder.encode(list(new_texts.values()))
+            known.update(zip(new_texts, encoded))
+
+        return np.stack([known[message['content_hash']] for message in batch])
+    
+    def _insert_messages(
+        self,
+        conn: sqlite3.Connection,
+        batch: List[Dict[str, Any]],
+        embeddings: np.ndarray
+    ) -> List[Tuple[int, Dict[str, Any], np.ndarray]]:
+        """
+        Insert queued messages; returns (row id, message, embedding) of the new rows
+
+        embeddings holds one vector per unindexed message or, for a split
+        message, per passage. A split message is stored whole without a
+        vector, followed by its passage rows.
+        """
+        cursor = conn.cursor()
+        
+        def insert(message: Dict[str, Any], embedding: Optional[np.ndarray], parent_id=None, passage_count=None):
+            # Replayed log entries may already be stored
+            cursor.execute("""
+                INSERT OR IGNORE INTO conversations
+                (user_id, session_id, message_role, message_content, timestamp, embedding, topics,
+                 importance_score, embedding_model, ingest_id, content_hash, topic_mask,
+                 parent_id, passage_count, simhash)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                message['user_id'], message['session_id'], message['role'], message['content'],
+                message['timestamp'], None if embedding is None else encode_embedding(embedding),
+                json.dumps(message['topics']), message['importance_score'],
+                None if embedding is None else self.embedding_model_name, message['ingest_id'],
+                message['content_hash'], topic_bitmask(message['topics']),
+                parent_id, passage_count, message['simhash']
+            ))
+            return cursor.lastrowid if cursor.rowcount else None
+        
+        inserted = []
+        embeddings = iter(embeddings)
+        for message in batch:
+            if 'passages' not in message:
+                embedding = next(embeddings)
+                conversation_id = insert(message, embedding)
+                if conversation_id is not None:
+                    inserted.append((conversation_id, message, embedding))
+                continue
             
-        except Exception as e:
-            logger.error(f"Error storing conversation message: {e}")
+            passage_embeddings = [next(embeddings) for _ in message['passages']]
+            parent_id = insert(message, None, passage_count=len(message['passages']))
+            if parent_id is None:
+                continue
+            for passage, embedding in zip(message['passages'], passage_embeddings):
+                inserted.append((insert(passage, embedding, parent_id=parent_id), passage, embedding))
+        return inserted
     
-    async def _extract_topics(self, content: str) -> List[str]:
-        """Extract topics from conversation content"""
-        topics = []
+    async def _replay_ingest_log(self):
+        """Re-queue messages journaled but not committed before the last shutdown"""
+        if not self.ingest_log_path.exists():
+            return
         
-        # Simple keyword-based topic extraction
-        fitness_keywords = {
-            'workout': ['workout', 'exercise', 'training', 'тренировка', 'упражнение'],
-            'nutrition': ['nutrition', 'diet', 'food', 'eating', 'питание', 'диета', 'еда'],
-            'muscle_groups': ['chest', 'back', 'legs', 'arms', 'shoulders', 'abs', 'грудь', 'спина', 'ноги', 'руки', 'плечи', 'пресс'],
-            'equipment': ['gym', 'weights', 'dumbbells', 'barbell', 'тренажер', 'штанга', 'гантели'],
-            'goals': ['weight loss', 'muscle gain', 'strength', 'похудение', 'набор массы', 'сила']
-        }
+        messages = []
+        with open(self.ingest_log_path, encoding='utf-8') as log:
+            for line in log:
+                try:
+                    messages.append(json.loads(line))
+                except ValueError:
+                    # A torn final line from a crash mid-write
+                    continue
+        
+        if not messages:
+            return
         
-        content_lower = content.lower()
+        logger.info(f"Replaying {len(messages)} journaled conversation messages")
+        self._ingest_pending += len(messages)
+        for message in messages:
+            self._user_ingest_pending[message['user_id']] = self._user_ingest_pending.get(message['user_id'], 0) + 1
+        self._ensure_ingest_worker()
+        for message in messages:
+            await self._ingest_queue.put(message)
+    
+    async def flush(self):
+        """Wait until every queued message is stored and indexed"""
+        if self._ingest_queue is not None and self._ingest_loop is asyncio.get_running_loop():
+            await self._ingest_queue.join()
+    
+    async def _extract_topics(self, content: str) -> List[str]:
+        """Extract topics from conversation content"""
         
-        for category, keywords in fitness_keywords.items():
-            if any(keyword in content_lower for keyword in keywords):
-                topics.append(category)
+        # Keyword-based topic extraction in one pass over the text
+        topics, _ = KEYWORD_MATCHER.scan(content.lower())
         
         return topics if topics else ['general']
     
@@ -287,56 +3214,130 @@ class ConversationKnowledgeBase:
         user_id: str,
         max_results: int = 5,
         time_window_days: int = 30,
-        min_similarity: float = 0.4
+        min_similarity: float = 0.4,
+        topics: Optional[List[str]] = None,
+        boost_topics: Optional[List[str]] = None
     ) -> List[Dict[str, Any]]:
         """
         Search for relevant conversation context using hybrid approach
         Combines semantic and keyword search for better Russian language support
         """
+        results = await self.search_relevant_context_many(
+            [query], user_id, max_results, time_window_days, min_similarity, [topics], [boost_topics]
+        )
+        return results[0] if results else []
+
+    async def search_relevant_context_many(
+        self,
+        queries: List[str],
+        user_id: str,
+        max_results: Union[int, List[int]] = 5,
+        time_window_days: Union[int, List[int]] = 30,
+        min_similarity: Union[float, List[float]] = 0.4,
+        topics: Optional[List[Optional[List[str]]]] = None,
+        boost_topics: Optional[List[Optional[List[str]]]] = None
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        Hybrid search for several queries of one user at once
+
+        All queries are encoded in one batch and run through one batched FAISS
+        search; the lexical arms of every query run concurrently. The options
+        take one value for all queries or a list with one value per query.
+        topics optionally scopes each query to messages tagged with any of
+        its topics (vocabulary topics only; None or no known topic means
+        unscoped); boost_topics instead ranks messages tagged with them
+        higher without dropping the others. Returns each query's results, in
+        query order.
+        """
         
         if not self._initialized:
             logger.warning("Knowledge base not initialized for search")
+            return [[] for _ in queries]
+        
+        if not queries:
             return []
         
         try:
-            # Get all results from both search methods
-            semantic_results = await self._semantic_search(query, user_id, max_results * 2)
-            keyword_results = await self._keyword_search(query, user_id, max_results * 2)
+            await self._ensure_resident(user_id)
+            max_results = self._per_query(max_results, len(queries))
+            time_window_days = self._per_query(time_window_days, len(queries))
+            min_similarity = self._per_query(min_similarity, len(queries))
+            topic_masks = [
+                topic_bitmask(query_topics, vocabulary_only=True)
+                for query_topics in (topics if topics is not None else [None] * len(queries))
+            ]
+            boost_masks = [
+                topic_bitmask(query_topics, vocabulary_only=True)
+                for query_topics in (boost_topics if boost_topics is not None else [None] * len(queries))
+            ]
+            if len(topic_masks) != len(queries) or len(boost_masks) != len(queries):
+                raise ValueError(f"Expected {len(queries)} per-query topic lists")
             
-            # Add direct content search fallback for better reliability
-            direct_results = await self._direct_content_search(query, user_id, max_results)
-            
-            # Combine and deduplicate results
-            combined_results = self._combine_and_deduplicate_results(
-                semantic_results, keyword_results, direct_results, query
+            # The arms overlap: encoding, FAISS and SQLite reads all run off the loop
+            semantic_batch, lexical_batch = await asyncio.gather(
+                self._semantic_search_many(
+                    queries, user_id, [n * 2 for n in max_results], time_window_days, topic_masks
+                ),
+                asyncio.gather(*(
+                    asyncio.gather(
+                        self._keyword_search(query, user_id, n * 2, topic_mask),
+                        # Direct content search fallback for better reliability
+                        self._direct_content_search(query, user_id, n, topic_mask)
+                    )
+                    for query, n, topic_mask in zip(queries, max_results, topic_masks)
+                ))
             )
             
-            # Filter by time window
-            if time_window_days > 0:
-                combined_results = self._filter_by_time_window(combined_results, time_window_days)
-            
-            # Filter by similarity threshold
-            filtered_results = [r for r in combined_results if r['similarity'] >= min_similarity]
-            
-            # Sort by similarity (highest first) and limit results
-            final_results = sorted(filtered_results, key=lambda x: x['similarity'], reverse=True)[:max_results]
-            
-            logger.debug(f"Found {len(final_results)} relevant contexts for query: {query}")
+            batch_results = []
+            for i, query in enumerate(queries):
+                keyword_results, direct_results = lexical_batch[i]
+                
+                # Fuse by message id
+                combined_results = self._fuse_results({
+                    'semantic': semantic_batch[i],
+                    'keyword': keyword_results,
+                    'direct': direct_results
+                }, boost_masks[i])
+                
+                # Filter by time window
+                if time_window_days[i] > 0:
+                    combined_results = self._filter_by_time_window(combined_results, time_window_days[i])
+                
+                # Filter by similarity threshold; fused order is kept
+                final_results = [r for r in combined_results if r['similarity'] >= min_similarity[i]][:max_results[i]]
+                
+                logger.debug(f"Found {len(final_results)} relevant contexts for query: {query}")
+                batch_results.append(final_results)
             
-            return final_results
+            return batch_results
             
         except Exception as e:
-            logger.error(f"Error in search_relevant_context: {e}")
-            return []
+            logger.error(f"Error in search_relevant_context_many: {e}")
+            return [[] for _ in queries]
+
+    @staticmethod
+    def _per_query(value: Union[Any, List[Any]], count: int) -> List[Any]:
+        """One option value per query, from a shared value or a per-query list"""
+        if isinstance(value, (list, tuple)):
+            if len(value) != count:
+                raise ValueError(f"Expected {count} per-query values, got {len(value)}")
+            return list(value)
+        return [value] * count
 
-    async def _direct_content_search(self, query: str, user_id: str, max_results: int) -> List[Dict[str, Any]]:
+    async def _direct_content_search(
+        self,
+        query: str,
+        user_id: str,
+        max_results: int,
+        topic_mask: int = 0
+    ) -> List[Dict[str, Any]]:
         """
         Direct content search fallback for improved reliability
         Searches for exact phrase matches in conversation content
         """
         
         results = []
-        query_words = query.lower().split()
+        query_words = _TOKEN_PATTERN.findall(query.lower())
         
         # Remove common stop words for better matching
         stop_words = {'и', 'в', 'на', 'с', 'по', 'для', 'к', 'о', 'от', 'за', 'у', 'я', 'ты', 'он', 'она', 'мы', 'они'}
@@ -346,20 +3347,16 @@ class ConversationKnowledgeBase:
             return results
         
         try:
-            for i, (text, metadata) in enumerate(zip(self.conversation_texts, self.conversation_metadata)):
-                # Check user filter
-                if user_id and metadata.get('user_id') != user_id:
-                    continue
-                
-                text_lower = text.lower()
-                
+            candidates = await self._direct_search_candidates(user_id, meaningful_words, max_results, topic_mask)
+            
+            for text, metadata, matched_words in candidates:
                 # Calculate direct match score based on word coverage
-                matched_words = sum(1 for word in meaningful_words if word in text_lower)
-                match_ratio = matched_words / len(meaningful_words) if meaningful_words else 0
+                match_ratio = matched_words / len(meaningful_words)
                 
                 # Bonus for phrase matches
                 phrase_bonus = 0
                 if len(meaningful_words) >= 2:
+                    text_lower = text.lower()
                     # Check for 2-word and 3-word phrases
                     for j in range(len(meaningful_words) - 1):
                         phrase = ' '.join(meaningful_words[j:j+2])
@@ -372,6 +3369,7 @@ class ConversationKnowledgeBase:
                 # Only include if we have meaningful matches
                 if similarity >= 0.3:  # Lower threshold for direct search
                     results.append({
+                        'id': metadata['id'],
                         'content': text,
                         'similarity': similarity,
                         'timestamp': metadata.get('timestamp', ''),
@@ -389,165 +3387,402 @@ class ConversationKnowledgeBase:
             logger.error(f"Error in direct content search: {e}")
             return []
 
-    def _combine_and_deduplicate_results(
-        self, 
-        semantic_results: List[Dict[str, Any]], 
-        keyword_results: List[Dict[str, Any]],
-        direct_results: List[Dict[str, Any]],
-        query: str
-    ) -> List[Dict[str, Any]]:
-        """Combine results from different search methods and remove duplicates"""
-        
-        combined = {}
+    async def _direct_search_candidates(
+        self,
+        user_id: str,
+        words: List[str],
+        max_results: int,
+        topic_mask: int = 0
+    ) -> List[Tuple[str, Dict[str, Any], int]]:
+        """Messages containing at least one of the words, with the number of words matched"""
+        if self._fts_enabled:
+            candidates = []
+            rows = await self._fts_candidates(user_id, words, max_results * 4, topic_mask=topic_mask)
+            for conv_id, content, timestamp, session_id, topics, importance in rows:
+                tokens = set(_TOKEN_PATTERN.findall(content.lower()))
+                matched_words = sum(1 for word in words if self._has_term_prefix(tokens, word))
+                candidates.append((content, {
+                    'id': conv_id,
+                    'timestamp': timestamp,
+                    'session_id': session_id,
+                    'topics': self._parse_topics(topics),
+                    'importance_score': importance
+                }, matched_words))
+            return candidates
         
-        # Add all results to dictionary (content as key to avoid duplicates)
-        for result_list, method in [(semantic_results, 'semantic'), (keyword_results, 'keyword'), (direct_results, 'direct')]:
-            for result in result_list:
-                content = result['content']
-                
-                if content in combined:
-                    # Keep the result with higher similarity
-                    if result['similarity'] > combined[content]['similarity']:
-                        combined[content] = result
-                        combined[content]['match_type'] = method
-                else:
-                    result['match_type'] = method
-                    combined[content] = result
+        # Posting lookups give, per query word, the user's messages containing it
+        word_matches = [self._match_term_prefix(user_id, word) for word in words]
+        candidate_ids = set().union(*word_matches)
+        if topic_mask:
+            candidate_ids &= set(self.metadata_store.topic_ids(user_id, topic_mask).tolist())
+        candidate_ids = sorted(candidate_ids)
+        messages = await self._fetch_messages(candidate_ids)
+        positions = self.metadata_store.positions(candidate_ids)
         
-        return list(combined.values())
+        candidates = []
+        for conversation_id, position in zip(candidate_ids, positions):
+            if position < 0 or conversation_id not in messages:
+                continue
+            content, timestamp = messages[conversation_id]
+            metadata = self.metadata_store.describe(position)
+            metadata['timestamp'] = timestamp
+            matched_words = sum(1 for matches in word_matches if conversation_id in matches)
+            candidates.append((content, metadata, matched_words))
+        return candidates
+    
+    def _fuse_results(self, arms: Dict[str, List[Dict[str, Any]]], boost_mask: int = 0) -> List[Dict[str, Any]]:
+        """
+        Merge the search arms by message id with reciprocal-rank fusion
+
+        Each arm contributes 1 / (KB_RRF_K + rank) per message; the sum is
+        weighted by recency (halving every KB_RRF_RECENCY_HALF_LIFE_DAYS) and
+        by importance_score, and raised by KB_TOPIC_BOOST for messages tagged
+        with a topic of boost_mask. Results keep the best arm's similarity and
+        match_type and are ordered by fused score; near-duplicates (SimHash
+        within KB_NEAR_DUPLICATE_BITS) collapse into the best ranked one.
+        """
+        best: Dict[int, Dict[str, Any]] = {}
+        ids = []
+        ranks = []
+        for method, results in arms.items():
+            for rank, result in enumerate(results):
+                result['match_type'] = method
+                ids.append(result['id'])
+                ranks.append(rank)
+                current = best.get(result['id'])
+                if current is None or result['similarity'] > current['similarity']:
+                    best[result['id']] = result
+
+        if not ids:
+            return []
+
+        unique_ids, inverse = np.unique(np.array(ids, dtype='int64'), return_inverse=True)
+        rrf = np.bincount(inverse, weights=1.0 / (settings.KB_RRF_K + 1 + np.array(ranks)))
+
+        results = [best[int(conv_id)] for conv_id in unique_ids]
+        now = datetime.now().timestamp()
+        timestamps = np.array(
+            [self._parse_timestamp(result['timestamp']) or 0.0 for result in results], dtype='float64'
+        )
+        age_days = np.maximum(now - timestamps, 0) / 86400
+        recency = 0.5 ** (age_days / settings.KB_RRF_RECENCY_HALF_LIFE_DAYS)
+        importance = np.array([result.get('importance_score') or 1.0 for result in results], dtype='float64')
+
+        scores = rrf * (1 + settings.KB_RRF_RECENCY_WEIGHT * recency) * importance ** settings.KB_RRF_IMPORTANCE_WEIGHT
+
+        positions = self.metadata_store.positions(unique_ids)
+        if boost_mask:
+            topic_masks = np.array([
+                int(self.metadata_store.topic_masks[position]) if position >= 0
+                else topic_bitmask(result.get('topics'), vocabulary_only=True)
+                for position, result in zip(positions, results)
+            ], dtype='uint64')
+            scores = scores * np.where(topic_masks & np.uint64(boost_mask) != 0, 1 + settings.KB_TOPIC_BOOST, 1.0)
+
+        # Stored fingerprints where the message is indexed, computed otherwise
+        fingerprints = [
+            int(self.metadata_store.simhashes[position]) if position >= 0 else simhash(result['content'])
+            for position, result in zip(positions, results)
+        ]
+
+        fused = []
+        kept: List[int] = []
+        for position in np.argsort(-scores, kind='stable'):
+            result = results[position]
+            fingerprint = fingerprints[position]
+            if any(hamming_distance(fingerprint, other) <= settings.KB_NEAR_DUPLICATE_BITS for other in kept):
+                continue
+            kept.append(fingerprint)
+            result['score'] = float(scores[position])
+            fused.append(result)
+        return fused
     
-    async def _semantic_search(self, query: str, user_id: str, max_results: int) -> List[Dict[str, Any]]:
+    async def _semantic_search(
+        self,
+        query: str,
+        user_id: str,
+        max_results: int,
+        time_window_days: int = 30
+    ) -> List[Dict[str, Any]]:
         """Semantic search for relevant conversation context"""
+        await self._ensure_resident(user_id)
+        return (await self._semantic_search_many([query], user_id, [max_results], [time_window_days]))[0]
+    
+    async def _semantic_search_many(
+        self,
+        queries: List[str],
+        user_id: str,
+        max_results: List[int],
+        time_window_days: List[int],
+        topic_masks: Optional[List[int]] = None
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        Semantic search for several queries with one encode and one FAISS
+        search per time bucket
+
+        Each query only reaches the user's buckets overlapping its time window
+        (0 means no window); per-bucket hits are merged by similarity. Queries
+        with a topic mask search only the ids of the user's messages tagged
+        with those topics. Queries reaching at least KB_SESSION_ROUTING_MIN_VECTORS
+        vectors first pick the KB_SESSION_CANDIDATES sessions with the most
+        similar centroids and search only their messages (and those of
+        sessions not summarized yet).
+        """
         
-        if not self._initialized or self.faiss_index is None:
+        if not self._initialized:
             logger.warning("Knowledge base not initialized for semantic search")
-            return []
+            return [[] for _ in queries]
+        
+        # Only the user's own partitions are searched
+        if not self.user_indexes.get(user_id):
+            return [[] for _ in queries]
         
         try:
-            faiss = _get_faiss()
+            query_embeddings = await self._embed_queries(queries)
             
-            # Generate query embedding
-            query_embedding = self.embeddings_model.encode([query], convert_to_tensor=False)[0]
-            query_embedding = query_embedding.astype('float32')
-            faiss.normalize_L2(query_embedding.reshape(1, -1))
+            # Long-range queries over many vectors are narrowed to candidate sessions
+            topic_masks = topic_masks or [0] * len(queries)
+            buckets = [self._route_buckets(user_id, days) for days in time_window_days]
+            sessions: List[Optional[Tuple[str, ...]]] = [None] * len(queries)
+            summarized = self.session_summaries.sessions(user_id)
+            if self._sessions_caught_up and len(summarized) > settings.KB_SESSION_CANDIDATES:
+                reached = [
+                    sum(self.user_indexes[user_id][bucket].ntotal for bucket in query_buckets)
+                    for query_buckets in buckets
+                ]
+                wide = [row for row, total in enumerate(reached) if total >= settings.KB_SESSION_ROUTING_MIN_VECTORS]
+                if wide:
+                    candidates = self.session_summaries.candidates(
+                        user_id, query_embeddings[wide], settings.KB_SESSION_CANDIDATES
+                    )
+                    for row, candidate_sessions in zip(wide, candidates):
+                        sessions[row] = tuple(sorted(candidate_sessions))
             
-            # Search in FAISS index
-            similarities, indices = self.faiss_index.search(query_embedding.reshape(1, -1), max_results)
+            # Route every query to its buckets; each bucket searches the queries
+            # routed to it, once per distinct scope (topics, candidate sessions)
+            scopes = list(zip(topic_masks, sessions))
+            routed: Dict[Tuple[str, Tuple], List[int]] = {}
+            for row, (query_buckets, scope) in enumerate(zip(buckets, scopes)):
+                for bucket in query_buckets:
+                    routed.setdefault((bucket, scope), []).append(row)
             
-            # Prepare semantic results
-            semantic_results = []
-            current_time = datetime.now()
+            # Per scope: the user's ids tagged with the topics (bitmap column)
+            # and in the candidate or not yet summarized sessions
+            open_sessions = {session for user, session in self._open_sessions if user == user_id}
+            scope_ids: Dict[Tuple, np.ndarray] = {}
+            for topic_mask, candidate_sessions in set(scopes):
+                ids = None
+                if topic_mask:
+                    ids = self.metadata_store.topic_ids(user_id, topic_mask)
+                if candidate_sessions is not None:
+                    session_ids = self.metadata_store.session_ids(
+                        user_id, list(candidate_sessions), [s for s in summarized if s not in open_sessions]
+                    )
+                    ids = session_ids if ids is None else np.intersect1d(ids, session_ids)
+                if ids is not None:
+                    scope_ids[(topic_mask, candidate_sessions)] = ids
             
-            for i, (similarity, idx) in enumerate(zip(similarities[0], indices[0])):
-                if idx == -1 or similarity < 0.3:
-                    continue
-                
-                if idx >= len(self.conversation_metadata):
-                    continue
-                
-                metadata = self.conversation_metadata[idx]
-                
-                # Filter by user and time window
-                if metadata['user_id'] != user_id:
-                    continue
-                
-                try:
-                    msg_time = datetime.fromisoformat(metadata['timestamp'])
-                    if msg_time < current_time - timedelta(days=30):
-                        continue
-                except:
-                    continue
-                
-                semantic_results.append({
-                    'content': self.conversation_texts[idx],
-                    'similarity': float(similarity),
-                    'timestamp': metadata['timestamp'],
-                    'session_id': metadata['session_id'],
-                    'topics': metadata.get('topics', []),
-                    'importance_score': metadata.get('importance_score', 1.0),
-                    'match_type': 'semantic'
-                })
+            limits = np.array(max_results)
+            searches = []
+            for (bucket, scope), rows in routed.items():
+                partition = (user_id, bucket)
+                index = self.user_indexes[user_id][bucket]
+                k = int(limits[rows].max())
+                params = None
+                if scope in scope_ids:
+                    # Scope ids are live rows, so the selector skips tombstoned vectors
+                    k = min(k, len(scope_ids[scope]), index.ntotal)
+                    params = self._filtered_search_params(partition, index, scope_ids[scope], k)
+                else:
+                    # Tombstoned vectors still rank among the hits and are dropped below
+                    k = min(k + self._tombstones.get(partition, 0), index.ntotal)
+                if k > 0:
+                    searches.append((partition, rows, index, k, params))
+            
+            loop = asyncio.get_running_loop()
+            hits = await asyncio.gather(*(
+                loop.run_in_executor(
+                    None, self._search_index, partition, index, query_embeddings[rows], k, params
+                )
+                for partition, rows, index, k, params in searches
+            ))
             
-            return semantic_results
+            # Merge the buckets' hits per query, best first
+            width = sum(search[3] for search in searches)
+            similarities = np.full((len(queries), width), -np.inf, dtype='float32')
+            ids = np.full((len(queries), width), -1, dtype='int64')
+            column = 0
+            for (_, rows, _, k, _), (bucket_similarities, bucket_ids) in zip(searches, hits):
+                similarities[rows, column:column + k] = bucket_similarities
+                ids[rows, column:column + k] = bucket_ids
+                column += k
+            order = np.argsort(-similarities, axis=1, kind='stable')
+            similarities = np.take_along_axis(similarities, order, axis=1)
+            ids = np.take_along_axis(ids, order, axis=1)
+            
+            # Filter by rank, similarity and time window as one vectorized mask
+            now = datetime.now()
+            cutoffs = np.array([
+                (now - timedelta(days=days)).timestamp() if days > 0 else -np.inf
+                for days in time_window_days
+            ])
+            positions = self.metadata_store.positions(ids)
+            live = (ids != -1) & (positions >= 0)
+            keep = live & (similarities >= 0.3)
+            keep &= np.cumsum(live, axis=1) <= limits[:, None]
+            keep[keep] &= self.metadata_store.timestamps[positions[keep]] >= np.broadcast_to(cutoffs[:, None], ids.shape)[keep]
+            
+            # One SQLite read for the text of every query's hits
+            messages = await self._fetch_messages(np.unique(ids[keep]).tolist())
+            return [
+                self._format_results(positions[row][keep[row]], similarities[row][keep[row]], 'semantic', messages)
+                for row in range(len(queries))
+            ]
             
         except Exception as e:
             logger.error(f"Error in semantic search: {e}")
-            return []
+            return [[] for _ in queries]
+    
+    async def _embed_queries(self, queries: List[str]) -> np.ndarray:
+        """
+        Normalized (n, dim) query vectors, served from the query cache when possible
+
+        Cache misses are encoded together in one batch. The normalized query
+        text is what gets encoded, so every spelling that maps to one cache
+        key also maps to one vector.
+        """
+        keys = [normalize_text(query) for query in queries]
+        vectors = {key: self.query_cache.get(key) for key in dict.fromkeys(keys)}
+        
+        missing = [key for key, vector in vectors.items() if vector is None]
+        if missing:
+            embeddings = np.array(await self._encoder.encode(missing), dtype='float32')
+            _get_faiss().normalize_L2(embeddings)
+            for key, embedding in zip(missing, embeddings):
+                vectors[key] = embedding
+                self.query_cache.put(key, embedding)
+        
+        return np.stack([vectors[key] for key in keys])
     
-    async def _keyword_search(self, query: str, user_id: str, max_results: int) -> List[Dict[str, Any]]:
+    async def _keyword_search(
+        self,
+        query: str,
+        user_id: str,
+        max_results: int,
+        topic_mask: int = 0
+    ) -> List[Dict[str, Any]]:
         """Keyword-based search for better Russian language support"""
         
         # Extract keywords from query
-        query_words = query.lower().split()
+        query_words = _TOKEN_PATTERN.findall(query.lower())
         keyword_results = []
+        total_words = len(query_words)
         
-        current_time = datetime.now()
+        if total_words == 0:
+            return keyword_results
         
-        # Search through conversation texts
-        for i, text in enumerate(self.conversation_texts):
-            metadata = self.conversation_metadata[i]
-            
-            # Filter by user and time
-            if metadata['user_id'] != user_id:
-                continue
-                
-            try:
-                msg_time = datetime.fromisoformat(metadata['timestamp'])
-                if msg_time < current_time - timedelta(days=30):
-                    continue
-            except:
+        if self._fts_enabled:
+            return await self._keyword_search_fts(query_words, user_id, max_results, topic_mask)
+        
+        cutoff_ts = (datetime.now() - timedelta(days=30)).timestamp()
+        
+        # Score only messages reachable from the query's posting lists
+        scores: Dict[int, float] = {}
+        for word in query_words:
+            if len(word) < 3:  # Only consider words with 3+ characters
                 continue
             
-            text_lower = text.lower()
-            
-            # Calculate keyword match score
-            keyword_score = 0.0
-            total_words = len(query_words)
-            
-            for word in query_words:
-                if len(word) >= 3:  # Only consider words with 3+ characters
-                    # Exact match
-                    if word in text_lower:
-                        keyword_score += 1.0
-                    # Partial match (Russian word stems)
-                    elif len(word) >= 4:
-                        word_stem = word[:4]  # Simple stemming
-                        if word_stem in text_lower:
-                            keyword_score += 0.5
-            
-            if total_words > 0:
-                keyword_score = keyword_score / total_words
-            
-            # Boost score for important keywords
-            boost_keywords = {
-                'регулярн': 2.0,
-                'вод': 1.5,
-                'пить': 1.5,
-                'здоровь': 1.3,
-                'совет': 1.3,
-                'важно': 1.2
-            }
+            # Exact match
+            exact_ids = self._match_term_prefix(user_id, word)
+            for conversation_id in exact_ids:
+                scores[conversation_id] = scores.get(conversation_id, 0.0) + 1.0
             
-            for boost_word, boost_factor in boost_keywords.items():
-                if boost_word in text_lower:
-                    keyword_score *= boost_factor
+            # Partial match (Russian word stems)
+            if len(word) >= 4:
+                word_stem = stem_russian(word)
+                for conversation_id in self._match_term_prefix(user_id, word_stem) - exact_ids:
+                    scores[conversation_id] = scores.get(conversation_id, 0.0) + 0.5
+        
+        if not scores:
+            return keyword_results
+        
+        # Boost score for important keywords: one combined factor per message
+        boosts: Dict[int, float] = {}
+        for boost_word, boost_factor in KEYWORD_BOOSTS.items():
+            for conversation_id in self._match_term_prefix(user_id, boost_word) & scores.keys():
+                boosts[conversation_id] = boosts.get(conversation_id, 1.0) * boost_factor
+        
+        candidate_ids = np.fromiter(scores, dtype='int64', count=len(scores))
+        positions = self.metadata_store.positions(candidate_ids)
+        
+        # Filter by time and topics
+        keep = positions >= 0
+        keep[keep] &= self.metadata_store.timestamps[positions[keep]] >= cutoff_ts
+        if topic_mask:
+            keep[keep] &= self.metadata_store.topic_masks[positions[keep]] & np.uint64(topic_mask) != 0
+        
+        scored = []
+        for conversation_id, position in zip(candidate_ids[keep].tolist(), positions[keep]):
+            keyword_score = scores[conversation_id] / total_words * boosts.get(conversation_id, 1.0)
             
             # Only include if there's a meaningful match
             if keyword_score > 0.3:
                 # Convert keyword score to similarity-like score
-                similarity_score = min(0.9, keyword_score)  # Cap at 0.9 to distinguish from semantic
-                
+                scored.append((min(0.9, keyword_score), position))  # Cap at 0.9 to distinguish from semantic
+        
+        # Sort by score and fetch text only for the returned top results
+        scored.sort(key=lambda x: x[0], reverse=True)
+        scored = scored[:max_results]
+        return await self._build_results(
+            np.array([position for _, position in scored], dtype='int64'),
+            [score for score, _ in scored],
+            'keyword'
+        )
+    
+    async def _keyword_search_fts(
+        self,
+        query_words: List[str],
+        user_id: str,
+        max_results: int,
+        topic_mask: int = 0
+    ) -> List[Dict[str, Any]]:
+        """Keyword search over the FTS5 index with stemmed terms and BM25 ranking"""
+        
+        words = [word for word in query_words if len(word) >= 3]
+        cutoff_time = datetime.now() - timedelta(days=30)
+        
+        # BM25 picks the candidates; the similarity-like score keeps the arms comparable
+        rows = await self._fts_candidates(user_id, words, max_results * 4, since=cutoff_time, topic_mask=topic_mask)
+        
+        keyword_results = []
+        for conv_id, content, timestamp, session_id, topics, importance in rows:
+            content_lower = content.lower()
+            tokens = set(_TOKEN_PATTERN.findall(content_lower))
+            
+            keyword_score = 0.0
+            for word in words:
+                if self._has_term_prefix(tokens, word):
+                    keyword_score += 1.0
+                elif self._has_term_prefix(tokens, stem_russian(word)):
+                    keyword_score += 0.5
+            keyword_score /= len(query_words)
+            
+            _, boost_factor = KEYWORD_MATCHER.scan(content_lower)
+            keyword_score *= boost_factor
+            
+            if keyword_score > 0.3:
                 keyword_results.append({
-                    'content': text,
-                    'similarity': similarity_score,
-                    'timestamp': metadata['timestamp'],
-                    'session_id': metadata['session_id'],
-                    'topics': metadata.get('topics', []),
-                    'importance_score': metadata.get('importance_score', 1.0),
+                    'id': conv_id,
+                    'content': content,
+                    'similarity': min(0.9, keyword_score),
+                    'timestamp': timestamp,
+                    'session_id': session_id,
+                    'topics': self._parse_topics(topics),
+                    'importance_score': importance,
                     'match_type': 'keyword'
                 })
         
-        # Sort by score and return top results
+        # Stable sort: ties keep their BM25 order
         keyword_results.sort(key=lambda x: x['similarity'], reverse=True)
         return keyword_results[:max_results]
     
@@ -587,56 +3822,35 @@ class ConversationKnowledgeBase:
             return {"summary": "Knowledge base not initialized", "message_count": 0}
         
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
             # Get recent conversations
             cutoff_date = datetime.now() - timedelta(days=days_back)
             
             if session_id:
-                cursor.execute("""
-                    SELECT message_content, timestamp, topics 
-                    FROM conversations 
-                    WHERE user_id = ? AND session_id = ? AND timestamp >= ?
-                    AND message_role != 'system'
-                    ORDER BY timestamp DESC
-                """, (user_id, session_id, cutoff_date.isoformat()))
+                message_count, topic_counts = await self._count_topics(user_id, cutoff_date, session_id=session_id)
             else:
-                cursor.execute("""
-                    SELECT message_content, timestamp, topics 
-                    FROM conversations 
-                    WHERE user_id = ? AND timestamp >= ?
-                    AND message_role != 'system'
-                    ORDER BY timestamp DESC
-                """, (user_id, cutoff_date.isoformat()))
-            
-            rows = cursor.fetchall()
-            conn.close()
+                # Whole days come from the rollups; only the partial first day
+                # is counted from the messages themselves
+                next_day = datetime.combine(cutoff_date.date() + timedelta(days=1), datetime.min.time())
+                (message_count, topic_counts), rollups = await asyncio.gather(
+                    self._count_topics(user_id, cutoff_date, until=next_day),
+                    self._db.fetchall("""
+                        SELECT topic, SUM(message_count) FROM conversation_rollups
+                        WHERE user_id = ? AND day >= ?
+                        GROUP BY topic
+                    """, (user_id, next_day.date().isoformat()))
+                )
+                for topic, count in rollups:
+                    if topic:
+                        topic_counts[topic] = topic_counts.get(topic, 0) + count
+                    else:
+                        message_count += count
             
-            if not rows:
+            if not message_count:
                 return {"summary": "No recent conversations found", "message_count": 0}
             
-            # Analyze topics
-            all_topics = []
-            messages = []
-            
-            for content, timestamp, topics_json in rows:
-                messages.append(content)
-                if topics_json:
-                    try:
-                        topics = json.loads(topics_json)
-                        all_topics.extend(topics)
-                    except:
-                        pass
-            
-            # Count topic frequency
-            topic_counts = {}
-            for topic in all_topics:
-                topic_counts[topic] = topic_counts.get(topic, 0) + 1
-            
             # Generate summary
             summary_parts = []
-            summary_parts.append(f"Analyzed {len(messages)} messages from the last {days_back} days.")
+            summary_parts.append(f"Analyzed {message_count} messages from the last {days_back} days.")
             
             if topic_counts:
                 top_topics = sorted(topic_counts.items(), key=lambda x: x[1], reverse=True)[:3]
@@ -645,7 +3859,7 @@ class ConversationKnowledgeBase:
             
             return {
                 "summary": " ".join(summary_parts),
-                "message_count": len(messages),
+                "message_count": message_count,
                 "topics": topic_counts,
                 "period_days": days_back
             }
@@ -654,32 +3868,114 @@ class ConversationKnowledgeBase:
             logger.error(f"Error generating conversation summary: {e}")
             return {"summary": f"Error generating summary: {e}", "message_count": 0}
     
+    async def _count_topics(
+        self,
+        user_id: str,
+        since: datetime,
+        until: Optional[datetime] = None,
+        session_id: Optional[str] = None
+    ) -> Tuple[int, Dict[str, int]]:
+        """Number of non-system messages in [since, until) and their topic frequencies"""
+        # Messages grouped by topic bitmask; the JSON topics are only read
+        # for rows with topics outside the vocabulary (or no mask yet)
+        sql = """
+            SELECT topic_mask, COUNT(*),
+                   CASE WHEN topic_mask IS NULL OR (topic_mask & ?) != 0 THEN topics END AS other_topics
+            FROM conversations
+            WHERE user_id = ? AND timestamp >= ?
+            AND message_role != 'system' AND parent_id IS NULL
+        """
+        params: List[Any] = [1 << OTHER_TOPICS_BIT, user_id, since.isoformat()]
+        if until is not None:
+            sql += " AND timestamp < ?"
+            params.append(until.isoformat())
+        if session_id:
+            sql += " AND session_id = ?"
+            params.append(session_id)
+        rows = await self._db.fetchall(sql + " GROUP BY topic_mask, other_topics", params)
+        
+        topic_counts = {}
+        for topic_mask, count, other_topics in rows:
+            topics = self._parse_topics(other_topics) if other_topics is not None else topics_for_bitmask(topic_mask or 0)
+            for topic in topics:
+                topic_counts[topic] = topic_counts.get(topic, 0) + count
+        return sum(count for _, count, _ in rows), topic_counts
+    
+    async def close(self):
+        """Drain the ingest queue and stop background workers; call on application shutdown"""
+        await self.flush()
+        if self._storage_migration_task is not None:
+            self._storage_migration_task.cancel()
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+            self._snapshot_task = None
+        if self._session_task is not None:
+            self._session_task.cancel()
+            self._session_task = None
+        if self._initialized and settings.KB_SNAPSHOT_ENABLED and self._changes_since_snapshot:
+            try:
+                await self.save_snapshot()
+            except Exception as e:
+                logger.error(f"Error writing knowledge base snapshot: {e}")
+        if self._ingest_worker is not None and not self._ingest_worker.done():
+            self._ingest_worker.cancel()
+            try:
+                await self._ingest_worker
+            except asyncio.CancelledError:
+                pass
+        await self._encoder.close()
+        self._db.close()
+    
     async def cleanup_old_conversations(self, days_to_keep: int = 90):
-        """Clean up old conversation data"""
+        """
+        Clean up old conversation data
+
+        Deleted rows are removed from the loaded indexes incrementally, so the
+        cost follows the number of deleted rows rather than the corpus size.
+        """
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
             cutoff_date = datetime.now() - timedelta(days=days_to_keep)
             
-            cursor.execute("""
-                DELETE FROM conversations 
-                WHERE timestamp < ?
-            """, (cutoff_date.isoformat(),))
+            deleted = await self._db.write(self._delete_conversations_before, cutoff_date.isoformat())
+            for user_id, session_id in await self._db.write(self._delete_session_summaries_before, cutoff_date.isoformat()):
+                self.session_summaries.discard(user_id, session_id)
             
-            deleted_count = cursor.rowcount
-            conn.commit()
-            conn.close()
+            logger.info(f"Cleaned up {len(deleted)} old conversation records")
             
-            logger.info(f"Cleaned up {deleted_count} old conversation records")
+            if deleted:
+                self._data_epoch += 1
             
-            # Rebuild FAISS index after cleanup
-            if self._initialized:
-                await self._load_conversations_to_faiss()
+            if self._initialized and deleted:
+                removed: Dict[str, List[int]] = {}
+                for conv_id, user_id in deleted:
+                    removed.setdefault(user_id, []).append(conv_id)
+                self._remove_from_indexes(removed)
+            
+            # Only now: removal skips the vectors superseded rows never had
+            self._superseded.difference_update(conv_id for conv_id, _ in deleted)
             
         except Exception as e:
             logger.error(f"Error cleaning up conversations: {e}")
 
+    
+    @staticmethod
+    def _delete_conversations_before(conn: sqlite3.Connection, cutoff: str) -> List[Tuple[int, str]]:
+        """Delete rows older than cutoff; returns (id, user_id) of the deleted rows"""
+        deleted = conn.execute(
+            "SELECT id, user_id FROM conversations WHERE timestamp < ?", (cutoff,)
+        ).fetchall()
+        conn.execute("DELETE FROM conversations WHERE timestamp < ?", (cutoff,))
+        return deleted
+
+    @staticmethod
+    def _delete_session_summaries_before(conn: sqlite3.Connection, cutoff: str) -> List[Tuple[str, str]]:
+        """Delete summaries of sessions with no message since cutoff; returns their (user_id, session_id)"""
+        deleted = conn.execute(
+            "SELECT user_id, session_id FROM session_summaries WHERE last_timestamp < ?", (cutoff,)
+        ).fetchall()
+        conn.execute("DELETE FROM session_summaries WHERE last_timestamp < ?", (cutoff,))
+        return deleted
+
 
 # Global instance
 knowledge_base = ConversationKnowledgeBase() 
\ No newline at end of file
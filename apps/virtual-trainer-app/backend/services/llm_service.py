@@ -410,38 +410,22 @@ class LLMService:
                     ]
                 })
                 
-                # Execute each tool call
-                for tool_call in response.choices[0].message.tool_calls:
-                    try:
-                        function_name = tool_call.function.name
-                        function_args = json.loads(tool_call.function.arguments)
-                        
-                        logger.info(f"Executing tool: {function_name} with args: {function_args}")
-                        
-                        # Execute the tool
-                        tool_result = await rag_tools.execute_tool(
-                            tool_name=function_name,
-                            tool_arguments=function_args,
-                            user_id=user_id,
-                            session_id=session_id,
-                            current_session_context=messages  # Pass current conversation context
-                        )
-                        
-                        # Add tool result to conversation
-                        messages.append({
-                            "role": "tool",
-                            "tool_call_id": tool_call.id,
-                            "content": json.dumps(tool_result, ensure_ascii=False)
-                        })
-                        
-                    except Exception as e:
-                        logger.error(f"Error executing tool {tool_call.function.name}: {e}")
-                        # Add error message
-                        messages.append({
-                            "role": "tool",
-                            "tool_call_id": tool_call.id,
-                            "content": json.dumps({"error": str(e)}, ensure_ascii=False)
-                        })
+                # Execute the tool calls; their searches run as one batch
+                tool_calls = response.choices[0].message.tool_calls
+                tool_results = await rag_tools.execute_tools(
+                    tool_calls=[(tool_call.function.name, tool_call.function.arguments) for tool_call in tool_calls],
+                    user_id=user_id,
+                    session_id=session_id,
+                    current_session_context=messages  # Pass current conversation context
+                )
+                
+                # Add tool results to conversation
+                for tool_call, tool_result in zip(tool_calls, tool_results):
+                    messages.append({
+                        "role": "tool",
+                        "tool_call_id": tool_call.id,
+                        "content": json.dumps(tool_result, ensure_ascii=False)
+                    })
                 
                 # Get final response after tool execution
                 final_response = await self.client.chat.completions.create(
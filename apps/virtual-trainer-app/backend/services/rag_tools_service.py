@@ -3,15 +3,74 @@ RAG Tools Service for AI Function Calling
 Provides tools for AI to access conversation knowledge base
 """
 
+import copy
 import json
-from typing import List, Dict, Any, Optional
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple, Union
 from datetime import datetime, timedelta
 from loguru import logger
 
-from backend.services.knowledge_base_service import knowledge_base
+from backend.core.config import settings
+from backend.services.knowledge_base_service import knowledge_base, query_topics
 from backend.core.exceptions import LLMServiceError
 
 
+class ToolResultCache:
+    """
+    LRU cache of RAG tool results with a time-to-live
+
+    Entries are keyed by user, tool and normalized arguments and remember the
+    knowledge base data version of the user they were computed at; a new
+    message of the user changes the version once it is indexed, so older
+    entries miss.
+    """
+    
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: 'OrderedDict[Tuple, Tuple[float, Any, Dict[str, Any]]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+    
+    def get(self, key: Tuple, version: Any) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] == version and time.monotonic() - entry[0] < self.ttl_seconds:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(entry[2])
+        
+        if entry is not None:
+            if entry[1] != version:
+                self.invalidations += 1
+            del self._entries[key]
+        self.misses += 1
+        return None
+    
+    def record_hit(self):
+        """Count a lookup answered without a search outside the cache, e.g. a repeated call"""
+        self.hits += 1
+    
+    def put(self, key: Tuple, version: Any, result: Dict[str, Any]):
+        if self.max_size <= 0:
+            return
+        self._entries[key] = (time.monotonic(), version, copy.deepcopy(result))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+
 class RAGToolsService:
     """
     Service providing tools for AI to access conversation knowledge base
@@ -41,6 +100,11 @@ class RAGToolsService:
                                 "type": "integer", 
                                 "description": "Search within this many days back (default: 30)",
                                 "default": 30
+                            },
+                            "expand_passages": {
+                                "type": "boolean",
+                                "description": "Long past replies are matched by passage; set to true to get the complete messages instead of the matching passages (default: false)",
+                                "default": False
                             }
                         },
                         "required": ["query"]
@@ -94,17 +158,252 @@ class RAGToolsService:
             }
         }
     
+        self.result_cache = ToolResultCache(
+            max_size=settings.KB_TOOL_CACHE_SIZE,
+            ttl_seconds=settings.KB_TOOL_CACHE_TTL_SECONDS
+        )
+    
     def get_tool_definitions(self) -> List[Dict[str, Any]]:
         """Get tool definitions for OpenAI function calling"""
         return list(self.available_tools.values())
     
-    async def execute_tool(
+    def get_cache_stats(self) -> Dict[str, Any]:
+        """Hit-rate metrics of the tool result cache"""
+        return self.result_cache.stats()
+    
+    def _cache_key(
         self,
         tool_name: str,
         tool_arguments: Dict[str, Any],
         user_id: str,
+        session_id: Optional[str],
+        current_session_context: Optional[List[Dict[str, str]]]
+    ) -> Optional[Tuple]:
+        """
+        Cache key of a tool call, or None for calls that aren't cached
+        
+        Arguments are completed with the tool's defaults and strings are
+        case- and whitespace-normalized, so repeated calls phrased slightly
+        differently share an entry.
+        """
+        tool = self.available_tools.get(tool_name)
+        if tool is None:
+            return None
+        
+        arguments = {
+            name: schema["default"]
+            for name, schema in tool["function"]["parameters"]["properties"].items()
+            if "default" in schema
+        }
+        arguments.update(tool_arguments)
+        arguments = {
+            name: " ".join(value.lower().split()) if isinstance(value, str) else value
+            for name, value in arguments.items()
+        }
+        
+        # History search also matches the current session's messages; only
+        # their texts matter, not tool calls and results added during the turn
+        context = None
+        if tool_name == "search_conversation_history" and current_session_context:
+            context = json.dumps(
+                [
+                    (message["role"], message["content"])
+                    for message in self._conversation_messages(current_session_context)
+                ],
+                ensure_ascii=False
+            )
+        
+        return (
+            user_id, session_id, tool_name,
+            json.dumps(arguments, sort_keys=True, ensure_ascii=False, default=str), context
+        )
+    
+    @staticmethod
+    def _conversation_messages(current_session_context: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """User and assistant messages of the session that carry text"""
+        return [
+            message for message in current_session_context
+            if message.get("role") in ("user", "assistant")
+            and message.get("content") and isinstance(message.get("content"), str)
+        ]
+    
+    async def execute_tools(
+        self,
+        tool_calls: List[Tuple[str, Union[str, Dict[str, Any]]]],
+        user_id: str,
         session_id: str = None,
         current_session_context: List[Dict[str, str]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Execute several RAG tool calls of one model turn
+        
+        The knowledge base searches of all calls run as one batch, so N
+        search tools cost one encode and one vector search instead of N.
+        Calls repeated since the user's last indexed message are served from
+        the result cache, and identical calls within the batch run once.
+        
+        Args:
+            tool_calls: (tool name, arguments) pairs; arguments may be a JSON string
+            user_id: User ID for filtering
+            session_id: Session ID for context
+            current_session_context: Current session messages for immediate context
+            
+        Returns:
+            Tool execution results, in call order
+        """
+        
+        parsed_calls = []
+        for tool_name, tool_arguments in tool_calls:
+            try:
+                if isinstance(tool_arguments, str):
+                    tool_arguments = json.loads(tool_arguments)
+                if not isinstance(tool_arguments, dict):
+                    raise ValueError(f"Tool arguments must be a JSON object, got {type(tool_arguments).__name__}")
+                parsed_calls.append((tool_name, tool_arguments, None))
+            except Exception as e:
+                logger.error(f"Error parsing arguments of tool {tool_name}: {e}")
+                parsed_calls.append((tool_name, None, {"error": str(e)}))
+        
+        # The turn's own message is usually still queued; searching after it is
+        # indexed keeps the version stable until the user's next message
+        await knowledge_base.wait_indexed(user_id, settings.KB_TOOL_INDEX_WAIT_SECONDS)
+        # Read before executing: a message indexed meanwhile makes these results stale
+        version = knowledge_base.data_version(user_id)
+        cache_keys = []
+        cached = []
+        first_call = {}
+        for index, (tool_name, tool_arguments, error) in enumerate(parsed_calls):
+            key = None
+            if error is None:
+                key = self._cache_key(tool_name, tool_arguments, user_id, session_id, current_session_context)
+            cache_keys.append(key)
+            if key is not None and key in first_call:
+                # A repeat within the batch shares the first call's result
+                self.result_cache.record_hit()
+                cached.append(None)
+                continue
+            if key is not None:
+                first_call[key] = index
+            cached.append(self.result_cache.get(key, version) if key is not None else None)
+        
+        # Cached and repeated calls need no search
+        search_results = await self._prefetch_searches(
+            [
+                (tool_name, tool_arguments or {})
+                if hit is None and (key is None or first_call[key] == index) else ("", {})
+                for index, ((tool_name, tool_arguments, _), key, hit) in enumerate(
+                    zip(parsed_calls, cache_keys, cached)
+                )
+            ],
+            user_id
+        )
+        
+        results = []
+        for index, ((tool_name, tool_arguments, error), prefetched, key, hit) in enumerate(zip(
+            parsed_calls, search_results, cache_keys, cached
+        )):
+            if error is not None:
+                results.append(error)
+                continue
+            if key is not None and first_call[key] != index:
+                results.append(copy.deepcopy(results[first_call[key]]))
+                continue
+            if hit is not None:
+                logger.info(f"Tool result cache hit: {tool_name} with args: {tool_arguments}")
+                results.append(hit)
+                continue
+            
+            logger.info(f"Executing tool: {tool_name} with args: {tool_arguments}")
+            result = await self.execute_tool(
+                tool_name=tool_name,
+                tool_arguments=tool_arguments,
+                user_id=user_id,
+                session_id=session_id,
+                current_session_context=current_session_context,
+                search_results=prefetched
+            )
+            # Failures and "still initializing" answers are retried next time
+            if key is not None and "error" not in result and result.get("available", True) \
+                    and result.get("search_performed", True):
+                self.result_cache.put(key, version, result)
+            results.append(result)
+        
+        return results
+    
+    @staticmethod
+    def _search_params(tool_name: str, tool_arguments: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Knowledge base search a tool call runs, or None for tools that don't search"""
+        if tool_name == "search_conversation_history":
+            return {
+                "query": tool_arguments.get("query", ""),
+                "max_results": tool_arguments.get("max_results", 3),
+                "time_window_days": tool_arguments.get("time_window_days", 30),
+                "min_similarity": 0.4,
+                "boost_topics": None
+            }
+        if tool_name == "find_related_discussions":
+            return {
+                "query": tool_arguments.get("topic", ""),
+                "max_results": 10,  # Get more results for topic analysis
+                "time_window_days": 90,  # Look back further for topic discussions
+                "min_similarity": 0.2,  # Lower threshold for topic matching
+                # Messages tagged with a known topic rank higher; untagged ones
+                # (tags miss paraphrases) still match by content
+                "boost_topics": query_topics(tool_arguments.get("topic", "")) or None
+            }
+        return None
+    
+    async def _prefetch_searches(
+        self,
+        tool_calls: List[Tuple[str, Dict[str, Any]]],
+        user_id: str
+    ) -> List[Optional[List[Dict[str, Any]]]]:
+        """
+        Run the searches of several tool calls as one batch
+        
+        Returns one entry per call: its search results, or None for calls
+        that don't search or when the knowledge base isn't ready, in which
+        case the tool searches (and reports unavailability) on its own.
+        """
+        
+        prefetched = [None] * len(tool_calls)
+        searches = {
+            i: params for i, params in enumerate(
+                self._search_params(name, arguments) for name, arguments in tool_calls
+            )
+            if params is not None
+        }
+        if not searches:
+            return prefetched
+        
+        try:
+            await knowledge_base._ensure_initialized()
+        except Exception as e:
+            logger.warning(f"Knowledge base not available for batched search: {e}")
+            return prefetched
+        if not knowledge_base._initialized:
+            return prefetched
+        
+        results = await knowledge_base.search_relevant_context_many(
+            queries=[params["query"] for params in searches.values()],
+            user_id=user_id,
+            max_results=[params["max_results"] for params in searches.values()],
+            time_window_days=[params["time_window_days"] for params in searches.values()],
+            min_similarity=[params["min_similarity"] for params in searches.values()],
+            boost_topics=[params["boost_topics"] for params in searches.values()]
+        )
+        for i, result in zip(searches, results):
+            prefetched[i] = result
+        return prefetched
+    
+    async def execute_tool(
+        self,
+        tool_name: str,
+        tool_arguments: Dict[str, Any],
+        user_id: str,
+        session_id: str = None,
+        current_session_context: List[Dict[str, str]] = None,
+        search_results: Optional[List[Dict[str, Any]]] = None
     ) -> Dict[str, Any]:
         """
         Execute a RAG tool with given arguments
@@ -115,6 +414,7 @@ class RAGToolsService:
             user_id: User ID for filtering
             session_id: Session ID for context
             current_session_context: Current session messages for immediate context
+            search_results: Knowledge base results already fetched for this call
             
         Returns:
             Tool execution result
@@ -128,7 +428,9 @@ class RAGToolsService:
                     max_results=tool_arguments.get("max_results", 3),
                     time_window_days=tool_arguments.get("time_window_days", 30),
                     session_id=session_id,
-                    current_session_context=current_session_context
+                    current_session_context=current_session_context,
+                    search_results=search_results,
+                    expand_passages=tool_arguments.get("expand_passages", False)
                 )
             
             elif tool_name == "get_conversation_summary":
@@ -144,7 +446,8 @@ class RAGToolsService:
                     user_id=user_id,
                     topic=tool_arguments.get("topic", ""),
                     include_context=tool_arguments.get("include_context", True),
-                    session_id=session_id
+                    session_id=session_id,
+                    search_results=search_results
                 )
             
             else:
@@ -168,7 +471,9 @@ class RAGToolsService:
         max_results: int = 3,
         time_window_days: int = 30,
         session_id: str = None,
-        current_session_context: List[Dict[str, str]] = None
+        current_session_context: List[Dict[str, str]] = None,
+        search_results: Optional[List[Dict[str, Any]]] = None,
+        expand_passages: bool = False
     ) -> Dict[str, Any]:
         """Search conversation history using semantic similarity"""
         
@@ -199,38 +504,41 @@ class RAGToolsService:
             }
         
         try:
-            results = await knowledge_base.search_relevant_context(
-                query=query,
-                user_id=user_id,
-                max_results=max_results,
-                time_window_days=time_window_days
-            )
+            results = search_results
+            if results is None:
+                results = await knowledge_base.search_relevant_context(
+                    query=query,
+                    user_id=user_id,
+                    max_results=max_results,
+                    time_window_days=time_window_days
+                )
+            if expand_passages:
+                results = await knowledge_base.expand_passages(results)
             
             # Also search current session context if provided
             current_session_results = []
             if current_session_context:
                 query_lower = query.lower()
-                for i, message in enumerate(current_session_context):
-                    if message.get("role") == "user" or message.get("role") == "assistant":
-                        content = message.get("content", "")
-                        if content and isinstance(content, str):  # Ensure content exists and is string
-                            content_lower = content.lower()
-                            
-                            # Simple keyword matching for current session
-                            # This could be enhanced with semantic similarity later
-                            if any(keyword in content_lower for keyword in query_lower.split() if len(keyword) > 3):
-                                # Calculate relative time (how many messages ago)
-                                messages_ago = len(current_session_context) - i
-                                current_session_results.append({
-                                    "content": content,
-                                    "similarity": 0.8,  # High similarity for current session
-                                    "timestamp": "current_session",
-                                    "session_id": session_id or "current",
-                                    "topics": ["current_session"],
-                                    "importance_score": 1.5,  # Higher importance for current session
-                                    "messages_ago": messages_ago,
-                                    "source": "current_session"
-                                })
+                conversation = self._conversation_messages(current_session_context)
+                for i, message in enumerate(conversation):
+                    content = message["content"]
+                    content_lower = content.lower()
+                    
+                    # Simple keyword matching for current session
+                    # This could be enhanced with semantic similarity later
+                    if any(keyword in content_lower for keyword in query_lower.split() if len(keyword) > 3):
+                        # Calculate relative time (how many messages ago)
+                        messages_ago = len(conversation) - i
+                        current_session_results.append({
+                            "content": content,
+                            "similarity": 0.8,  # High similarity for current session
+                            "timestamp": "current_session",
+                            "session_id": session_id or "current",
+                            "topics": ["current_session"],
+                            "importance_score": 1.5,  # Higher importance for current session
+                            "messages_ago": messages_ago,
+                            "source": "current_session"
+                        })
             
             # Combine results (current session first, then historical)
             all_results = current_session_results + results
@@ -352,7 +660,8 @@ class RAGToolsService:
         user_id: str,
         topic: str,
         include_context: bool = True,
-        session_id: str = None
+        session_id: str = None,
+        search_results: Optional[List[Dict[str, Any]]] = None
     ) -> Dict[str, Any]:
         """Find all discussions related to a specific topic"""
         
@@ -384,13 +693,10 @@ class RAGToolsService:
         
         try:
             # Search for discussions related to the topic
-            results = await knowledge_base.search_relevant_context(
-                query=topic,
-                user_id=user_id,
-                max_results=10,  # Get more results for topic analysis
-                time_window_days=90,  # Look back further for topic discussions
-                min_similarity=0.2  # Lower threshold for topic matching
-            )
+            results = search_results
+            search_params = self._search_params("find_related_discussions", {"topic": topic})
+            if results is None:
+                results = await knowledge_base.search_relevant_context(user_id=user_id, **search_params)
             
             if not results:
                 return {
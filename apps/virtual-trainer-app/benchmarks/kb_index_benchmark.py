@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the knowledge base index types on a synthetic corpus
+Compares Flat, HNSW and IVF-PQ on build time, memory, latency and recall@k
+
+Exits non-zero when an approximate index's recall is below --min-recall.
+
+Usage:
+    python benchmarks/kb_index_benchmark.py --vectors 200000 --queries 500
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.services.knowledge_base_service import _get_faiss, create_vector_index
+
+DIM = 384
+
+
+def make_corpus(n_vectors: int, n_queries: int, n_clusters: int, seed: int):
+    """Clustered unit vectors, roughly shaped like sentence embeddings"""
+    faiss = _get_faiss()
+    rng = np.random.default_rng(seed)
+
+    centers = rng.standard_normal((n_clusters, DIM)).astype('float32')
+    assignments = rng.integers(0, n_clusters, n_vectors + n_queries)
+    data = centers[assignments] + 0.6 * rng.standard_normal((n_vectors + n_queries, DIM)).astype('float32')
+    faiss.normalize_L2(data)
+
+    return data[:n_vectors], data[n_vectors:]
+
+
+def bench_index(index_type: str, corpus: np.ndarray, queries: np.ndarray, k: int):
+    """Build one index type and measure it"""
+    faiss = _get_faiss()
+    ids = np.arange(len(corpus), dtype='int64')
+
+    start = time.perf_counter()
+    index = create_vector_index(index_type, DIM, len(corpus))
+    if not index.is_trained:
+        index.train(corpus)
+    index.add_with_ids(corpus, ids)
+    build_seconds = time.perf_counter() - start
+
+    latencies = []
+    found = np.empty((len(queries), k), dtype='int64')
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        _, result_ids = index.search(query.reshape(1, -1), k)
+        latencies.append(time.perf_counter() - start)
+        found[i] = result_ids[0]
+
+    return {
+        'type': index_type,
+        'build_s': build_seconds,
+        'size_mb': faiss.serialize_index(index).nbytes / 2 ** 20,
+        'p50_ms': np.percentile(latencies, 50) * 1000,
+        'p99_ms': np.percentile(latencies, 99) * 1000,
+        'found': found,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--vectors', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--clusters', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--min-recall', type=float, default=0.9)
+    args = parser.parse_args()
+
+    corpus, queries = make_corpus(args.vectors, args.queries, args.clusters, args.seed)
+    print(f"Corpus: {args.vectors} x {DIM}, {args.queries} queries, recall@{args.k} vs flat\n")
+
+    results = [bench_index(index_type, corpus, queries, args.k) for index_type in ('flat', 'hnsw', 'ivfpq')]
+    exact = results[0]['found']
+
+    print(f"{'index':<8}{'build s':>10}{'size MB':>10}{'p50 ms':>10}{'p99 ms':>10}{'recall':>10}")
+    failed = []
+    for result in results:
+        recall = np.mean([
+            len(set(found) & set(truth)) / args.k
+            for found, truth in zip(result['found'], exact)
+        ])
+        print(
+            f"{result['type']:<8}{result['build_s']:>10.2f}{result['size_mb']:>10.1f}"
+            f"{result['p50_ms']:>10.3f}{result['p99_ms']:>10.3f}{recall:>10.3f}"
+        )
+        if recall < args.min_recall:
+            failed.append(result['type'])
+
+    if failed:
+        sys.exit(f"\nRecall@{args.k} below {args.min_recall}: {', '.join(failed)}")
+
+
+if __name__ == '__main__':
+    main()
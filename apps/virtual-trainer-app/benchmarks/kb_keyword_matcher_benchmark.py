@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of topic extraction and keyword boosting
+Compares the per-keyword substring and token-prefix loops with the compiled
+KeywordMatcher on synthetic chat messages, and checks both agree
+
+Usage:
+    python benchmarks/kb_keyword_matcher_benchmark.py --messages 20000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.services.knowledge_base_service import (
+    _TOKEN_PATTERN,
+    FITNESS_TOPIC_KEYWORDS,
+    KEYWORD_BOOSTS,
+    KEYWORD_MATCHER,
+)
+
+FILLER = (
+    'сегодня', 'завтра', 'хочу', 'обсудить', 'план', 'неделю', 'как', 'дела', 'после', 'работы',
+    'немного', 'устал', 'спасибо', 'понял', 'расскажи', 'подробнее', 'можно', 'утром', 'вечером'
+)
+
+
+def make_messages(n_messages: int, keyword_ratio: float, seed: int):
+    """Chat-sized messages mixing filler words with topic and boost keywords"""
+    rng = random.Random(seed)
+    keywords = [keyword for keywords in FITNESS_TOPIC_KEYWORDS.values() for keyword in keywords]
+    keywords += [word + 'ые' for word in KEYWORD_BOOSTS]
+
+    messages = []
+    for _ in range(n_messages):
+        words = [
+            rng.choice(keywords) if rng.random() < keyword_ratio else rng.choice(FILLER)
+            for _ in range(rng.randint(5, 60))
+        ]
+        messages.append(' '.join(words).capitalize() + '.')
+    return messages
+
+
+def scan_loops(text: str):
+    """The per-keyword loops KeywordMatcher replaces"""
+    text = text.lower()
+    topics = [
+        topic for topic, keywords in FITNESS_TOPIC_KEYWORDS.items()
+        if any(keyword in text for keyword in keywords)
+    ]
+    tokens = set(_TOKEN_PATTERN.findall(text))
+    factor = 1.0
+    for boost_word, boost_factor in KEYWORD_BOOSTS.items():
+        if any(token.startswith(boost_word) for token in tokens):
+            factor *= boost_factor
+    return topics, factor
+
+
+def scan_matcher(text: str):
+    return KEYWORD_MATCHER.scan(text.lower())
+
+
+def bench(scan, messages, repeat: int):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for message in messages:
+            scan(message)
+        best = min(best, time.perf_counter() - start)
+    return best / len(messages) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--keyword-ratio', type=float, default=0.1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages, args.keyword_ratio, args.seed)
+    mismatches = sum(scan_loops(message) != scan_matcher(message) for message in messages)
+    print(f"{args.messages} messages, {args.keyword_ratio:.0%} keywords, {mismatches} mismatches\n")
+
+    print(f"{'scan':<10}{'us/msg':>10}")
+    for name, scan in (('loops', scan_loops), ('matcher', scan_matcher)):
+        print(f"{name:<10}{bench(scan, messages, args.repeat):>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Recall vs memory of the knowledge base vector representations
+Compares float32/float16 SQLite storage and the float32/fp16/sq8 Flat codecs
+and IVF-PQ against exact float32 search on a synthetic corpus
+
+Usage:
+    python benchmarks/kb_quantization_benchmark.py --vectors 100000 --queries 300
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.core.config import settings
+from backend.services.knowledge_base_service import (
+    EMBEDDING_STORAGE_DTYPES,
+    FLAT_CODECS,
+    _get_faiss,
+    create_vector_index,
+    decode_embeddings,
+)
+from benchmarks.kb_index_benchmark import DIM, make_corpus
+
+
+def recall_at_k(found: np.ndarray, exact: np.ndarray, k: int) -> float:
+    return float(np.mean([len(set(f) & set(e)) / k for f, e in zip(found, exact)]))
+
+
+def search_all(index, queries: np.ndarray, k: int) -> np.ndarray:
+    _, found = index.search(queries, k)
+    return found
+
+
+def build(index_type: str, corpus: np.ndarray):
+    index = create_vector_index(index_type, DIM, len(corpus))
+    if not index.is_trained:
+        index.train(corpus)
+    index.add_with_ids(corpus, np.arange(len(corpus), dtype='int64'))
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--vectors', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--clusters', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    faiss = _get_faiss()
+    corpus, queries = make_corpus(args.vectors, args.queries, args.clusters, args.seed)
+    print(f"Corpus: {args.vectors} x {DIM}, {args.queries} queries, recall@{args.k} vs float32 flat\n")
+
+    settings.KB_FLAT_CODEC = 'float32'
+    exact = search_all(build('flat', corpus), queries, args.k)
+
+    print(f"{'representation':<22}{'bytes/vector':>14}{'vs float32':>12}{'recall':>10}")
+    baseline = DIM * 4
+
+    def report(name: str, bytes_per_vector: float, found: np.ndarray):
+        print(f"{name:<22}{bytes_per_vector:>14.0f}{baseline / bytes_per_vector:>11.1f}x"
+              f"{recall_at_k(found, exact, args.k):>10.3f}")
+
+    # SQLite BLOBs: vectors are decoded back to float32 before indexing
+    for name, dtype in EMBEDDING_STORAGE_DTYPES.items():
+        blobs = [vector.astype(dtype).tobytes() for vector in corpus]
+        restored = decode_embeddings(blobs, DIM)
+        faiss.normalize_L2(restored)
+        settings.KB_FLAT_CODEC = 'float32'
+        index = create_vector_index('flat', DIM)
+        index.add_with_ids(restored, np.arange(len(restored), dtype='int64'))
+        report(f"sqlite {name}", DIM * dtype.itemsize, search_all(index, queries, args.k))
+
+    # In-memory partitions; size excludes the id map shared by all types
+    for codec in FLAT_CODECS:
+        settings.KB_FLAT_CODEC = codec
+        index = build('flat', corpus)
+        report(f"flat {codec}", index.index.sa_code_size(), search_all(index, queries, args.k))
+
+    # IVF-PQ codes alone and with the finer codes its candidates are re-scored with
+    for refine in dict.fromkeys(('none', settings.KB_IVFPQ_REFINE.lower())):
+        settings.KB_IVFPQ_REFINE = refine
+        index = build('ivfpq', corpus)
+        bytes_per_vector = faiss.extract_index_ivf(index).code_size
+        refined = faiss.downcast_index(index.index)
+        if isinstance(refined, faiss.IndexRefine):
+            bytes_per_vector += refined.refine_index.sa_code_size()
+        report(f"ivfpq refine {refine}", bytes_per_vector, search_all(index, queries, args.k))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@ async def search_cat_response():
     print("=== SEARCHING FOR CAT RESPONSE ===\n")
     
     await knowledge_base._ensure_initialized()
+    conversations = knowledge_base.get_all_conversations()
     
     # Search for specific phrases from the cat response
     search_phrases = [
@@ -28,9 +29,9 @@ async def search_cat_response():
         print(f"Searching for: '{phrase}'")
         matches = []
         
-        for i, text in enumerate(knowledge_base.conversation_texts):
+        for i, metadata in enumerate(conversations):
+            text = metadata['content']
             if phrase.lower() in text.lower():
-                metadata = knowledge_base.conversation_metadata[i]
                 matches.append({
                     'index': i,
                     'text': text,
@@ -71,11 +72,11 @@ async def search_cat_response():
     print("\n--- CHECKING ALL 'КОТ' CONTENT ---")
     cat_content = []
     
-    for i, text in enumerate(knowledge_base.conversation_texts):
+    for i, metadata in enumerate(conversations):
+        text = metadata['content']
         if "кот" in text.lower():
             # Filter out false positives (котор, который, etc.)
             if any(word in text.lower() for word in ["как накачать кота", "про кота", "спрашивал про кота"]):
-                metadata = knowledge_base.conversation_metadata[i]
                 cat_content.append({
                     'index': i,
                     'text': text[:150],
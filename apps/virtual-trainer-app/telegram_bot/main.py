@@ -20,6 +20,7 @@ from telegram.ext import (
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from backend.services.llm_service import LLMService
+from backend.services.knowledge_base_service import knowledge_base
 from backend.services.user_service import UserService
 from backend.services.trainer_service import TrainerService
 from backend.services.nutrition_service import NutritionService
@@ -43,8 +44,12 @@ nutrition_service = NutritionService(llm_service, user_service)
 trainer_service = TrainerService(llm_service, user_service, nutrition_service)
 questionnaire_service = QuestionnaireService(user_service, trainer_service, llm_service)
 
+async def shutdown_services(application: Application) -> None:
+    """Stop background workers of shared services"""
+    await knowledge_base.close()
+
 # Create bot application
-application = Application.builder().token(settings.TELEGRAM_BOT_TOKEN).build()
+application = Application.builder().token(settings.TELEGRAM_BOT_TOKEN).post_shutdown(shutdown_services).build()
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle /start command"""
@@ -26,8 +26,8 @@ async def test_rag_search():
         return
     
     print("✅ Knowledge base initialized successfully")
-    print(f"Loaded {len(knowledge_base.conversation_texts)} conversations")
-    print(f"FAISS index size: {knowledge_base.faiss_index.ntotal if knowledge_base.faiss_index else 0}")
+    print(f"Loaded {knowledge_base.total_conversations} conversations")
+    print(f"FAISS index size: {knowledge_base.total_vectors}")
     
     for query in queries:
         print(f"\n--- Searching for: '{query}' ---")
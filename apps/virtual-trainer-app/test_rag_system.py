@@ -53,6 +53,7 @@ async def test_knowledge_base_storage():
         )
         print(f"  ✅ Stored: {role} - {content[:50]}...")
     
+    await knowledge_base.flush()
     print(f"✅ Successfully stored {len(test_messages)} messages")
     return user_id, session_id
 
@@ -0,0 +1,1147 @@
+"""
+Тесты для базы знаний разговоров
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import zlib
+from datetime import datetime, timedelta
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+
+from backend.core.config import settings
+from backend.services.knowledge_base_service import (
+    ConversationDatabase,
+    ConversationKnowledgeBase,
+    ConversationMetadataStore,
+    KeywordMatcher,
+    select_index_type,
+    split_passages,
+    time_bucket,
+)
+
+
+class FakeEmbeddingModel:
+    """Детерминированная замена SentenceTransformer на основе триграмм"""
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+        self.encoded_texts = []
+
+    def encode(self, texts, convert_to_tensor=False):
+        self.encoded_texts.extend(texts)
+        vectors = np.zeros((len(texts), self.dim), dtype='float32')
+        for row, text in enumerate(texts):
+            text = f"  {text.lower()}  "
+            for i in range(len(text) - 2):
+                vectors[row, zlib.crc32(text[i:i + 3].encode()) % self.dim] += 1.0
+        return vectors
+
+
+async def make_knowledge_base(db_path, model=None):
+    """Создание базы знаний без загрузки настоящей модели"""
+    kb = ConversationKnowledgeBase(db_path=str(db_path))
+    kb.embeddings_model = model or FakeEmbeddingModel()
+    await kb._init_database()
+    await kb._load_conversations_to_faiss()
+    kb._initialized = True
+    return kb
+
+
+def current_partition(user_id, days_ago=0):
+    """Ключ раздела пользователя для сообщений указанной давности"""
+    return user_id, time_bucket((datetime.now() - timedelta(days=days_ago)).timestamp())
+
+
+def partition_index(kb, user_id, days_ago=0):
+    """Индекс раздела пользователя для сообщений указанной давности"""
+    return kb.user_indexes[user_id][current_partition(user_id, days_ago)[1]]
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """Путь к временной базе разговоров"""
+    return tmp_path / "conversation_kb.db"
+
+
+@pytest.mark.asyncio
+async def test_startup_reuses_stored_embeddings(db_path):
+    """При старте векторы берутся из БД без повторного кодирования"""
+    kb = await make_knowledge_base(db_path)
+    await kb.store_conversation_message("u1", "s1", "user", "Пей больше воды")
+    await kb.store_conversation_message("u1", "s1", "assistant", "Тренировка ног в четверг")
+    await kb.flush()
+
+    model = FakeEmbeddingModel()
+    reloaded = await make_knowledge_base(db_path, model)
+
+    assert model.encoded_texts == []
+    assert reloaded.total_vectors == 2
+
+
+@pytest.mark.asyncio
+async def test_startup_reembeds_only_stale_rows(db_path):
+    """Строки без вектора или от другой модели перекодируются в фоне"""
+    kb = await make_knowledge_base(db_path)
+    await kb.store_conversation_message("u1", "s1", "user", "Пей больше воды")
+    await kb.flush()
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("""
+        INSERT INTO conversations (user_id, session_id, message_role, message_content, timestamp)
+        VALUES ('u1', 's1', 'user', 'Без вектора', '2024-01-01T00:00:00')
+    """)
+    conn.execute("UPDATE conversations SET embedding_model = 'old-model' WHERE id = 1")
+    conn.execute("""
+        INSERT INTO conversations (user_id, session_id, message_role, message_content, timestamp,
+                                   embedding, embedding_model)
+        SELECT user_id, session_id, message_role, 'Актуальный вектор', timestamp, embedding, ?
+        FROM conversations WHERE id = 1
+    """, (kb.embedding_model_name,))
+    conn.commit()
+    conn.close()
+
+    model = FakeEmbeddingModel()
+    reloaded = await make_knowledge_base(db_path, model)
+    assert reloaded.total_vectors == 1
+
+    await reloaded._reembed_task
+    assert sorted(model.encoded_texts) == sorted(["Пей больше воды", "Без вектора"])
+    assert reloaded.total_vectors == 3
+
+
+@pytest.mark.asyncio
+async def test_semantic_search_only_touches_user_partition(db_path):
+    """Сообщения других пользователей не вытесняют результаты пользователя"""
+    kb = await make_knowledge_base(db_path)
+    for i in range(20):
+        await kb.store_conversation_message("other", "s2", "user", f"Пей больше воды каждый день {i}")
+    await kb.store_conversation_message("u1", "s1", "user", "Пей больше воды")
+    await kb.flush()
+
+    assert set(kb.user_indexes) == {"other", "u1"}
+    assert partition_index(kb, "u1").ntotal == 1
+
+    results = await kb._semantic_search("Пей больше воды", "u1", max_results=2)
+    assert [r['content'] for r in results] == ["Пей больше воды"]
+
+
+def test_select_index_type_by_partition_size(monkeypatch):
+    """Тип индекса выбирается по размеру раздела"""
+    monkeypatch.setattr(settings, "KB_INDEX_TYPE", "auto")
+    monkeypatch.setattr(settings, "KB_HNSW_MIN_VECTORS", 100)
+    monkeypatch.setattr(settings, "KB_IVFPQ_MIN_VECTORS", 1000)
+    monkeypatch.setattr(settings, "KB_IVF_NLIST", 4)
+    monkeypatch.setattr(settings, "KB_PQ_NBITS", 4)
+
+    assert select_index_type(10) == "flat"
+    assert select_index_type(100) == "hnsw"
+    assert select_index_type(1000) == "ivfpq"
+
+    monkeypatch.setattr(settings, "KB_INDEX_TYPE", "ivfpq")
+    assert select_index_type(10) == "flat"  # мало данных для обучения
+
+
+def test_ivfpq_candidates_refined_and_filtered(tmp_path, monkeypatch):
+    """IVF-PQ пересчитывает кандидатов по точным кодам и соблюдает фильтр id"""
+    import faiss
+    from backend.services.knowledge_base_service import create_vector_index
+
+    monkeypatch.setattr(settings, "KB_IVF_NLIST", 8)
+    monkeypatch.setattr(settings, "KB_PQ_NBITS", 4)
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((2000, 384)).astype('float32')
+    faiss.normalize_L2(vectors)
+    ids = np.arange(1000, 3000, dtype='int64')
+
+    index = create_vector_index("ivfpq", 384, len(vectors))
+    assert isinstance(faiss.downcast_index(index.index), faiss.IndexRefine)
+    index.train(vectors)
+    index.add_with_ids(vectors, ids)
+
+    _, found = index.search(vectors[:50], 1)
+    assert np.mean(found[:, 0] == ids[:50]) >= 0.95
+
+    kb = ConversationKnowledgeBase(db_path=str(tmp_path / "kb.db"))
+    kb._index_types[("u1", "all")] = "ivfpq"
+    allowed = ids[10:20]
+    params = kb._filtered_search_params(("u1", "all"), index, allowed, 5)
+    _, found = index.search(vectors[10:11], 5, params=params)
+    assert found[0][0] == ids[10]
+    assert set(found[0].tolist()) <= set(allowed.tolist())
+
+
+@pytest.mark.asyncio
+async def test_partition_upgraded_in_background(db_path, monkeypatch):
+    """Разросшийся раздел перестраивается в HNSW в фоне"""
+    monkeypatch.setattr(settings, "KB_INDEX_TYPE", "auto")
+    monkeypatch.setattr(settings, "KB_HNSW_MIN_VECTORS", 3)
+
+    kb = await make_knowledge_base(db_path)
+    for text in ["Приседания", "Жим лежа", "Становая тяга"]:
+        await kb.store_conversation_message("u1", "s1", "user", text)
+    await kb.flush()
+
+    rebuild = kb._index_rebuilds[current_partition("u1")]
+    await kb.store_conversation_message("u1", "s1", "user", "Пей больше воды")
+    await kb.flush()
+    await rebuild
+
+    assert kb._index_types[current_partition("u1")] == "hnsw"
+    assert partition_index(kb, "u1").ntotal == 4
+    results = await kb._semantic_search("Пей больше воды", "u1", max_results=1)
+    assert results[0]['content'] == "Пей больше воды"
+
+
+@pytest.mark.asyncio
+async def test_lexical_search_uses_user_postings(db_path, monkeypatch):
+    """Без FTS5 ключевой и прямой поиск идут через инвертированный индекс"""
+    monkeypatch.setattr(ConversationKnowledgeBase, "_init_fts", lambda self, cursor: False)
+    kb = await make_knowledge_base(db_path)
+    await kb.store_conversation_message("u1", "s1", "assistant", "Советую пить воду регулярно")
+    await kb.store_conversation_message("u1", "s1", "user", "Болит плечо после жима")
+    await kb.store_conversation_message("u2", "s2", "user", "Пить воду регулярно")
+    await kb.flush()
+
+    assert kb._match_term_prefix("u1", "вод") == {1}
+
+    keyword = await kb._keyword_search("сколько воды пить", "u1", max_results=5)
+    assert [r['content'] for r in keyword] == ["Советую пить воду регулярно"]
+
+    direct = await kb._direct_content_search("плечо болит", "u1", max_results=5)
+    assert [r['content'] for r in direct] == ["Болит плечо после жима"]
+
+
+@pytest.mark.asyncio
+async def test_keyword_search_runs_in_fts(db_path):
+    """Ключевой поиск идет через FTS5 со стеммингом и без чужих сообщений"""
+    kb = await make_knowledge_base(db_path)
+    assert kb._fts_enabled
+    assert kb._postings == {}
+
+    await kb.store_conversation_message("u1", "s1", "assistant", "Советую пить воду регулярно")
+    await kb.store_conversation_message("u1", "s1", "user", "Болит плечо после жима")
+    await kb.store_conversation_message("u1-x", "s2", "user", "Пить воду регулярно")
+    await kb.flush()
+
+    keyword = await kb._keyword_search("сколько воды пьешь", "u1", max_results=5)
+    assert [r['content'] for r in keyword] == ["Советую пить воду регулярно"]
+
+    direct = await kb._direct_content_search("плечо болит", "u1", max_results=5)
+    assert [r['content'] for r in direct] == ["Болит плечо после жима"]
+
+
+def test_metadata_store_keeps_id_order():
+    """Колоночное хранилище остается упорядоченным по id и кодирует темы маской"""
+    store = ConversationMetadataStore(capacity=2)
+
+    def row(conv_id, user_id, topics):
+        return {'id': conv_id, 'user_id': user_id, 'session_id': 's', 'ts': float(conv_id),
+                'topics': topics, 'importance_score': 1.0, 'content_hash': conv_id, 'simhash': conv_id}
+
+    store.append([row(5, "u1", ["workout"]), row(7, "u2", ["custom"])])
+    store.append([row(3, "u1", ["nutrition", "goals"])])  # перекодированная старая строка
+
+    assert list(store.live_ids()) == [3, 5, 7]
+    assert list(store.positions(np.array([7, 4, 3]))) == [2, -1, 0]
+    assert store.describe(0)['topics'] == ["nutrition", "goals"]
+    assert store.describe(2) == {'id': 7, 'user_id': "u2", 'session_id': "s",
+                                 'topics': ["custom"], 'importance_score': 1.0}
+
+
+def test_metadata_store_per_user_id_sets():
+    """Выборки по пользователю, сессиям и темам идут по поддерживаемым сортированным массивам id"""
+    from backend.services.knowledge_base_service import topic_bitmask
+
+    store = ConversationMetadataStore(capacity=2)
+
+    def row(conv_id, user_id, session_id, topics=()):
+        return {'id': conv_id, 'user_id': user_id, 'session_id': session_id, 'ts': float(conv_id),
+                'topics': list(topics), 'importance_score': 1.0, 'content_hash': conv_id, 'simhash': conv_id}
+
+    store.append([row(1, "u1", "a", ["nutrition"]), row(2, "u2", "a", ["nutrition"]),
+                  row(4, "u1", "b", ["workout", "nutrition"]), row(5, "u1", "c", ["sleep"])])
+    store.append([row(3, "u1", "a", ["workout"])])
+
+    assert store.user_ids("u1").tolist() == [1, 3, 4, 5]
+    assert store.session_ids("u1", ["a"], ["a", "b"]).tolist() == [1, 3, 5]
+    assert store.topic_ids("u1", topic_bitmask(["nutrition"])).tolist() == [1, 4]
+    assert store.topic_ids("u1", topic_bitmask(["nutrition", "workout"])).tolist() == [1, 3, 4]
+
+    store.remove(np.array([1, 3, 5]))
+    assert store.user_ids("u1").tolist() == [4]
+    assert store.session_ids("u1", ["a"], ["b"]).tolist() == []
+    assert store.topic_ids("u1", topic_bitmask(["workout"])).tolist() == [4]
+    assert store.user_ids("u2").tolist() == [2]
+    assert store.user_ids("u3").tolist() == []
+
+    restored = ConversationMetadataStore.from_snapshot(*store.snapshot())
+    assert restored.session_ids("u2", [], []).tolist() == [2]
+
+    # Учет памяти включает массивы id, а не только колонки
+    assert store.user_bytes("u3") == 0
+    store.append([row(conv_id, "u3", "a", ["sleep"]) for conv_id in range(10, 20010)])
+    column_bytes = sum(getattr(store, column).itemsize for column in store._ROW_ARRAYS)
+    assert len(store) * (column_bytes + 3 * 8) <= store.user_bytes("u3") + store.user_bytes("u1") + store.user_bytes("u2")
+    assert column_bytes + 3 * 8 <= store.row_bytes <= 2 * (column_bytes + 3 * 8)
+
+
+def test_metadata_store_tombstones_and_compacts_in_bulk(monkeypatch):
+    """Удаление помечает строки, сжатие колонок идет пачкой"""
+    monkeypatch.setattr(ConversationMetadataStore, "COMPACT_MIN_ROWS", 2)
+    store = ConversationMetadataStore(capacity=2)
+
+    def row(conv_id, content_hash=None):
+        return {'id': conv_id, 'user_id': "u1", 'session_id': "s", 'ts': float(conv_id), 'topics': [],
+                'importance_score': 1.0, 'content_hash': content_hash or conv_id, 'simhash': conv_id}
+
+    store.append([row(conv_id) for conv_id in range(1, 9)])
+    assert store.remove(np.array([2, 5])) == 2
+    assert (len(store), store._size) == (6, 8)
+    assert list(store.positions(np.array([2, 3]))) == [-1, 2]
+    assert store.content_ids("u1") == {conv_id: conv_id for conv_id in (1, 3, 4, 6, 7, 8)}
+
+    # Повторно добавленный id не путается со своим надгробием
+    store.append([row(5, content_hash=50)])
+    assert store.live_ids().tolist() == [1, 3, 4, 5, 6, 7, 8]
+    assert store.content_ids("u1")[50] == 5
+
+    store.remove(np.array([1, 3, 4]))
+    assert (len(store), store._size) == (4, 4)
+    assert store.live_ids().tolist() == [5, 6, 7, 8]
+    ids, fingerprints = store.simhashes_of("u1")
+    assert ids.tolist() == fingerprints.tolist() == [5, 6, 7, 8]
+
+
+def test_keyword_matcher_finds_topics_and_boosts_in_one_pass():
+    """Темы ищутся как подстроки, усиления — как начала слов, включая пересечения"""
+    matcher = KeywordMatcher(
+        {'a': ['штанга', 'ган'], 'b': ['штан'], 'c': ['вес']},
+        {'вод': 1.5, 'водопад': 2.0, 'совет': 1.3}
+    )
+
+    assert matcher.scan("штанга и водопад") == (['a', 'b'], 1.5 * 2.0)
+    assert matcher.scan("безводный подход") == ([], 1.0)
+    assert matcher.scan("совет: весы") == (['c'], 1.3)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_encodes_share_one_batch(db_path):
+    """Одновременные запросы к энкодеру объединяются в один батч"""
+    model = FakeEmbeddingModel()
+    kb = await make_knowledge_base(db_path, model)
+    encoder = kb._encoder
+
+    texts = [f"сообщение {i}" for i in range(5)]
+    vectors = await asyncio.gather(*(encoder.encode([text]) for text in texts))
+
+    assert encoder.batches_encoded == 1
+    assert model.encoded_texts == texts
+    assert all(vector.shape == (1, kb.embedding_dim) for vector in vectors)
+    await kb.close()
+
+
+@pytest.mark.asyncio
+async def test_ingest_writes_batch_and_replays_log(db_path, monkeypatch):
+    """Сообщения пишутся батчем, а незавершенный журнал дозаписывается без дублей"""
+    fsynced = []
+    original_fsync = os.fsync
+
+    def spy_fsync(fd):
+        fsynced.append(fd)
+        return original_fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", spy_fsync)
+    model = FakeEmbeddingModel()
+    kb = await make_knowledge_base(db_path, model)
+    for i in range(3):
+        await kb.store_conversation_message("u1", "s1", "user", f"Подход номер {i}")
+    assert fsynced == []
+    await kb.flush()
+
+    # Журнал синхронизируется с диском один раз на пачку, а не на сообщение
+    assert len(fsynced) == 1
+    assert kb._encoder.batches_encoded == 1
+    assert kb.total_vectors == 3
+    assert kb.ingest_log_path.read_text() == ""
+
+    # Журнал после сбоя: одна запись уже в БД, одна нет, последняя строка оборвана
+    conn = sqlite3.connect(db_path)
+    stored_id = conn.execute("SELECT ingest_id FROM conversations WHERE id = 1").fetchone()[0]
+    conn.close()
+    kb.ingest_log_path.write_text(
+        f'{{"ingest_id": "{stored_id}", "user_id": "u1", "session_id": "s1", "role": "user", '
+        f'"content": "Подход номер 0", "timestamp": "2024-01-01T00:00:00", "topics": null, '
+        f'"importance_score": 1.0}}\n'
+        '{"ingest_id": "lost", "user_id": "u1", "session_id": "s1", "role": "user", '
+        '"content": "Потерянное сообщение", "timestamp": "2024-01-01T00:00:00", "topics": null, '
+        '"importance_score": 1.0}\n'
+        '{"ingest_id": "torn", "user_'
+    )
+
+    reloaded = await make_knowledge_base(db_path)
+    await reloaded._replay_ingest_log()
+    await reloaded.flush()
+
+    assert reloaded.total_vectors == 4
+    assert reloaded.ingest_log_path.read_text() == ""
+    await kb.close()
+    await reloaded.close()
+
+
+@pytest.mark.asyncio
+async def test_failed_ingest_retried_and_kept_in_log(db_path, monkeypatch):
+    """Сбойная пачка повторяется, а после всех попыток остается в журнале"""
+    monkeypatch.setattr(settings, "KB_INGEST_RETRY_DELAY_SECONDS", 0)
+    kb = await make_knowledge_base(db_path)
+
+    # Сбой после фиксации транзакции: повтор индексирует уже записанную строку
+    add_to_indexes = kb._add_to_indexes
+    failures = []
+
+    def flaky_add(*args, **kwargs):
+        if not failures:
+            failures.append(True)
+            raise RuntimeError("index busy")
+        return add_to_indexes(*args, **kwargs)
+
+    monkeypatch.setattr(kb, "_add_to_indexes", flaky_add)
+    await kb.store_conversation_message("u1", "s1", "user", "Пей больше воды")
+    await kb.flush()
+    assert kb.total_vectors == 1
+    assert (kb._ingest_pending, kb.ingest_log_path.read_text()) == (0, "")
+
+    async def broken_batch(batch):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(kb, "_ingest_batch", broken_batch)
+    await kb.store_conversation_message("u1", "s1", "user", "Приседания по средам")
+    await kb.flush()
+    assert kb._ingest_pending == 0
+    assert [entry["content"] for entry in map(json.loads, kb.ingest_log_path.read_text().splitlines())] == [
+        "Приседания по средам"
+    ]
+
+    reloaded = await make_knowledge_base(db_path)
+    await reloaded._replay_ingest_log()
+    await reloaded.flush()
+    assert reloaded.total_vectors == 2
+    assert reloaded.ingest_log_path.read_text() == ""
+    await reloaded.close()
+
+
+def test_ingest_queue_moves_to_new_event_loop(db_path):
+    """Очередь и прерванная пачка старого цикла событий дописываются в новом, журнал очищается"""
+
+    async def first_loop():
+        kb = await make_knowledge_base(db_path)
+        started = asyncio.Event()
+
+        async def hanging_embed(units):
+            started.set()
+            await asyncio.Event().wait()
+
+        kb._embed_messages = hanging_embed
+        for i in range(3):
+            await kb.store_conversation_message("u1", "s1", "user", f"Подход номер {i}")
+        await started.wait()
+        for text in ["Пей больше воды", "Приседания по средам"]:
+            await kb.store_conversation_message("u1", "s1", "user", text)
+        del kb._embed_messages
+        return kb
+
+    # Цикл завершается посреди пачки, еще две записи ждут в очереди
+    kb = asyncio.run(first_loop())
+    assert (kb._ingest_pending, len(kb._ingest_inflight), kb._ingest_queue.qsize()) == (5, 3, 2)
+
+    async def second_loop():
+        await kb.store_conversation_message("u1", "s1", "user", "Жим лежа")
+        await kb.flush()
+        assert kb.total_vectors == 6
+        assert (kb._ingest_pending, kb.ingest_log_path.read_text()) == (0, "")
+        await kb.close()
+
+    asyncio.run(second_loop())
+
+
+@pytest.mark.asyncio
+async def test_reads_do_not_wait_for_open_write(db_path):
+    """В режиме WAL чтение не ждет незавершенной транзакции записи"""
+    kb = await make_knowledge_base(db_path)
+    await kb.store_conversation_message("u1", "s1", "user", "Пей больше воды")
+    await kb.flush()
+
+    db = ConversationDatabase(db_path)
+    assert db.reader().execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    writer = sqlite3.connect(db_path, timeout=0)
+    writer.execute("BEGIN IMMEDIATE")
+    writer.execute("DELETE FROM conversations")
+
+    rows = await db.fetchall("SELECT message_content FROM conversations")
+    assert rows == [("Пей больше воды",)]
+
+    writer.rollback()
+    writer.close()
+    db.close()
+    await kb.close()
+
+
+@pytest.mark.asyncio
+async def test_cleanup_removes_only_deleted_vectors(db_path, monkeypatch):
+    """Очистка удаляет старые векторы точечно, без перезагрузки всего индекса"""
+    monkeypatch.setattr(settings, "KB_INDEX_TYPE", "auto")
+    monkeypatch.setattr(settings, "KB_HNSW_MIN_VECTORS", 3)
+
+    model = FakeEmbeddingModel()
+    kb = await make_knowledge_base(db_path, model)
+    await kb.store_conversation_message("u1", "s1", "user", "Старая тренировка", timestamp=datetime.now() - timedelta(days=200))
+    await kb.store_conversation_message("u2", "s2", "user", "Старое питание", timestamp=datetime.now() - timedelta(days=200))
+    for text in ["Приседания", "Жим лежа", "Становая тяга"]:
+        await kb.store_conversation_message("u2", "s2", "user", text)
+    await kb.store_conversation_message("u1", "s1", "user", "Пей больше воды")
+    await kb.flush()
+    await kb._index_rebuilds[current_partition("u2")]
+    assert kb._index_types[current_partition("u2")] == "hnsw"
+
+    encoded_before = len(model.encoded_texts)
+    await kb.cleanup_old_conversations(days_to_keep=90)
+
+    # Разделы устаревших месяцев удаляются целиком
+    assert len(model.encoded_texts) == encoded_before
+    assert set(kb.user_indexes["u1"]) == {current_partition("u1")[1]}
+    assert set(kb.user_indexes["u2"]) == {current_partition("u2")[1]}
+    assert kb.total_conversations == 4
+    assert kb.metadata_store.positions(np.array([1, 2])).tolist() == [-1, -1]
+
+    # HNSW не умеет удалять: вектор повтора помечен, раздел перестраивается
+    await kb.store_conversation_message("u2", "s2", "user", "приседания")
+    await kb.flush()
+    assert kb._tombstones[current_partition("u2")] == 1
+    await kb._index_rebuilds[current_partition("u2")]
+    assert partition_index(kb, "u2").ntotal == 3
+    assert kb.total_vectors == 4
+    await kb.close()
+
+
+@pytest.mark.asyncio
+async def test_search_skips_tombstoned_vectors_without_losing_results(db_path, monkeypatch):
+    """Удаленные векторы HNSW не съедают места в выдаче"""
+    monkeypatch.setattr(settings, "KB_INDEX_TYPE", "hnsw")
+    monkeypatch.setattr(settings, "KB_HNSW_COMPACT_RATIO", 1.0)
+
+    kb = await make_knowledge_base(db_path)
+    for text in ["Пей больше воды", "Пей больше воды днем", "Воды больше пей",
+                 "Больше воды после тренировки", "Пей больше воды с утра", "Жим лежа"]:
+        await kb.store_conversation_message("u1", "s1", "user", text)
+    await kb.flush()
+    kb._remove_from_indexes({"u1": [1, 2, 3]})
+    assert kb._tombstones[current_partition("u1")] == 3
+    assert kb._superseded == set()
+
+    results = await kb._semantic_search("Пей больше воды", "u1", max_results=2)
+    assert [r['content'] for r in results] == ["Пей больше воды с утра", "Больше воды после тренировки"]
+    await kb.close()
+
+
+@pytest.mark.asyncio
+async def test_windowed_search_skips_old_buckets(db_path, monkeypatch):
+    """Поиск за последние дни обращается только к свежим разделам"""
+    kb = await make_knowledge_base(db_path)
+    await kb.store_conversation_message("u1", "s1", "user", "Пей больше воды", timestamp=datetime.now() - timedelta(days=80))
+    await kb.store_conversation_message("u1", "s1", "user", "Пей больше воды днем")
+    await kb.flush()
+    assert len(kb.user_indexes["u1"]) == 2
+
+    searched = []
+    search_index = kb._search_index
+    monkeypatch.setattr(kb, "_search_index", lambda *args: searched.append(args[0]) or search_index(*args))
+
+    recent = await kb._semantic_search("Пей больше воды", "u1", max_results=5, time_window_days=7)
+    assert searched == [current_partition("u1")]
+    assert [r['content'] for r in recent] == ["Пей больше воды днем"]
+
+    searched.clear()
+    everything = await kb._semantic_search("Пей больше воды", "u1", max_results=5, time_window_days=90)
+    assert set(searched) == {current_partition("u1"), current_partition("u1", days_ago=80)}
+    assert [r['content'] for r in everything] == ["Пей больше воды", "Пей больше воды днем"]
+
+
+@pytest.mark.asyncio
+async def test_cold_users_evicted_and_paged_in(db_path):
+    """При нехватке памяти вытесняются давно неактивные пользователи и подгружаются по запросу"""
+    kb = await make_knowledge_base(db_path)
+    kb.residency.budget_bytes = 7500  # около трех пользователей по одному сообщению
+    for user_id in ("u1", "u2", "u3"):
+        await kb.store_conversation_message(user_id, "s", "user", f"Пей больше воды, {user_id}")
+        await kb.flush()
+    await kb._semantic_search("вода", "u1", max_results=1)
+    await kb.store_conversation_message("u4", "s", "user", "Пей больше воды, u4")
+    await kb.flush()
+
+    # u2 дольше всех не обращался
+    assert set(kb.user_indexes) == {"u1", "u3", "u4"}
+    assert len(kb.metadata_store.user_ids("u2")) == 0
+    assert kb.residency.stats()['evictions'] == 1
+    assert kb.residency.resident_bytes <= kb.residency.budget_bytes
+
+    results = await kb._semantic_search("Пей больше воды", "u2", max_results=1)
+    assert [r['content'] for r in results] == ["Пей больше воды, u2"]
+    assert set(kb.user_indexes) == {"u1", "u2", "u4"}
+    stats = kb.residency.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (1, 1, 2)
+
+    # Сообщения вытесненного пользователя пишутся только в SQLite
+    await kb.store_conversation_message("u3", "s", "user", "Приседания по средам")
+    await kb.flush()
+    assert "u3" not in kb.user_indexes
+    results = await kb._semantic_search("Приседания по средам", "u3", max_results=1)
+    assert results[0]['content'] == "Приседания по средам"
+    assert len(kb.metadata_store.user_ids("u3")) == 2
+
+
+@pytest.mark.asyncio
+async def test_startup_maps_snapshot_and_replays_tail(db_path, monkeypatch):
+    """Старт берет индекс из снимка и дочитывает из БД только хвост"""
+    kb = await make_knowledge_base(db_path)
+    await kb.store_conversation_message("u1", "s1", "user", "Пей больше воды")
+    await kb.store_conversation_message("u1", "s1", "user", "Приседания по средам")
+    await kb.close()
+    assert (kb.snapshot_dir / "CURRENT").exists()
+
+    # После снимка: одна строка удалена, одна добавлена другим процессом
+    conn = sqlite3.connect(db_path)
+    conn.execute("DELETE FROM conversations WHERE id = 2")
+    conn.execute("""
+        INSERT INTO conversations (user_id, session_id, message_role, message_content, timestamp,
+                                   embedding, embedding_model)
+        SELECT user_id, session_id, message_role, 'Жим лежа', timestamp, embedding, embedding_model
+        FROM conversations WHERE id = 1
+    """)
+    conn.commit()
+    conn.close()
+
+    loaded_ids = []
+    original_load_rows = ConversationKnowledgeBase._load_rows
+
+    def spy_load_rows(self, rows, stale_ids):
+        loaded_ids.extend(row[0] for row in rows)
+        return original_load_rows(self, rows, stale_ids)
+
+    monkeypatch.setattr(ConversationKnowledgeBase, "_load_rows", spy_load_rows)
+    reloaded = await make_knowledge_base(db_path)
+
+    assert loaded_ids == [3]
+    assert reloaded.total_vectors == 2
+    assert reloaded.metadata_store.live_ids().tolist() == [1, 3]
+    results = await reloaded._semantic_search("Пей больше воды", "u1", max_results=3)
+    assert "Приседания по средам" not in [r['content'] for r in results]
+    await reloaded.close()
+
+
+@pytest.mark.asyncio
+async def test_snapshot_remembers_deduplicated_rows(db_path, monkeypatch):
+    """Строки без вектора из-за дедупликации не перечитываются при каждом старте"""
+    kb = await make_knowledge_base(db_path)
+    await kb.store_conversation_message("u1", "s1", "user", "Пей больше воды")
+    await kb.store_conversation_message("u1", "s1", "user", "Приседания по средам")
+    await kb.store_conversation_message("u1", "s1", "user", "пей  больше воды")
+    await kb.close()
+
+    loaded_ids = []
+    original_load_rows = ConversationKnowledgeBase._load_rows
+
+    def spy_load_rows(self, rows, stale_ids):
+        loaded_ids.extend(row[0] for row in rows)
+        return original_load_rows(self, rows, stale_ids)
+
+    monkeypatch.setattr(ConversationKnowledgeBase, "_load_rows", spy_load_rows)
+    reloaded = await make_knowledge_base(db_path)
+
+    assert loaded_ids == []
+    assert reloaded._superseded == {1}
+    assert reloaded.metadata_store.live_ids().tolist() == [1, 2, 3]
+    assert reloaded.total_vectors == 2
+
+    # Удаленная строка забывается
+    await reloaded.cleanup_old_conversations(days_to_keep=0)
+    assert reloaded._superseded == set()
+    await reloaded.close()
+
+
+@pytest.mark.asyncio
+async def test_snapshot_partitions_accept_writes_after_restart(db_path, monkeypatch):
+    """После рестарта из снимка разделы IVF-PQ и Flat принимают новые сообщения"""
+    monkeypatch.setattr(settings, "KB_INDEX_TYPE", "ivfpq")
+    monkeypatch.setattr(settings, "KB_IVF_NLIST", 2)
+    monkeypatch.setattr(settings, "KB_PQ_NBITS", 2)
+    words = ["присед", "жим", "тяга", "бег", "вода", "белок", "сон", "растяжка",
+             "планка", "выпады", "кардио", "отдых", "гречка", "творог"]
+    rng = np.random.default_rng(0)
+
+    kb = await make_knowledge_base(db_path)
+    for _ in range(170):
+        await kb.store_conversation_message("u1", "s1", "user", " ".join(rng.choice(words, 6)))
+    await kb.store_conversation_message("u2", "s1", "user", "Пей больше воды")
+    await kb.flush()
+    await kb._index_rebuilds[current_partition("u1")]
+    assert kb._index_types[current_partition("u1")] == "ivfpq"
+    await kb.close()
+
+    reloaded = await make_knowledge_base(db_path)
+    assert current_partition("u2") in reloaded._mapped_partitions
+    before = reloaded.total_vectors
+    await reloaded.store_conversation_message("u1", "s1", "user", "Новый рекорд в становой тяге")
+    await reloaded.store_conversation_message("u2", "s1", "user", "Приседания по средам")
+    await reloaded.flush()
+
+    assert reloaded.total_vectors == before + 2
+    assert current_partition("u2") not in reloaded._mapped_partitions
+    assert reloaded.ingest_log_path.read_text() == ""
+    results = await reloaded._semantic_search("Новый рекорд в становой тяге", "u1", max_results=1)
+    assert results[0]['content'] == "Новый рекорд в становой тяге"
+    await reloaded.close()
+
+    # Следующий старт снова поднимается из снимка
+    restarted = await make_knowledge_base(db_path)
+    assert restarted.total_vectors == before + 2
+    await restarted.close()
+
+
+@pytest.mark.asyncio
+async def test_quantized_storage_and_flat_codec(db_path, monkeypatch):
+    """Векторы переводятся в float16 на диске, а Flat-разделы держат коды sq8"""
+    kb = await make_knowledge_base(db_path)
+    await kb.store_conversation_message("u1", "s1", "user", "Пей больше воды")
+    await kb.store_conversation_message("u1", "s1", "user", "Приседания по средам")
+    await kb.flush()
+
+    monkeypatch.setattr(settings, "KB_EMBEDDING_STORAGE", "float16")
+    monkeypatch.setattr(settings, "KB_FLAT_CODEC", "sq8")
+    reloaded = await make_knowledge_base(db_path)
+    await reloaded._storage_migration_task
+
+    conn = sqlite3.connect(db_path)
+    sizes = [row[0] for row in conn.execute("SELECT length(embedding) FROM conversations")]
+    conn.close()
+    assert sizes == [kb.embedding_dim * 2] * 2
+
+    index = partition_index(reloaded, "u1")
+    assert index.ntotal == 2
+    assert index.sa_code_size() == kb.embedding_dim  # 1 байт на компоненту
+    results = await reloaded._semantic_search("Пей больше воды", "u1", max_results=1)
+    assert results[0]['content'] == "Пей больше воды"
+
+    # После миграции векторы читаются из float16
+    again = await make_knowledge_base(db_path)
+    assert again.total_vectors == 2
+
+
+@pytest.mark.asyncio
+async def test_repeated_queries_skip_encoder(db_path):
+    """Повторные и почти одинаковые запросы берут вектор из кэша"""
+    model = FakeEmbeddingModel()
+    kb = await make_knowledge_base(db_path, model)
+    await kb.store_conversation_message("u1", "s1", "user", "Пей больше воды")
+    await kb.flush()
+    model.encoded_texts.clear()
+
+    first = await kb._semantic_search("Вода", "u1", max_results=1)
+    second = await kb._semantic_search("  вода? ", "u1", max_results=1)
+
+    assert model.encoded_texts == ["вода"]
+    assert first == second
+    assert kb.query_cache.stats()['hits'] == 1
+    assert kb.query_cache.stats()['misses'] == 1
+
+
+@pytest.mark.asyncio
+async def test_repeated_messages_share_one_vector(db_path):
+    """Одинаковые по тексту сообщения кодируются один раз и хранят один вектор"""
+    model = FakeEmbeddingModel()
+    kb = await make_knowledge_base(db_path, model)
+    await kb.store_conversation_message("u1", "s1", "user", "Спасибо!")
+    await kb.store_conversation_message("u1", "s1", "user", "спасибо")
+    await kb.store_conversation_message("u2", "s2", "user", "Спасибо")
+    await kb.flush()
+    await kb.store_conversation_message("u1", "s1", "user", "Спасибо")
+    await kb.flush()
+
+    assert model.encoded_texts == ["Спасибо!"]
+    assert partition_index(kb, "u1").ntotal == 1
+    assert partition_index(kb, "u2").ntotal == 1
+    # Вектор закреплен за последним из повторов, строки старых остаются
+    assert kb.metadata_store.live_ids().tolist() == [1, 2, 3, 4]
+    assert kb._superseded == {1, 2}
+
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0] == 4
+    conn.close()
+
+    reloaded = await make_knowledge_base(db_path)
+    assert reloaded.total_vectors == 2
+
+
+@pytest.mark.asyncio
+async def test_query_batch_shares_one_encode_and_search(db_path, monkeypatch):
+    """Пачка запросов кодируется и ищется в FAISS за один проход"""
+    model = FakeEmbeddingModel()
+    kb = await make_knowledge_base(db_path, model)
+    for text in ("Присед со штангой", "Протеин после тренировки", "Растяжка перед сном"):
+        await kb.store_conversation_message("u1", "s1", "user", text)
+    await kb.flush()
+    model.encoded_texts.clear()
+
+    searched = []
+    search_index = kb._search_index
+    monkeypatch.setattr(kb, "_search_index", lambda *args: searched.append(args[2].shape) or search_index(*args))
+
+    batch = await kb.search_relevant_context_many(
+        ["присед", "протеин", "Присед!"], "u1", max_results=[1, 2, 1], min_similarity=0.0
+    )
+
+    assert model.encoded_texts == ["присед", "протеин"]
+    assert searched == [(3, model.dim)]
+    assert [r['content'] for r in batch[0]] == ["Присед со штангой"]
+    assert batch[1][0]['content'] == "Протеин после тренировки"
+    assert [r['id'] for r in batch[2]] == [r['id'] for r in batch[0]]
+    single = await kb.search_relevant_context("протеин", "u1", max_results=2, min_similarity=0.0)
+    assert [r['id'] for r in single] == [r['id'] for r in batch[1]]
+
+
+@pytest.mark.asyncio
+async def test_topic_scoped_search_and_summary(db_path):
+    """Поиск по темам ограничен помеченными сообщениями, сводка считается по маскам"""
+    kb = await make_knowledge_base(db_path)
+    await kb.store_conversation_message("u1", "s1", "user", "Протеин и штанга")
+    await kb.store_conversation_message("u1", "s1", "user", "Протеин: питание после зала")
+    await kb.store_conversation_message("u1", "s2", "user", "Протеин перед сном", topics=["sleep"])
+    await kb.flush()
+
+    scoped = await kb.search_relevant_context("протеин", "u1", max_results=5, min_similarity=0.0, topics=["nutrition"])
+    assert [r['content'] for r in scoped] == ["Протеин: питание после зала"]
+    unscoped = await kb.search_relevant_context("протеин", "u1", max_results=5, min_similarity=0.0)
+    assert len(unscoped) == 3
+
+    summary = await kb.get_conversation_summary("u1", days_back=7)
+    assert summary["message_count"] == 3
+    assert summary["topics"] == {"equipment": 1, "nutrition": 1, "sleep": 1}
+    session = await kb.get_conversation_summary("u1", session_id="s2", days_back=7)
+    assert session["topics"] == {"sleep": 1}
+
+
+@pytest.mark.asyncio
+async def test_related_discussions_boost_topics_without_filtering(db_path, monkeypatch):
+    """Тема запроса поднимает помеченные сообщения, но не отсекает непомеченные"""
+    from backend.services import rag_tools_service
+    from backend.services.knowledge_base_service import query_topics
+
+    assert query_topics("правильного питания") == ["nutrition"]
+    assert query_topics("упражнения на спину") == ["workout", "muscle_groups"]
+
+    kb = await make_knowledge_base(db_path)
+    monkeypatch.setattr(rag_tools_service, "knowledge_base", kb)
+    await kb.store_conversation_message("u1", "s1", "user", "Держусь правильного питания уже месяц")
+    await kb.store_conversation_message("u1", "s1", "user", "Питание: правильного режима нет")
+    await kb.flush()
+
+    related = await rag_tools_service.RAGToolsService().execute_tools(
+        [("find_related_discussions", {"topic": "правильного питания"})], "u1"
+    )
+    contents = [discussion["content"] for discussion in related[0]["discussions"]]
+    assert sorted(contents) == ["Держусь правильного питания уже месяц", "Питание: правильного режима нет"]
+
+    boosted = await kb.search_relevant_context(
+        "правильного питания", "u1", max_results=5, min_similarity=0.0, boost_topics=["nutrition"]
+    )
+    assert boosted[0]["content"] == "Питание: правильного режима нет"
+
+
+@pytest.mark.asyncio
+async def test_summary_reads_daily_rollups(db_path):
+    """Сводка складывается из дневных агрегатов, которые ведут триггеры"""
+    kb = await make_knowledge_base(db_path)
+    now = datetime.now()
+    await kb.store_conversation_message("u1", "s1", "user", "Питание и штанга", timestamp=now)
+    await kb.store_conversation_message("u1", "s1", "assistant", "Ешь больше белка", timestamp=now - timedelta(days=3))
+    await kb.store_conversation_message("u1", "s1", "system", "Питание", timestamp=now)
+    await kb.store_conversation_message("u1", "s1", "user", "Старая диета", timestamp=now - timedelta(days=30))
+    await kb.store_conversation_message("u2", "s2", "user", "Питание", timestamp=now)
+    await kb.flush()
+
+    expected = {"message_count": 2, "topics": {"nutrition": 1, "equipment": 1, "general": 1}}
+    summary = await kb.get_conversation_summary("u1", days_back=7)
+    assert {key: summary[key] for key in expected} == expected
+
+    conn = sqlite3.connect(db_path)
+    rollups = conn.execute("SELECT day, topic, message_count FROM conversation_rollups WHERE user_id = 'u1'").fetchall()
+    assert sorted(rollups) == sorted([
+        (now.date().isoformat(), "", 1), (now.date().isoformat(), "nutrition", 1),
+        (now.date().isoformat(), "equipment", 1), ((now - timedelta(days=3)).date().isoformat(), "", 1),
+        ((now - timedelta(days=3)).date().isoformat(), "general", 1), ((now - timedelta(days=30)).date().isoformat(), "", 1),
+        ((now - timedelta(days=30)).date().isoformat(), "nutrition", 1),
+    ])
+
+    # Удаление старых сообщений вычитается из агрегатов
+    await kb.cleanup_old_conversations(days_to_keep=10)
+    assert conn.execute("SELECT COUNT(*) FROM conversation_rollups WHERE user_id = 'u1'").fetchone()[0] == 5
+
+    # Базы без агрегатов заполняют их при старте
+    conn.execute("DROP TABLE conversation_rollups")
+    conn.commit()
+    conn.close()
+    reloaded = await make_knowledge_base(db_path)
+    summary = await reloaded.get_conversation_summary("u1", days_back=7)
+    assert {key: summary[key] for key in expected} == expected
+
+
+def test_split_passages_overlap():
+    """Длинный текст режется по строкам и предложениям с перекрытием"""
+    text = "\n".join(f"Подход {i}: присед со штангой, восемь повторов." for i in range(20))
+
+    passages = split_passages(text, max_chars=200, overlap_chars=60)
+
+    assert len(passages) > 1
+    assert all(len(passage) <= 200 for passage in passages)
+    for previous, passage in zip(passages, passages[1:]):
+        assert passage.split("\n")[0] == previous.split("\n")[-1]
+    assert split_passages("Коротко", max_chars=200, overlap_chars=60) == ["Коротко"]
+    assert max(map(len, split_passages("слово " * 100, max_chars=50, overlap_chars=10))) <= 50
+
+
+@pytest.mark.asyncio
+async def test_long_messages_indexed_as_passages(db_path, monkeypatch):
+    """Длинный ответ индексируется фрагментами, целиком — по запросу"""
+    monkeypatch.setattr(settings, "KB_PASSAGE_MAX_CHARS", 120)
+    monkeypatch.setattr(settings, "KB_PASSAGE_OVERLAP_CHARS", 40)
+    model = FakeEmbeddingModel()
+    kb = await make_knowledge_base(db_path, model)
+    reply = "Понедельник: жим лежа 4x8.\nСреда: становая тяга 3x5.\nПятница: приседания 5x5.\n" * 3
+    await kb.store_conversation_message("u1", "s1", "assistant", reply)
+    await kb.flush()
+
+    passages = split_passages(reply, 120, 40)
+    assert model.encoded_texts == list(dict.fromkeys(passages))
+    assert kb.total_conversations == len(passages)
+    assert kb.total_vectors == len(set(passages))
+
+    results = await kb.search_relevant_context("становая тяга", "u1", min_similarity=0.0)
+    assert results and all(result['content'] in passages for result in results)
+    expanded = await kb.expand_passages(results)
+    assert [result['content'] for result in expanded] == [reply]
+    assert (await kb.get_conversation_summary("u1"))["message_count"] == 1
+    assert [row['content'] for row in kb.get_all_conversations("u1")] == [reply]
+
+    # Родительское сообщение не считается устаревшим при перезагрузке
+    model = FakeEmbeddingModel()
+    reloaded = await make_knowledge_base(db_path, model)
+    assert reloaded.total_conversations == len(passages)
+    assert reloaded.total_vectors == len(set(passages))
+    assert reloaded._reembed_task is None
+
+
+@pytest.mark.asyncio
+async def test_long_range_search_routes_through_sessions(db_path, monkeypatch):
+    """Запрос сначала выбирает близкие сессии по центроидам, затем ищет в их сообщениях"""
+    monkeypatch.setattr(settings, "KB_SESSION_IDLE_MINUTES", 0)
+    monkeypatch.setattr(settings, "KB_SESSION_ROUTING_MIN_VECTORS", 1)
+    monkeypatch.setattr(settings, "KB_SESSION_CANDIDATES", 1)
+    kb = await make_knowledge_base(db_path)
+    sessions = {
+        "legs": ["Становая тяга с паузой", "Становая тяга сумо"],
+        "food": ["Овсянка на завтрак", "Овсянка с бананом"],
+        "sleep": ["Сон восемь часов", "Сон без телефона"],
+    }
+    for session_id, texts in sessions.items():
+        for text in texts:
+            await kb.store_conversation_message("u1", session_id, "user", text)
+    await kb.flush()
+    await kb._catch_up_session_summaries()
+
+    assert sorted(kb.session_summaries.sessions("u1")) == ["food", "legs", "sleep"]
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT SUM(message_count) FROM session_summaries").fetchone()[0] == 6
+    conn.close()
+
+    results = await kb._semantic_search("становая тяга", "u1", max_results=10, time_window_days=0)
+    assert {r['session_id'] for r in results} == {"legs"}
+
+    # Сообщения еще не свернутой сессии ищутся всегда
+    await kb.store_conversation_message("u1", "new", "user", "Становая тяга с цепями")
+    await kb.flush()
+    results = await kb._semantic_search("становая тяга", "u1", max_results=10, time_window_days=0)
+    assert {r['session_id'] for r in results} == {"legs", "new"}
+
+    await kb._summarize_idle_sessions()
+    assert kb.session_summaries.get("u1", "new")[1] == 1
+    reloaded = await make_knowledge_base(db_path)
+    assert len(reloaded.session_summaries) == 4
+
+
+@pytest.mark.asyncio
+async def test_near_duplicates_share_one_vector(db_path, monkeypatch):
+    """Почти одинаковые советы хранят один вектор и не повторяются в выдаче"""
+    monkeypatch.setattr(settings, "KB_NEAR_DUPLICATE_BITS", 3)
+    kb = await make_knowledge_base(db_path)
+    advice = "Старайся пить не меньше двух литров воды в день, особенно в дни тренировок, и не забывай про {}."
+    await kb.store_conversation_message("u1", "s1", "assistant", advice.format("сон"))
+    await kb.store_conversation_message("u1", "s2", "assistant", "Жим лежа делай в четыре подхода по восемь повторений.")
+    await kb.flush()
+    await kb.store_conversation_message("u1", "s3", "assistant", advice.format("отдых"))
+    await kb.flush()
+
+    assert kb.total_vectors == 2
+    assert kb._superseded == {1}
+
+    # Старый совет без своего вектора по-прежнему находится по словам
+    assert kb.metadata_store.live_ids().tolist() == [1, 2, 3]
+    keyword = await kb._keyword_search("про сон", "u1", max_results=5)
+    assert advice.format("сон") in [r['content'] for r in keyword]
+
+    results = await kb.search_relevant_context("литров воды в день", "u1", min_similarity=0.0)
+    assert [r['content'] for r in results].count(advice.format("сон")) + [
+        r['content'] for r in results
+    ].count(advice.format("отдых")) == 1
+
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT COUNT(*) FROM conversations WHERE simhash IS NOT NULL").fetchone()[0] == 3
+    conn.close()
+
+
+@pytest.mark.asyncio
+async def test_tool_results_cached_until_new_message(db_path, monkeypatch):
+    """Повторный вызов инструмента берется из кэша до нового сообщения пользователя"""
+    from backend.services import rag_tools_service
+
+    kb = await make_knowledge_base(db_path)
+    monkeypatch.setattr(rag_tools_service, "knowledge_base", kb)
+    tools = rag_tools_service.RAGToolsService()
+    await kb.store_conversation_message("u1", "s1", "user", "Протеин после тренировки")
+    await kb.flush()
+
+    first = await tools.execute_tools([("search_conversation_history", '{"query": "протеин"}')], "u1")
+    search = kb.search_relevant_context_many
+    monkeypatch.setattr(kb, "search_relevant_context_many", None)
+    second = await tools.execute_tools([("search_conversation_history", {"query": "  Протеин ", "max_results": 3})], "u1")
+    assert second == first
+    assert tools.get_cache_stats()["hits"] == 1
+
+    monkeypatch.setattr(kb, "search_relevant_context_many", search)
+    await kb.store_conversation_message("u1", "s1", "user", "Протеин перед сном")
+    await kb.flush()
+    third = await tools.execute_tools([("search_conversation_history", '{"query": "протеин"}')], "u1")
+    assert third[0]["total_found"] == 2
+    assert tools.get_cache_stats() == {
+        "size": 1, "hits": 1, "misses": 2, "invalidations": 1, "hit_rate": 1 / 3
+    }
+
+
+@pytest.mark.asyncio
+async def test_tool_cache_in_llm_tool_calling_flow(db_path, monkeypatch):
+    """В реальном цикле вызова инструментов повторы берутся из кэша"""
+    import importlib
+    from types import SimpleNamespace
+    from unittest.mock import AsyncMock
+    from backend.services import rag_tools_service
+
+    llm_module = importlib.import_module("backend.services.llm_service")
+
+    kb = await make_knowledge_base(db_path)
+    tools = rag_tools_service.RAGToolsService()
+    monkeypatch.setattr(rag_tools_service, "knowledge_base", kb)
+    monkeypatch.setattr(llm_module, "knowledge_base", kb)
+    monkeypatch.setattr(llm_module, "rag_tools", tools)
+    await kb.store_conversation_message("u1", "s1", "user", "Протеин после тренировки")
+    await kb.flush()
+
+    searched = []
+    search = kb.search_relevant_context_many
+
+    async def counting_search(queries, *args, **kwargs):
+        searched.extend(queries)
+        return await search(queries, *args, **kwargs)
+
+    monkeypatch.setattr(kb, "search_relevant_context_many", counting_search)
+
+    def tool_call(call_id, name, arguments):
+        return SimpleNamespace(id=call_id, type="function",
+                               function=SimpleNamespace(name=name, arguments=json.dumps(arguments)))
+
+    def response(content=None, tool_calls=None):
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content, tool_calls=tool_calls))],
+            usage=SimpleNamespace(total_tokens=10), model="test"
+        )
+
+    calls = [("search_conversation_history", {"query": "протеин"}), ("find_related_discussions", {"topic": "сон"})]
+    repeated = []
+
+    async def create(**kwargs):
+        if "tools" in kwargs:
+            return response(tool_calls=[
+                tool_call(f"call_{number}", name, arguments)
+                for number, (name, arguments) in enumerate(calls + calls[:1])
+            ])
+        # Второй раунд с теми же вызовами: в истории уже tool_calls с новыми id и ответы инструментов
+        repeated.extend(await tools.execute_tools(
+            [(name, json.dumps(arguments)) for name, arguments in calls], "u1", "s1",
+            current_session_context=kwargs["messages"]
+        ))
+        return response(content="Ты ел протеин после тренировки")
+
+    service = llm_module.LLMService()
+    service.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=AsyncMock(side_effect=create))))
+
+    result = await service.chat_with_virtual_trainer("Когда я пил протеин?", user_id="u1", session_id="s1")
+
+    assert result["used_rag"] is True
+    assert searched == ["протеин", "сон"]
+    assert repeated[0]["historical_results"] == 2
+    assert tools.get_cache_stats()["hits"] == 3
+    assert tools.get_cache_stats()["misses"] == 2
+    await kb.flush()
+
+
+@pytest.mark.asyncio
+async def test_tool_arguments_must_be_objects(db_path, monkeypatch):
+    """Аргументы не-объекты дают ошибку только своему вызову"""
+    from backend.services import rag_tools_service
+
+    kb = await make_knowledge_base(db_path)
+    monkeypatch.setattr(rag_tools_service, "knowledge_base", kb)
+    tools = rag_tools_service.RAGToolsService()
+
+    results = await tools.execute_tools(
+        [("search_conversation_history", "[1]"), ("search_conversation_history", '"x"'),
+         ("get_conversation_summary", "{}")],
+        "u1"
+    )
+
+    assert "JSON object" in results[0]["error"] and "JSON object" in results[1]["error"]
+    assert results[2]["available"] is True
+
+
+def test_fusion_merges_arms_by_message_id(tmp_path):
+    """Слияние по id складывает ранги и учитывает важность и свежесть"""
+    kb = ConversationKnowledgeBase(db_path=str(tmp_path / "kb.db"))
+    now = datetime.now()
+
+    def result(conv_id, similarity, days_ago=0, importance=1.0):
+        return {'id': conv_id, 'content': f"сообщение {conv_id}", 'similarity': similarity,
+                'timestamp': (now - timedelta(days=days_ago)).isoformat(),
+                'session_id': 's', 'topics': [], 'importance_score': importance}
+
+    fused = kb._fuse_results({
+        'semantic': [result(1, 0.5), result(2, 0.8)],
+        'keyword': [result(2, 0.6), result(3, 0.9, days_ago=60)],
+        'direct': [result(4, 0.4, importance=3.0)],
+    })
+
+    assert [r['id'] for r in fused] == [4, 2, 1, 3]
+    assert fused[1]['similarity'] == 0.8 and fused[1]['match_type'] == 'semantic'
+    assert fused[0]['score'] > fused[1]['score'] > fused[2]['score']
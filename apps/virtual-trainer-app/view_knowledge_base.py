@@ -12,18 +12,20 @@ async def view_knowledge_base():
         await knowledge_base._ensure_initialized()
         
         print(f"✅ Knowledge base initialized successfully")
-        print(f"📊 Total conversations: {len(knowledge_base.conversation_texts)}")
-        print(f"📊 Total metadata entries: {len(knowledge_base.conversation_metadata)}")
+        conversations_list = knowledge_base.get_all_conversations()
         
-        if hasattr(knowledge_base, 'faiss_index') and knowledge_base.faiss_index:
-            print(f"📊 FAISS index entries: {knowledge_base.faiss_index.ntotal}")
+        print(f"📊 Total conversations: {len(conversations_list)}")
+        print(f"📊 Total metadata entries: {knowledge_base.total_conversations}")
+        
+        print(f"📊 FAISS index entries: {knowledge_base.total_vectors} ({len(knowledge_base.user_indexes)} users)")
         
         print("\n" + "="*80 + "\n")
         
         # Group conversations by user
         user_conversations = {}
         
-        for i, (text, metadata) in enumerate(zip(knowledge_base.conversation_texts, knowledge_base.conversation_metadata)):
+        for i, metadata in enumerate(conversations_list):
+            text = metadata['content']
             user_id = metadata.get('user_id', 'unknown')
             
             if user_id not in user_conversations:
@@ -86,7 +88,8 @@ async def view_knowledge_base():
         cat_content = []
         motivation_content = []
         
-        for i, text in enumerate(knowledge_base.conversation_texts):
+        for i, conversation in enumerate(conversations_list):
+            text = conversation['content']
             text_lower = text.lower()
             
             if any(word in text_lower for word in ['воду', 'вода', 'пить']):
@@ -113,7 +116,7 @@ async def view_knowledge_base():
         print("\n" + "="*80)
         print("📊 SUMMARY:")
         print(f"   Total users: {len(user_conversations)}")
-        print(f"   Total conversations: {len(knowledge_base.conversation_texts)}")
+        print(f"   Total conversations: {len(conversations_list)}")
         print(f"   Water content: {len(water_content)}")
         print(f"   Cat content: {len(cat_content)}")
         print(f"   Motivation content: {len(motivation_content)}")